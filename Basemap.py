@@ -0,0 +1,127 @@
+import os
+import json
+import argparse
+from typing import Optional, TYPE_CHECKING
+import numpy as np
+if TYPE_CHECKING:
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+
+#the dash apps serve this directory at ASSETS_URL
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+ASSETS_URL = '/assets/'
+#seconds browsers may cache assets, urls from basemap_url change whenever the file does
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+#bundled basemaps by the smallest projection scale they are drawn at, zoomed out maps get the coarser ones
+#levels whose file is not in ASSETS_DIR are skipped, a more detailed level is added here once its file is generated
+BASEMAP_LEVELS = [(0, 'world-110m-coarse.json'), (300, 'world-110m.json')]
+#name of the countries object in every basemap topology
+BASEMAP_OBJECT = 'countries'
+
+
+def basemap_file(scale: float) -> str:
+    #the most detailed bundled basemap for a map at projection scale
+    available = [name for min_scale, name in BASEMAP_LEVELS
+                 if os.path.exists(os.path.join(ASSETS_DIR, name))]
+    assert available, f"No basemap found in {ASSETS_DIR}, generate one with Basemap.py"
+    detailed = [name for min_scale, name in BASEMAP_LEVELS if min_scale <= scale and name in available]
+    return detailed[-1] if detailed else available[0]
+
+
+def basemap_url(name: str) -> str:
+    #url of a bundled basemap, the modification time changes the url when the file is regenerated
+    #so browsers can cache it for as long as the app allows
+    mtime = int(os.path.getmtime(os.path.join(ASSETS_DIR, name)))
+    return f'{ASSETS_URL}{name}?m={mtime}'
+
+
+def encode_topology(gdf: 'gpd.GeoDataFrame', quantization: int = 100000, tolerance: float = 0.0,
+                    name_column: Optional[str] = 'name', id_column: Optional[str] = 'iso_a3') -> dict:
+    #a topojson topology of the (multi)polygons of gdf in lon/lat, held as the object BASEMAP_OBJECT
+    #geometries are simplified by tolerance degrees first, positions are quantized and delta encoded
+    #every ring is its own arc, borders are not shared between neighbours
+    #geopandas and shapely are only needed to generate basemaps, not by the apps reading them
+    from shapely.geometry import Polygon, MultiPolygon
+    from shapely.geometry.polygon import orient
+    geometries = gdf.geometry.simplify(tolerance, preserve_topology=True) if tolerance else gdf.geometry
+    x0, y0, x1, y1 = geometries.total_bounds
+    kx = (x1 - x0) / (quantization - 1) or 1.0
+    ky = (y1 - y0) / (quantization - 1) or 1.0
+    arcs = []
+
+    def arc(ring) -> Optional[int]:
+        q = np.round((np.asarray(ring.coords)[:, :2] - [x0, y0]) / [kx, ky]).astype(np.int64)
+        #points that fall on the same quantized position are dropped, collapsed rings with them
+        q = q[np.r_[True, np.any(np.diff(q, axis=0) != 0, axis=1)]]
+        if len(q) < 4:
+            return None
+        arcs.append(np.r_[q[:1], np.diff(q, axis=0)].tolist())
+        return len(arcs) - 1
+
+    def polygon(poly: 'Polygon') -> list:
+        #d3 expects clockwise exterior rings
+        poly = orient(poly, sign=-1.0)
+        exterior = arc(poly.exterior)
+        if exterior is None:
+            return []
+        return [[exterior]] + [[i] for i in map(arc, poly.interiors) if i is not None]
+
+    objects = []
+    for i, geometry in enumerate(geometries):
+        if geometry is None or geometry.is_empty:
+            continue
+        polygons = list(geometry.geoms) if isinstance(geometry, MultiPolygon) else [geometry]
+        rings = [rings for rings in map(polygon, polygons) if rings]
+        if not rings:
+            continue
+        obj = {'type': 'Polygon', 'arcs': rings[0]} if len(rings) == 1 else {'type': 'MultiPolygon', 'arcs': rings}
+        if id_column in gdf.columns:
+            obj['id'] = str(gdf[id_column].iloc[i])
+        if name_column in gdf.columns:
+            obj['properties'] = {'name': str(gdf[name_column].iloc[i])}
+        objects.append(obj)
+    return {'type': 'Topology',
+            'bbox': [float(x0), float(y0), float(x1), float(y1)],
+            'transform': {'scale': [float(kx), float(ky)], 'translate': [float(x0), float(y0)]},
+            'objects': {BASEMAP_OBJECT: {'type': 'GeometryCollection', 'geometries': objects}},
+            'arcs': arcs}
+
+
+def decode_topology(topology: dict) -> dict:
+    #the BASEMAP_OBJECT of a topology written by encode_topology as a geojson FeatureCollection
+    scale, translate = topology['transform']['scale'], topology['transform']['translate']
+    rings = [(np.cumsum(np.array(arc), axis=0) * scale + translate).round(5).tolist() for arc in topology['arcs']]
+    def polygon(arcs):
+        return [rings[ring[0]] for ring in arcs]
+    features = []
+    for obj in topology['objects'][BASEMAP_OBJECT]['geometries']:
+        coordinates = polygon(obj['arcs']) if obj['type'] == 'Polygon' else [polygon(arcs) for arcs in obj['arcs']]
+        features.append({'type': 'Feature', 'id': obj.get('id'), 'properties': obj.get('properties', {}),
+                         'geometry': {'type': obj['type'], 'coordinates': coordinates}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def basemap_geojson(name: str) -> dict:
+    #a bundled basemap as geojson, for renderers that do not read topojson
+    with open(os.path.join(ASSETS_DIR, name)) as f:
+        return decode_topology(json.load(f))
+
+
+def write_topology(gdf: 'gpd.GeoDataFrame', path: str, **kwargs) -> None:
+    with open(path, 'w') as f:
+        json.dump(encode_topology(gdf, **kwargs), f, separators=(',', ':'))
+
+
+if __name__ == '__main__':
+    #regenerates a bundled basemap from a natural earth countries file, e.g.
+    #python Basemap.py ne_50m_admin_0_countries.shp world-50m.json
+    parser = argparse.ArgumentParser(description='Write a countries basemap topology into assets/')
+    parser.add_argument('source', help='polygon file readable by geopandas, in lon/lat')
+    parser.add_argument('name', help='file name in assets/, see BASEMAP_LEVELS')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='simplification tolerance in degrees')
+    parser.add_argument('--quantization', type=int, default=100000)
+    args = parser.parse_args()
+    import geopandas as gpd
+    gdf = gpd.read_file(args.source).to_crs(4326)
+    gdf.columns = [col.lower() for col in gdf.columns]
+    write_topology(gdf, os.path.join(ASSETS_DIR, args.name), quantization=args.quantization, tolerance=args.tolerance)
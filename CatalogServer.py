@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import argparse
+import threading
+from dataclasses import fields
+from datetime import datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+from DataLoader import RequestParams, DT_FORMAT, MAX_RECORDS, RAW_TYPES, InvalidParamError, load_catalog
+from SpatialIndex import SpatialIndex
+from CatalogStore import CatalogStore
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#where a local server listens by default, point DataLoader at it with
+#EARTHQUAKE_API_URL=http://127.0.0.1:8600/fdsnws/event/1/
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8600
+#served under the same path as the usgs service
+SERVER_PATH = '/fdsnws/event/1/'
+#like the usgs service, a query without starttime covers the last 30 days
+DEFAULT_DAYS = 30
+#orderby values and the column and direction they sort by
+ORDERS = {'time': ('time', False), 'time-asc': ('time', True),
+          'magnitude': ('mag', False), 'magnitude-asc': ('mag', True)}
+
+
+def raw_frame(df: pd.DataFrame) -> pd.DataFrame:
+    #the events of df with RAW_TYPES columns, as parse_geojson reads them from the api
+    #accepts frames as returned by the api (a CatalogStore) or preprocessed catalogs indexed by id (save_catalog)
+    if 'id' not in df.columns:
+        df = df.reset_index().rename(columns={df.index.name or 'index': 'id'})
+    df = df.copy()
+    for col in ('time', 'updated'):
+        if col in df.columns and pd.api.types.is_datetime64_any_dtype(df[col]):
+            times = df[col] if df[col].dt.tz is not None else df[col].dt.tz_localize('UTC')
+            df[col] = (times - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+    if 'updated' not in df.columns:
+        df['updated'] = df['time']
+    return df[list(RAW_TYPES)].astype(RAW_TYPES, copy=False)
+
+
+def read_catalog(path: str) -> pd.DataFrame:
+    #a CatalogStore directory, which holds the events as the api returned them, or any catalog load_catalog reads
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return raw_frame(CatalogStore(path).load())
+    return raw_frame(load_catalog(path))
+
+
+def parse_params(args: dict) -> RequestParams:
+    #RequestParams from the arguments of a request, typed like the dataclass defaults
+    #arguments that are not given are None so they do not filter, unlike the RequestParams defaults
+    values = {}
+    for field in fields(RequestParams):
+        value = args.get(field.name)
+        if value is None or field.name in ('format', 'orderby', 'limit', 'offset'):
+            continue
+        if field.name in ('starttime', 'endtime', 'updatedafter'):
+            #the api also accepts dates and iso times with a T
+            value = datetime.fromisoformat(value.replace('Z', '')).strftime(DT_FORMAT)
+        elif field.name in ('minsig', 'maxsig'):
+            value = int(float(value))
+        else:
+            value = float(value)
+        values[field.name] = value
+    return RequestParams(**{**{field.name: None for field in fields(RequestParams)}, **values,
+                            'format': args.get('format', 'geojson'),
+                            'orderby': args.get('orderby', 'time'),
+                            'limit': int(args['limit']) if 'limit' in args else None,
+                            'offset': int(args.get('offset', 1))})
+
+
+class LocalCatalog:
+    #events held sorted by time with a SpatialIndex, answering requests as the usgs api would
+    #a request is a binary search of its time window, vectorised masks of the other filters
+    #and a SpatialIndex lookup of its rectangle and circle
+    def __init__(self, df: pd.DataFrame) -> None:
+        self.df = raw_frame(df).sort_values('time', kind='stable', ignore_index=True)
+        self.times = self.df['time'].to_numpy()
+        self.index = SpatialIndex.from_frame(self.df)
+        self.columns = {col: self.df[col].to_numpy() for col in RAW_TYPES}
+
+    @classmethod
+    def from_path(cls, path: str) -> 'LocalCatalog':
+        return cls(read_catalog(path))
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def select(self, params: RequestParams) -> np.ndarray:
+        #rows matching every filter of params, ascending in time
+        def ms(value):
+            return int(datetime.strptime(value, DT_FORMAT).replace(tzinfo=timezone.utc).timestamp() * 1000)
+        start = params.starttime
+        if start is None:
+            start = datetime.strftime(datetime.now(timezone.utc) - timedelta(days=DEFAULT_DAYS), DT_FORMAT)
+        i = np.searchsorted(self.times, ms(start), side='left')
+        j = len(self) if params.endtime is None else np.searchsorted(self.times, ms(params.endtime), side='right')
+        rows = np.arange(i, max(i, j))
+        keep = np.ones(len(rows), dtype=bool)
+        if params.updatedafter is not None:
+            keep &= self.columns['updated'][rows] > ms(params.updatedafter)
+        for col, low, high in (('mag', params.minmagnitude, params.maxmagnitude),
+                               ('depth', params.mindepth, params.maxdepth),
+                               ('sig', params.minsig, params.maxsig)):
+            if low is not None:
+                keep &= self.columns[col][rows] >= low
+            if high is not None:
+                keep &= self.columns[col][rows] <= high
+        rows = rows[keep]
+        spatial = self.index.filter(params)
+        if spatial is not None:
+            rows = np.intersect1d(rows, spatial, assume_unique=True)
+        return rows
+
+    def count(self, params: RequestParams) -> int:
+        return len(self.select(params))
+
+    def query(self, params: RequestParams) -> pd.DataFrame:
+        #the page of events selected by offset and limit, in the order asked for
+        rows = self.select(params)
+        if params.orderby not in ORDERS:
+            raise InvalidParamError(f'orderby must be one of {", ".join(ORDERS)} not "{params.orderby}"')
+        col, ascending = ORDERS[params.orderby]
+        if col == 'time':
+            order = rows if ascending else rows[::-1]
+        else:
+            values = self.columns[col][rows]
+            #ties stay most recent first, like the api
+            order = rows[::-1][np.argsort(values[::-1] if ascending else -values[::-1], kind='stable')]
+        limit = MAX_RECORDS if params.limit is None else params.limit
+        if limit > MAX_RECORDS:
+            raise InvalidParamError(f'limit must be at most {MAX_RECORDS}')
+        if params.limit is None and len(order) > MAX_RECORDS:
+            raise InvalidParamError(f'{len(order)} matching events exceeds search limit of {MAX_RECORDS}')
+        offset = max(params.offset or 1, 1) - 1
+        return self.df.take(order[offset:offset + limit])
+
+    def geojson(self, df: pd.DataFrame, url: str = '') -> bytes:
+        #a geojson feature collection of df shaped like the usgs response
+        records = df.astype(object).where(df.notna(), None)
+        features = [{'type': 'Feature',
+                     'properties': {'mag': mag, 'place': place, 'time': t, 'updated': updated, 'tsunami': int(tsunami),
+                                    'cdi': cdi, 'alert': alert, 'sig': sig, 'type': 'earthquake'},
+                     'geometry': {'type': 'Point', 'coordinates': [lon, lat, depth]},
+                     'id': id}
+                    for id, place, t, lat, lon, mag, sig, depth, tsunami, cdi, alert, updated
+                    in zip(*(records[col] for col in RAW_TYPES))]
+        body = {'type': 'FeatureCollection',
+                'metadata': {'generated': int(time.time() * 1000), 'url': url, 'title': 'Local earthquake catalog',
+                             'status': 200, 'count': len(features)},
+                'features': features}
+        return orjson.dumps(body) if orjson is not None else json.dumps(body).encode()
+
+
+def make_handler(catalog: LocalCatalog):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send(self, status: int, body: bytes, content_type: str = 'application/json') -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            args = {k: v[0] for k, v in parse_qs(url.query).items()}
+            endpoint = url.path[len(SERVER_PATH):] if url.path.startswith(SERVER_PATH) else None
+            if endpoint not in ('count', 'query'):
+                self.send(404, b'Not Found', 'text/plain')
+                return
+            try:
+                params = parse_params(args)
+                if params.format != 'geojson':
+                    raise InvalidParamError(f'format must be "geojson" not "{params.format}"')
+                if endpoint == 'count':
+                    body = json.dumps({'count': catalog.count(params), 'maxAllowed': MAX_RECORDS}).encode()
+                else:
+                    body = catalog.geojson(catalog.query(params), self.path)
+            except (InvalidParamError, ValueError) as e:
+                #the api answers bad requests with 400 and a plain text explanation
+                self.send(400, f'Bad Request: {e}'.encode(), 'text/plain')
+                return
+            self.send(200, body)
+    return Handler
+
+
+def serve(catalog: LocalCatalog, host: str = SERVER_HOST, port: int = SERVER_PORT,
+          background: bool = False) -> ThreadingHTTPServer:
+    #serves catalog on host:port, port 0 picks a free port, the api url is then
+    #f'http://{host}:{server.server_port}{SERVER_PATH}'
+    #in the background the server runs in a daemon thread and is stopped with server.shutdown()
+    server = ThreadingHTTPServer((host, port), make_handler(catalog))
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+if __name__ == '__main__':
+    #serves a synced or saved catalog, e.g.
+    #python CatalogServer.py .cache/catalogs/0123456789abcdef --port 8600
+    parser = argparse.ArgumentParser(description='Serve a local catalog through the usgs fdsn event api')
+    parser.add_argument('path', help='a CatalogStore directory or a catalog written by save_catalog')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    args = parser.parse_args()
+    catalog = LocalCatalog.from_path(args.path)
+    print(f'Serving {len(catalog)} events at http://{args.host}:{args.port}{SERVER_PATH}')
+    serve(catalog, args.host, args.port)
@@ -0,0 +1,91 @@
+import os
+import json
+import hashlib
+from typing import Optional
+import pandas as pd
+from DataLoader import empty_frame
+
+#default location of synced catalogs, relative to the working directory
+STORE_DIR = os.path.join('.cache', 'catalogs')
+
+#request params that select which events are held, every other param only pages or orders them
+WINDOW_PARAMS = ('starttime', 'endtime', 'updatedafter', 'limit', 'offset', 'orderby')
+
+
+def filter_fingerprint(url: str, params) -> str:
+    #hash of the url and the non window params, catalogs are only reused for identical filters
+    fields = {k: v for k, v in params.__dict__.items() if k not in WINDOW_PARAMS}
+    return hashlib.sha256(json.dumps([url, fields], sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class CatalogStore:
+    #a local copy of the events in a request window, kept current by DataLoader.sync
+    #events are stored as returned by the api in catalog.parquet
+    #meta.json records the filters, the window start and end and the high-water mark of 'updated'
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.path = os.path.join(directory, 'catalog.parquet')
+        self.meta_path = os.path.join(directory, 'meta.json')
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.meta = {}
+
+    @classmethod
+    def for_params(cls, url: str, params, root: str = STORE_DIR) -> 'CatalogStore':
+        #one store per filter set under root so differently filtered requests do not reset each other
+        return cls(os.path.join(root, filter_fingerprint(url, params)))
+
+    @property
+    def high_water_mark(self) -> Optional[int]:
+        #latest 'updated' time (epoch ms) of any stored event
+        return self.meta.get('high_water_mark')
+
+    @property
+    def endtime(self) -> Optional[str]:
+        #end of the window the store was last synced for, later events have to be fetched in full
+        return self.meta.get('endtime')
+
+    def covers(self, url: str, params) -> bool:
+        #True if the store holds the same filters and a window starting no later than params
+        #the window may end before params, DataLoader.sync fetches the rest
+        if self.high_water_mark is None or self.meta.get('filters') != filter_fingerprint(url, params):
+            return False
+        return params.starttime is not None and self.meta.get('starttime') is not None \
+            and self.meta['starttime'] <= params.starttime
+
+    def load(self) -> pd.DataFrame:
+        if not os.path.exists(self.path):
+            return empty_frame()
+        return pd.read_parquet(self.path)
+
+    def replace(self, df: pd.DataFrame, url: str, params, endtime: Optional[str] = None) -> pd.DataFrame:
+        #overwrites the stored events with df, fetched with params for a window ending at endtime
+        #(params.endtime by default)
+        if df.empty:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.meta['high_water_mark'] = None
+        else:
+            df.to_parquet(self.path)
+            self.meta['high_water_mark'] = int(df['updated'].max())
+        self.meta['filters'] = filter_fingerprint(url, params)
+        self.meta['starttime'] = params.starttime
+        self.meta['endtime'] = endtime or params.endtime
+        with open(self.meta_path, 'w') as f:
+            json.dump(self.meta, f)
+        return df
+
+    def upsert(self, df: pd.DataFrame, url: str, params, start_ms: Optional[int] = None,
+               endtime: Optional[str] = None) -> pd.DataFrame:
+        #replaces stored events that share an id with df and appends the rest
+        #events older than start_ms have left the window and are dropped
+        old = self.load()
+        df = df.drop_duplicates(subset='id', keep='last')
+        merged = pd.concat([old[~old['id'].isin(df['id'])], df], ignore_index=True)
+        if start_ms is not None:
+            merged = merged[merged['time'] >= start_ms]
+        merged = merged.sort_values('time', ascending=False, ignore_index=True)
+        return self.replace(merged, url, params, endtime)
@@ -1,15 +1,51 @@
 import pandas as pd
-from io import StringIO
+import numpy as np
+from io import BytesIO
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import json
-import geopandas as gpd
-from typing import Union
-from dataclasses import dataclass
-from datetime import datetime
+import os
+import shutil
+import threading
+import hashlib
+import math
+from typing import Union, BinaryIO, Callable, Iterator
+#ijson parses responses feature by feature as they stream in
+#without it the whole response is parsed at once, with orjson when it is installed
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
 from typing import Optional
+from SingleFlight import SingleFlight
 #Datetime format for the project
 DT_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+#fdsn event service queried by default, EARTHQUAKE_API_URL points every DataLoader elsewhere,
+#e.g. at a CatalogServer answering from a local catalog
+API_URL = os.environ.get('EARTHQUAKE_API_URL', 'https://earthquake.usgs.gov/fdsnws/event/1/')
+
+#the usgs api refuses any single query matching more than this many records
+MAX_RECORDS = 20000
+#sharded queries aim to fill each sub-window to this fraction of MAX_RECORDS
+#so that uneven event rates inside a window rarely force a second split
+SHARD_FILL = 0.8
+
+#number of requests a DataLoader runs at once when counting and fetching shards
+MAX_WORKERS = 4
+#responses that are retried with exponential backoff before a request fails
+RETRY_STATUS = (429, 500, 502, 503, 504)
+#seconds to wait for the api to connect and to respond
+REQUEST_TIMEOUT = (10, 120)
+
 #columns and their types expected by the datavisuzlizer
 COL_TYPES = {'place': 'object',
             'time': 'datetime64[ns, UTC]',
@@ -22,6 +58,14 @@ COL_TYPES = {'place': 'object',
             'cdi': 'float64',
             'alert': 'object',
 }
+
+#columns and their types parsed from the api's geojson by parse_geojson
+#time and updated stay in epoch milliseconds until preprocess
+RAW_TYPES = {'id': 'object',
+             **COL_TYPES,
+             'time': 'int64',
+             'updated': 'int64',
+}
 #A custom error class for validating GeoJSONRequestParams
 class InvalidParamError(Exception):
     def __init__(self, message: str):
@@ -57,6 +101,7 @@ class RequestParams:
     maxradius: Optional[float] = None #radius in degress, must be in [0, 180]
 
     #requests are limited to a max of 20000 records
+    #DataLoader.query returns at most limit records, fetching more than 20000 a page at a time with offset
     limit: int = 20000
     offset: int = 1
     orderby: str = 'time' #
@@ -67,6 +112,9 @@ class RequestParams:
     minsig: Optional[int] = None
     maxsig: Optional[int] = None
 
+    #only return events updated after this time, used to sync a local catalog
+    updatedafter: Optional[str] = None
+
     def validate(self):
         try:
             assert self.format == 'geojson', f'format must be "geojson" not "{self.format}"'
@@ -90,47 +138,393 @@ class RequestParams:
 
 
 
+def params_key(url: str, params: RequestParams) -> str:
+    #canonical hash of a request to url
+    #None values are dropped since they are never sent, numbers are compared as floats so 6 and 6.0 match
+    fields = {}
+    for name, value in params.__dict__.items():
+        if value is None:
+            continue
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = float(value)
+        fields[name] = value
+    blob = json.dumps([url, fields], sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def parse_geojson(stream: Union[bytes, BinaryIO])->pd.DataFrame:
+    #parses a geojson feature collection into a DataFrame with RAW_TYPES columns
+    #properties and coordinates are appended to one buffer per column, so no per-feature objects are kept
+    if isinstance(stream, bytes):
+        stream = BytesIO(stream)
+    if ijson is not None:
+        features = ijson.items(stream, 'features.item', use_float=True)
+    elif orjson is not None:
+        features = orjson.loads(stream.read())['features']
+    else:
+        features = json.load(stream)['features']
+
+    columns = {col: [] for col in RAW_TYPES}
+    for feature in features:
+        properties = feature['properties']
+        coordinates = feature['geometry']['coordinates']
+        columns['id'].append(feature['id'])
+        columns['place'].append(properties['place'])
+        columns['time'].append(properties['time'])
+        columns['updated'].append(properties['updated'])
+        columns['mag'].append(properties['mag'])
+        columns['sig'].append(properties['sig'] or 0)
+        columns['tsunami'].append(properties['tsunami'] or 0)
+        columns['cdi'].append(properties['cdi'])
+        columns['alert'].append(properties['alert'])
+        columns['lon'].append(coordinates[0])
+        columns['lat'].append(coordinates[1])
+        columns['depth'].append(coordinates[2] if len(coordinates) > 2 else None)
+
+    #None becomes NaN in the float columns
+    return pd.DataFrame({col: np.array(values, dtype=RAW_TYPES[col]) for col, values in columns.items()},
+                        copy=False)
+
+def empty_frame()->pd.DataFrame:
+    #a DataFrame with RAW_TYPES columns and no events
+    return pd.DataFrame({col: np.array([], dtype=dtype) for col, dtype in RAW_TYPES.items()})
+
+def save_catalog(df: pd.DataFrame, path: str, format: str = 'parquet', partition_by_year: bool = False,
+                 window: Optional[tuple] = None)->None:
+    #writes a catalog as parquet or arrow ipc ('arrow'), keeping the COL_TYPES schema
+    #including the tz-aware time and the bool tsunami columns
+    #partition_by_year writes a parquet dataset directory with one year=YYYY subdirectory per year
+    #'monthly' writes the events to the PartitionedCatalog in directory path, which queries read only parts of,
+    #replacing the events it holds in window, (start, end) of the request df came from, by default the times of df
+    if format == 'monthly':
+        from PartitionedCatalog import PartitionedCatalog
+        if window is None and len(df):
+            window = (df['time'].min(), df['time'].max())
+        PartitionedCatalog(path).write(df, *(window or ()))
+    elif format == 'arrow':
+        assert not partition_by_year, "Only parquet catalogs can be partitioned"
+        #arrow ipc files have no index, a named index is kept as a column
+        df.reset_index(drop=df.index.name is None).to_feather(path)
+    elif partition_by_year:
+        #a dataset directory gains files on every write, so an existing catalog is removed first
+        shutil.rmtree(path, ignore_errors=True)
+        df.assign(year=df['time'].dt.year).to_parquet(path, partition_cols=['year'])
+    else:
+        df.to_parquet(path)
+
+def load_catalog(path: str, columns: Optional[list[str]] = None)->pd.DataFrame:
+    #reads a catalog written by save_catalog, columns optionally limits the columns read
+    #arrow ipc files are recognised by their .arrow or .feather extension, monthly catalogs by their metadata file
+    from PartitionedCatalog import PartitionedCatalog, CATALOG_META
+    if os.path.exists(os.path.join(path, CATALOG_META)):
+        df = PartitionedCatalog(path).to_frame(columns)
+    elif path.endswith(('.arrow', '.feather')):
+        df = pd.read_feather(path, columns=columns)
+        if 'id' in df.columns:
+            df = df.set_index('id')
+    else:
+        df = pd.read_parquet(path, columns=columns)
+        if 'year' in df.columns:
+            df = df.drop(columns='year')
+    return df.astype({col: dtype for col, dtype in COL_TYPES.items() if col in df.columns}, copy=False)
+
+def make_session(max_workers: int = MAX_WORKERS,
+                 per_host: Optional[int] = None,
+                 retries: int = 5,
+                 backoff: float = 0.5)->requests.Session:
+    #returns a session with a connection pool of max_workers connections
+    #per_host caps the open connections to any one host, requests beyond it wait for a free connection
+    #429 and 5xx responses are retried with exponential backoff, honouring Retry-After
+    #a failed connection is retried once, unreachable hosts fail fast
+    retry = Retry(total=retries,
+                  connect=1,
+                  read=0,
+                  backoff_factor=backoff,
+                  status_forcelist=RETRY_STATUS,
+                  allowed_methods=['GET'],
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=per_host or max_workers,
+                          pool_block=True,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 class DataLoader:
-    url: str = 'https://earthquake.usgs.gov/fdsnws/event/1/'
+    url: str = API_URL
     count_url: str = url + 'count'
     query_url: str = url + 'query'
-    def __init__(self, params: RequestParams) -> None:
+    #sessions shared by the DataLoaders that are not given one, one per max_workers
+    #so a loader never waits on the smaller connection pool of another
+    sessions: dict[int, requests.Session] = {}
+    sessions_lock = threading.Lock()
+    #identical requests made at the same time by any DataLoader in the process share one response
+    flights: SingleFlight = SingleFlight()
+    def __init__(self, params: RequestParams,
+                 url: Optional[str] = None,
+                 session: Optional[requests.Session] = None,
+                 max_workers: int = MAX_WORKERS,
+                 cache: Optional['QueryCache'] = None,
+                 progress: Optional[Callable[[int, int], None]] = None) -> None:
         assert params.validate()
         self.params = params
+        if url is not None:
+            self.url = url
+            self.count_url = url + 'count'
+            self.query_url = url + 'query'
+        if session is None:
+            with DataLoader.sessions_lock:
+                if max_workers not in DataLoader.sessions:
+                    DataLoader.sessions[max_workers] = make_session(max_workers)
+                session = DataLoader.sessions[max_workers]
+        self.session = session
+        self.max_workers = max_workers
+        #an optional QueryCache answering repeated counts and queries
+        self.cache = cache
+        #an optional callback given (shards fetched, shards) as a sharded query progresses
+        self.progress = progress
 
-    def count(self)->int: 
-        #performs a get request using count_url and params
-        #returns the number of records that would be returned in a query
+    def get(self, url: str, params: RequestParams, stream: bool = False)->requests.Response:
+        #performs a get request with the pooled session
+        #raises if the request still fails after retries
         try:
-            self.response = requests.get(self.count_url, self.params.__dict__)
-            if self.response.status_code != 200:
-                raise Exception(f'HTTP Request Error: {self.response.status_code}')
+            response = self.session.get(url, params=params.__dict__, timeout=REQUEST_TIMEOUT, stream=stream)
+            if response.status_code != 200:
+                #a streamed response holds its connection until closed, which would leave a blocking pool short
+                response.close()
+                raise Exception(f'HTTP Request Error: {response.status_code}')
         except Exception as e:
             raise Exception(str(e))
         else:
-            self.body = json.loads(self.response.text)
+            self.response = response
+            return response
+
+    def count(self, params: Optional[RequestParams] = None)->int: 
+        #performs a get request using count_url and params (self.params by default)
+        #returns the number of records that would be returned in a query
+        params = params or self.params
+        def request():
+            if self.cache is not None:
+                count = self.cache.get_count(self.count_url, params)
+                if count is not None:
+                    return count
+            response = self.get(self.count_url, params)
+            self.body = json.loads(response.text)
+            if self.cache is not None:
+                self.cache.put_count(self.count_url, params, self.body['count'])
             return self.body['count']
+        return self.coalesce(self.count_url, params, request)
+
+    def fetch(self, params: RequestParams)->pd.DataFrame:
+        #performs a single get request using query_url and params
+        #the response body is parsed as it streams in
+        def request():
+            if self.cache is not None:
+                df = self.cache.get_frame(self.query_url, params)
+                if df is not None:
+                    return df
+            response = self.get(self.query_url, params, stream=True)
+            with response:
+                response.raw.decode_content = True
+                df = parse_geojson(response.raw)
+            if self.cache is not None:
+                self.cache.put_frame(self.query_url, params, df)
+            return df
+        return self.coalesce(self.query_url, params, request)
+
+    def coalesce(self, url: str, params: RequestParams, request: Callable):
+        #runs request unless the same request is already in flight, then waits for and returns its answer
+        #loaders given a cache also wait for the same request made by other processes sharing the cache,
+        #request looks in the cache first so it finds their answer instead of asking the api
+        directory = os.path.join(self.cache.directory, 'flights') if self.cache is not None else None
+        return self.flights.do(params_key(url, params), request, directory)
     
-    def query(self)->gpd.GeoDataFrame:
-        try: 
-            COUNT = self.count()
-            assert COUNT <= 20000, "Queries cannot exceed 20,000 records"
-            self.response = requests.get(self.query_url, self.params.__dict__)
-            if self.response.status_code != 200:
-                raise Exception(f"HTTP Request Error: {self.response.status_code}")
-        except Exception as e:
-            raise Exception(str(e))
+    def query(self, sharded: bool = False, page_size: int = MAX_RECORDS)->pd.DataFrame:
+        #sharded queries split the time window so they are not limited to MAX_RECORDS
+        if sharded:
+            return self.query_sharded()
+        self.df = self.paginate(self.params, page_size)
+        return self.df
+
+    def paginate(self, params: RequestParams, page_size: int = MAX_RECORDS)->pd.DataFrame:
+        #fetches the first params.limit records of params, page_size at a time with offset, instead of counting first
+        #a full page means there may be more, so pages are requested until one comes back short
+        #when the cache already knows the count, the pages it implies are fetched concurrently first,
+        #paging then goes on after them in case the count went stale
+        page_size = min(page_size, MAX_RECORDS)
+        offset, end = params.offset, params.offset + params.limit
+        def page(offset: int)->RequestParams:
+            return replace(params, limit=min(page_size, end - offset), offset=offset)
+
+        frames = []
+        count = None if self.cache is None else self.cache.get_count(self.count_url, params)
+        if count:
+            pages = [page(start) for start in range(offset, min(offset + count, end), page_size)]
+            with ThreadPoolExecutor(self.max_workers) as pool:
+                frames = list(pool.map(self.fetch, pages))
+            offset = pages[-1].offset + pages[-1].limit
+            if len(frames[-1]) < pages[-1].limit:
+                offset = end
+        while offset < end:
+            request = page(offset)
+            frames.append(self.fetch(request))
+            if len(frames[-1]) < request.limit:
+                break
+            offset += request.limit
+
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
+
+    def window(self)->tuple[datetime, datetime]:
+        #returns the (start, end) of the request, filling in the api defaults
+        #of the last 30 days when starttime or endtime is not specified
+        now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        end = now if self.params.endtime is None else datetime.strptime(self.params.endtime, DT_FORMAT)
+        start = end - timedelta(days=30) if self.params.starttime is None else datetime.strptime(self.params.starttime, DT_FORMAT)
+        return start, end
+
+    def window_params(self, start: datetime, end: datetime)->RequestParams:
+        #returns a copy of self.params restricted to [start, end]
+        #every window is fetched whole, the caller's offset and limit apply once to the combined events
+        return replace(self.params,
+                       starttime=datetime.strftime(start, DT_FORMAT),
+                       endtime=datetime.strftime(end, DT_FORMAT),
+                       offset=1, limit=MAX_RECORDS)
+
+    def shard(self, max_records: int = MAX_RECORDS)->list[RequestParams]:
+        #splits the request window into sub-windows holding at most max_records events each
+        #windows are sized from their counts and split again until every window fits
+        #each round counts all the new sub-windows concurrently
+        start, end = self.window()
+        pending = [(start, end, self.count(self.window_params(start, end)))]
+        shards = []
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            while pending:
+                windows = []
+                for start, end, count in pending:
+                    if count == 0:
+                        continue
+                    if count <= max_records:
+                        shards.append(self.window_params(start, end))
+                        continue
+
+                    seconds = int((end - start).total_seconds())
+                    n = math.ceil(count / (max_records * SHARD_FILL))
+                    if seconds < n:
+                        raise Exception(f"Cannot shard {count} records between {start} and {end}")
+                    #api times have a resolution of one second, so bounds are whole seconds
+                    bounds = [start + timedelta(seconds=seconds * i // n) for i in range(n)] + [end]
+                    windows.extend(zip(bounds[:-1], bounds[1:]))
+
+                counts = pool.map(lambda window: self.count(self.window_params(*window)), windows)
+                pending = [(start, end, count) for (start, end), count in zip(windows, counts)]
+
+        #most recent window first, matching the api default orderby='time'
+        shards.sort(key=lambda params: params.starttime, reverse=True)
+        return shards
+
+    def iter_sharded(self, max_records: int = MAX_RECORDS)->Iterator[pd.DataFrame]:
+        #yields the events of each shard as soon as it and the shards before it arrive, most recent shard first
+        #windows share their boundary second so events on it already yielded are dropped by id
+        shards = self.shard(max_records)
+        seen = set()
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            for i, frame in enumerate(pool.map(self.fetch, shards), 1):
+                frame = frame[~frame['id'].isin(seen)].reset_index(drop=True)
+                seen.update(frame['id'])
+                if self.progress is not None:
+                    self.progress(i, len(shards))
+                yield frame
+
+    def query_sharded(self, max_records: int = MAX_RECORDS)->pd.DataFrame:
+        #queries every shard concurrently and concatenates the results
+        self.df = self.combine(list(self.iter_sharded(max_records)))
+        return self.df
+
+    def combine(self, frames: list[pd.DataFrame])->pd.DataFrame:
+        #concatenates shard frames in the order the request asked for
+        if not frames:
+            return empty_frame()
+        df = pd.concat(frames, ignore_index=True)
+        if self.params.orderby in ('time', 'time-asc'):
+            df = df.sort_values('time', ascending=(self.params.orderby == 'time-asc'), ignore_index=True)
+        #a limit below MAX_RECORDS caps the whole request, the default one does not since sharding exists to exceed it
+        start = self.params.offset - 1
+        end = start + self.params.limit if self.params.limit < MAX_RECORDS else None
+        if start or end is not None:
+            df = df.iloc[start:end].reset_index(drop=True)
+        return df
+
+    def stream(self, store: 'CatalogStore', max_records: int = MAX_RECORDS)->Iterator[pd.DataFrame]:
+        #sync, yielding the events in batches as they arrive so the first ones can be shown early
+        #a store that already holds these filters is synced and yielded as one batch
+        #otherwise every shard is yielded, most recent first, and the store is replaced once all have arrived
+        if store.covers(self.url, self.params):
+            yield self.sync(store)
+            return
+        frames = []
+        for frame in self.iter_sharded(max_records):
+            frames.append(frame)
+            yield frame
+        self.df = store.replace(self.combine(frames), self.url, self.params,
+                                datetime.strftime(self.window()[1], DT_FORMAT))
+
+    def derive(self, params: RequestParams)->'DataLoader':
+        #a loader for params sharing the url, session, workers and progress of this one
+        return DataLoader(params, url=self.url, session=self.session, max_workers=self.max_workers,
+                          progress=self.progress)
+
+    def sync(self, store: 'CatalogStore')->pd.DataFrame:
+        #brings store up to date with the request window and returns the events in it
+        #a store that already holds these filters only asks for events updated after its high-water mark
+        #and upserts them by id, otherwise the whole window is fetched and replaces the store
+        #the part of the window after the end the store was synced for is always fetched in full,
+        #its events may have been updated before the high-water mark
+        start, end = self.window()
+        start_ms = int(start.replace(tzinfo=timezone.utc).timestamp() * 1000)
+        end_ms = int(end.replace(tzinfo=timezone.utc).timestamp() * 1000)
+        endtime = datetime.strftime(end, DT_FORMAT)
+        if not store.covers(self.url, self.params):
+            self.df = store.replace(self.query_sharded(), self.url, self.params, endtime)
         else:
-            self.gdf = gpd.read_file(StringIO(self.response.text))
-            return self.gdf
+            #the api compares whole seconds, so events updated in the high-water second are fetched again
+            mark = datetime.fromtimestamp(store.high_water_mark // 1000, timezone.utc)
+            frames = []
+            synced = start if store.endtime is None else max(start, datetime.strptime(store.endtime, DT_FORMAT))
+            if synced < end:
+                frames.append(self.derive(self.window_params(synced, end)).query_sharded())
+            delta = self.derive(replace(self.params, updatedafter=datetime.strftime(mark, DT_FORMAT)))
+            frames.append(delta.query_sharded())
+            self.df = store.upsert(pd.concat(frames, ignore_index=True), self.url, self.params, start_ms, endtime)
+
+        #a store synced for a later endtime may hold events past this window
+        self.df = self.df[self.df['time'] <= end_ms].reset_index(drop=True)
+        return self.df
     
-    def preprocess(self):
-        self.gdf['lon'] = self.gdf.geometry.x
-        self.gdf['lat'] = self.gdf.geometry.y
-        self.gdf['depth'] = self.gdf.geometry.z
-        self.gdf.rename({'magnitude': 'mag', 'significance': 'sig'}, inplace=True)
-        self.gdf['sig'] = self.gdf['sig'].astype(int)
-        self.gdf['time'] = pd.to_datetime(self.gdf['time'], unit = 'ms', utc = True)
-        self.gdf['tsunami'] = self.gdf['tsunami'].astype(bool)
-        return self.gdf[COL_TYPES.keys()]
+    def save(self, path: str, format: str = 'parquet', partition_by_year: bool = False)->pd.DataFrame:
+        #preprocesses the loaded events and saves them with save_catalog, indexed by event id
+        df = self.preprocess().set_axis(pd.Index(self.df['id'], name='id'))
+        window = None
+        if self.params.starttime is not None and self.params.endtime is not None:
+            window = (self.params.starttime, self.params.endtime)
+        save_catalog(df, path, format, partition_by_year, window)
+        return df
+
+    def geodataframe(self):
+        #the loaded events as a GeoDataFrame of points, geopandas is only needed for this
+        import geopandas as gpd
+        return gpd.GeoDataFrame(self.df,
+                                geometry=gpd.points_from_xy(self.df['lon'], self.df['lat'], self.df['depth']),
+                                crs='EPSG:4326')
 
+    def preprocess(self, df: Optional[pd.DataFrame] = None)->pd.DataFrame:
+        #builds the COL_TYPES frame expected by the visualizer from the raw columns in one pass
+        #columns parse_geojson already typed are passed through without copying, only time is converted from epoch ms
+        #df defaults to the loaded events, a batch from stream can be given instead
+        df = self.df if df is None else df
+        columns = {col: df[col].to_numpy(dtype=dtype, copy=False) for col, dtype in COL_TYPES.items() if col != 'time'}
+        columns['time'] = pd.to_datetime(df['time'].to_numpy(), unit='ms', utc=True)
+        return pd.DataFrame(columns, columns=list(COL_TYPES), copy=False)
@@ -1,12 +1,253 @@
+import re
+import json
+import inspect
+import threading
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import altair as alt
-from vega_datasets import data
-from DataLoader import COL_TYPES
+from DataLoader import COL_TYPES, load_catalog
+from Basemap import BASEMAP_OBJECT, basemap_file, basemap_url, basemap_geojson
+from SpatialIndex import unit_vectors
 from datetime import timedelta
+from typing import Optional
 alt.data_transformers.disable_max_rows()
+
+#above this many events the map draws hexagonal bins instead of one circle per event
+MAX_POINTS = 5000
+#above this many circles the auto renderer draws on a canvas, svg keeps a dom node per circle
+SVG_MAX_MARKS = 1000
+#ways a page can draw the chart, webgl draws the map with create_deck_spec and the rest on a canvas
+RENDERERS = ('auto', 'svg', 'canvas', 'webgl')
+#magma colour scheme stops for the webgl map, which is coloured on the server
+MAGMA = ['#000004', '#180f3d', '#440f76', '#721f81', '#9e2f7f', '#cd4071', '#f1605d', '#fd9668', '#feca8d', '#fcfdbf']
+#tooltip of the webgl map, with the fields of the create_chart tooltip
+DECK_TOOLTIP = {'html': '<b>Location:</b> {place}<br/><b>Magnitude:</b> {mag}<br/>'
+                        '<b>Depth (km):</b> {depth}<br/><b>Time:</b> {time}'}
+#hexagon radius in degrees at projection scale 100, bins shrink as the map is zoomed in
+BIN_SIZE = 2.0
+#decimal places kept for float columns embedded in a chart spec
+PRECISION = 3
+#names of the top-level datasets the sub-charts of create_chart refer to
+EVENTS = 'events'
+BINS = 'bins'
+#name of the brush of the map, each filter histogram has a brush named after its column, e.g. 'mag_brush'
+BRUSH = 'brush'
+#most bars drawn by each filter histogram
+MAX_BINS = 30
+#most bins along each numeric axis of the heatmap
+HEATMAP_BINS = 10
+#reductions the heatmap can compute on the server
+AGGREGATES = ('max', 'mean', 'count', 'sum')
+#heatmap grids kept for redrawing unchanged heatmaps, least recently used dropped first
+MAX_HEATMAPS = 32
+#chart specs kept by create_spec, least recently used dropped first
+MAX_SPECS = 16
+#basemap and graticule layers kept by create_map, least recently used dropped first
+MAX_BASEMAPS = 16
+#create_chart arguments that only move the map, a spec differing in these is patched instead of rebuilt
+PROJECTION_ARGS = ('projection', 'phi', 'theta', 'scale')
+#vega params holding the map projection, named by the create_chart argument they start from,
+#each bound to the html input with the given id, setting those inputs moves the map in the browser
+PROJECTION_PARAMS = {'projection': 'projection_type', 'phi': 'projection_phi',
+                     'theta': 'projection_theta', 'scale': 'projection_scale'}
+PROJECTION_INPUTS = {'projection': 'projection_input', 'phi': 'phi_input',
+                     'theta': 'theta_input', 'scale': 'scale_input'}
+
+class LRU:
+    #a mapping shared by threads that keeps its size most recently used entries
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def values(self) -> list:
+        #the values, most recently used last
+        with self.lock:
+            return list(self.entries.values())
+
+HEATMAPS = LRU(MAX_HEATMAPS)
+SPECS = LRU(MAX_SPECS)
+BASEMAPS = LRU(MAX_BASEMAPS)
+
+def compact_records(df: pd.DataFrame, columns: list[str], precision: int = PRECISION) -> list[dict]:
+    #the given columns of df as json records for a vega-lite dataset
+    #times become epoch ms, which vega parses as dates, floats are rounded and missing values become null
+    out = {}
+    for col in columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.DatetimeTZDtype):
+            values = (values - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+        elif pd.api.types.is_float_dtype(values):
+            values = values.round(precision)
+        out[col] = values.to_numpy()
+    compact = pd.DataFrame(out)
+    return compact.astype(object).where(compact.notna(), None).to_dict('records')
+
+def encoded_field(shorthand: str) -> str:
+    #the column named by an encoding shorthand, 'max(mag)' -> 'mag', 'time:T' -> 'time', 'count()' -> ''
+    match = re.search(r'\((\w*)\)', shorthand)
+    return match[1] if match else shorthand.split(':')[0]
+
+def hex_bins(df: pd.DataFrame, size: float, ranges: tuple = ()) -> pd.DataFrame:
+    #aggregates events into pointy-top hexagons of radius size degrees of lon/lat
+    #each bin is placed at the mean position of its events, so a bin of one event sits on it
+    #the other columns hold a representative value, the largest event of the bin gives place and mag
+    #the columns in ranges also get the smallest and largest value of the bin, as col_min and col_max
+    q = (np.sqrt(3) / 3 * df['lon'].to_numpy() - df['lat'].to_numpy() / 3) / size
+    r = (2 / 3 * df['lat'].to_numpy()) / size
+    #round the fractional axial coordinates to the nearest hexagon in cube coordinates
+    x, z = q, r
+    y = -x - z
+    rx, ry, rz = np.round(x), np.round(y), np.round(z)
+    dx, dy, dz = np.abs(rx - x), np.abs(ry - y), np.abs(rz - z)
+    fix_x = (dx > dy) & (dx > dz)
+    fix_z = ~fix_x & ~(dy > dz)
+    rx = np.where(fix_x, -ry - rz, rx)
+    rz = np.where(fix_z, -rx - ry, rz)
+    codes, _ = pd.factorize(rx.astype(np.int64) * (1 << 32) + rz.astype(np.int64))
+
+    groups = df.groupby(codes, sort=False)
+    bins = groups.agg(count=('mag', 'size'),
+                      lon=('lon', 'mean'),
+                      lat=('lat', 'mean'),
+                      mag=('mag', 'max'),
+                      sig=('sig', 'max'),
+                      depth=('depth', 'mean'),
+                      time=('time', 'max'),
+                      cdi=('cdi', 'max'),
+                      tsunami=('tsunami', 'any'),
+                      **{col + suffix: (col, agg) for col in ranges for suffix, agg in (('_min', 'min'), ('_max', 'max'))})
+    largest = df['mag'].fillna(-np.inf).groupby(codes, sort=False).idxmax()
+    bins['place'] = df.loc[largest.to_numpy(), 'place'].to_numpy()
+    return bins.reset_index(drop=True)
+
+def event_bins(df: pd.DataFrame, ranges: tuple = ()) -> pd.DataFrame:
+    #the events as hex_bins of one event each, for drawing them alongside bins
+    bins = df[['lon', 'lat', 'mag', 'sig', 'depth', 'time', 'cdi', 'tsunami', 'place']].reset_index(drop=True)
+    bins.insert(0, 'count', 1)
+    for col in ranges:
+        bins[col + '_min'] = bins[col + '_max'] = df[col].to_numpy()
+    return bins
+
+def brush_names(filter_vars: list[str]) -> list[str]:
+    #the params of create_chart holding the brushes, a page observing them can apply them on the server
+    return [BRUSH, *[var + '_brush' for var in filter_vars]]
+
+def brush_ranges(signals: Optional[dict]) -> dict:
+    #{column: (low, high)} of the active brushes in the observed values of the brush_names params
+    #an interval brush holds {column: [low, high]} and {} when cleared, times become epoch ms
+    ranges = {}
+    for value in (signals or {}).values():
+        for field, bounds in (value or {}).items() if isinstance(value, dict) else ():
+            if not isinstance(bounds, list) or len(bounds) != 2:
+                continue
+            if field == 'time':
+                bounds = [pd.Timestamp(bound, unit='ms', tz='UTC') if isinstance(bound, (int, float))
+                          else pd.Timestamp(bound) for bound in bounds]
+                bounds = [(bound.tz_localize('UTC') if bound.tz is None else bound).value // 10**6 for bound in bounds]
+            ranges[field] = (min(bounds), max(bounds))
+    return ranges
+
+def heatmap_aggregate(color_var: str) -> tuple[str, str]:
+    #the reduction and column of a heatmap colour, 'max(mag)' -> ('max', 'mag'), a bare column is averaged
+    if '(' not in color_var:
+        return 'mean', encoded_field(color_var)
+    agg = color_var.split('(')[0]
+    if agg not in AGGREGATES:
+        raise ValueError(f"Heatmap aggregate must be one of {AGGREGATES} not '{agg}'")
+    return agg, encoded_field(color_var)
+
+def nice_step(span: float, max_bins: int) -> float:
+    #smallest bin width of 1, 2 or 5 times a power of ten that covers span in at most max_bins bins
+    if not span > 0:
+        return 1.0
+    base = 10.0 ** np.floor(np.log10(span / max_bins))
+    for multiple in (1, 2, 5, 10):
+        if span / (base * multiple) <= max_bins:
+            return base * multiple
+
+def bin_index(values: np.ndarray, step: Optional[float] = None, max_bins: int = MAX_BINS) -> tuple[np.ndarray, float, float]:
+    #bin of each value for bins of width step aligned to multiples of step, and the first bin start and step
+    low, high = values.min(), values.max()
+    step = step or nice_step(high - low, max_bins)
+    start = np.floor(low / step) * step
+    return ((values - start) // step).astype(np.int64), start, step
+
+def histogram(name: str, values: np.ndarray, mags: np.ndarray, step: Optional[float] = None, max_bins: int = MAX_BINS) -> pd.DataFrame:
+    #counts of values in bins of width step, aligned to multiples of step, with the largest mag of each bin
+    #bins start at column name and end at name + '_end', missing values and empty bins are left out
+    keep = ~np.isnan(values)
+    values, mags = values[keep], mags[keep]
+    if not len(values):
+        return pd.DataFrame({name: [], name + '_end': [], 'count': [], 'max_mag': []})
+    index, start, step = bin_index(values, step, max_bins)
+    n = int(index.max()) + 1
+    counts = np.bincount(index, minlength=n)
+    max_mag = np.full(n, -np.inf)
+    np.fmax.at(max_mag, index, mags)
+    edges = start + step * np.arange(n + 1)
+    filled = counts > 0
+    return pd.DataFrame({name: edges[:-1][filled],
+                         name + '_end': edges[1:][filled],
+                         'count': counts[filled],
+                         'max_mag': np.where(np.isinf(max_mag), np.nan, max_mag)[filled]})
+
+def aggregate_grid(x: np.ndarray, y: np.ndarray, values: Optional[np.ndarray], agg: str,
+                   x_step: Optional[float] = None, y_step: Optional[float] = None, max_bins: int = HEATMAP_BINS) -> pd.DataFrame:
+    #agg of values over the 2-d bins of x and y, one row per cell holding events
+    #cells span [x, x_end) and [y, y_end), events missing x or y are left out and count ignores values
+    if agg not in AGGREGATES:
+        raise ValueError(f"Heatmap aggregate must be one of {AGGREGATES} not '{agg}'")
+    keep = ~np.isnan(x) & ~np.isnan(y)
+    x, y = x[keep], y[keep]
+    if not len(x):
+        return pd.DataFrame({'x': [], 'x_end': [], 'y': [], 'y_end': [], 'value': []})
+    ix, x_start, x_step = bin_index(x, x_step, max_bins)
+    iy, y_start, y_step = bin_index(y, y_step, max_bins)
+    if agg == 'count':
+        cells = pd.Series(ix).groupby([ix, iy]).size()
+    else:
+        cells = pd.Series(values[keep]).groupby([ix, iy]).agg(agg)
+    ix, iy = cells.index.get_level_values(0).to_numpy(), cells.index.get_level_values(1).to_numpy()
+    return pd.DataFrame({'x': x_start + x_step * ix,
+                         'x_end': x_start + x_step * (ix + 1),
+                         'y': y_start + y_step * iy,
+                         'y_end': y_start + y_step * (iy + 1),
+                         'value': cells.to_numpy(dtype=float)})
+
+def spec_key(version, args: dict) -> str:
+    #canonical form of a dataset version and create_chart arguments, 6 and 6.0 compare equal
+    fields = {name: float(value) if isinstance(value, int) and not isinstance(value, bool) else value
+              for name, value in args.items()}
+    return json.dumps([version, fields], sort_keys=True, default=str)
+
+def patch_projection(spec: dict, projection: str, phi: float, theta: float, scale: float) -> dict:
+    #a copy of spec whose projection params start at the given type, rotation and scale
+    #only the params are copied, everything else, the datasets included, is shared with spec
+    values = {PROJECTION_PARAMS[arg]: value for arg, value in
+              zip(('projection', 'phi', 'theta', 'scale'), (projection, phi, theta, scale))}
+    params = [{**param, 'value': values[param['name']]} if param.get('name') in values else param
+              for param in spec.get('params', [])]
+    return {**spec, 'params': params}
+
 class DataVisualizer:
-    def __init__(self, df: pd.DataFrame):
+    def __init__(self, df: pd.DataFrame, version=None):
         assert isinstance(df, pd.DataFrame), "Input must be a pandas DataFrame"
         assert not df.empty, "Input DataFrame must not be empty"
         for col in COL_TYPES.keys():
@@ -17,8 +258,58 @@ class DataVisualizer:
             assert df[col].dtype == expected_type, f"Column '{col}' must be of type {expected_type}"
         #set internal dataframe
         self.df = df
-
-    def create_heatmap(self, filters, width, height, x_var='time', y_var='depth', color_var='max(mag)'):
+        #identifies the rows of df in cache keys, e.g. a dataset id and filter, hashed from df if not given
+        self._version = version
+
+    @property
+    def version(self):
+        if self._version is None:
+            numeric = self.df[['time', 'lat', 'lon', 'mag', 'sig', 'depth']]
+            self._version = (len(self.df), int(pd.util.hash_pandas_object(numeric, index=False).sum()))
+        return self._version
+
+    @classmethod
+    def from_file(cls, path: str):
+        #builds a visualizer from a parquet or arrow catalog written by DataLoader.save
+        return cls(load_catalog(path, columns=list(COL_TYPES)))
+
+    def heatmap_grid(self, x_var='time', y_var='depth', color_var='max(mag)', max_bins=HEATMAP_BINS,
+                     ranges: Optional[dict] = None) -> pd.DataFrame:
+        #aggregate_grid of the events, binned like create_heatmap bins them in the browser
+        #ranges optionally keeps only the events inside the brush_ranges of the chart, the cells stay those of all events
+        #grids are cached per version, so redrawing with unchanged heatmap settings reuses them
+        key = (self.version, x_var, y_var, color_var, max_bins, tuple(sorted((ranges or {}).items())))
+        grid = HEATMAPS.get(key)
+        if grid is not None:
+            return grid
+        agg, field = heatmap_aggregate(color_var)
+        ranges = {var: bounds for var, bounds in (ranges or {}).items() if var in self.df.columns}
+        values = {}
+        for var in filter(None, (x_var, y_var, field, *ranges)):
+            if var == 'time':
+                values[var] = ((self.df['time'] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)).to_numpy(dtype=float)
+            else:
+                values[var] = self.df[var].to_numpy(dtype=float)
+        day = 24*60*60*1000
+        n_days = int((self.df['time'].max() - self.df['time'].min()) / timedelta(days=1))
+        def step(var, time_step):
+            #the steps of all events, so the cells do not move as the brushes change
+            if var == 'time':
+                return time_step
+            return nice_step(np.nanmax(values[var]) - np.nanmin(values[var]), max_bins)
+        keep = np.ones(len(self.df), dtype=bool)
+        for var, (low, high) in ranges.items():
+            keep &= (values[var] >= low) & (values[var] <= high)
+        grid = aggregate_grid(values[x_var][keep], values[y_var][keep], values[field][keep] if field else None, agg,
+                              step(x_var, max(int(n_days/12), 1) * day), step(y_var, 365 * day), max_bins)
+        HEATMAPS.put(key, grid)
+        return grid
+
+    def create_heatmap(self, filters, width, height, x_var='time', y_var='depth', color_var='max(mag)', data=None, aggregate=False,
+                       ranges=None):
+        #with aggregate the grid comes from heatmap_grid instead of being binned in the browser
+        #the precomputed cells hold no events for the brushes in filters to act on, the brushes are applied
+        #on the server from ranges instead, see create_heatmap_spec
         day = 24*60*60*1000
         time_range = self.df['time'].max() - self.df['time'].min()
         format = '%Y'
@@ -32,45 +323,65 @@ class DataVisualizer:
 
         n_days = int(time_range / timedelta(days=1))
         step = int(n_days/12) * day
+        x_field, y_field = ('x', 'y') if aggregate else (x_var, y_var)
         if x_var == 'time':
-            X = alt.X('time:T',
+            X = alt.X(x_field + ':T',
                       axis = alt.Axis(format = format),
-                      bin = alt.BinParams(step = step),
+                      bin = 'binned' if aggregate else alt.BinParams(step = step),
                       title = 'Date')
-            X_tooltip = alt.Tooltip(tool_tip, title='Time')
+            X_tooltip = alt.Tooltip(x_field + ':T', title='Time', format = format) if aggregate else alt.Tooltip(tool_tip, title='Time')
         else:
-            X = alt.X(x_var+':Q',
+            X = alt.X(x_field+':Q',
                       axis = alt.Axis(),
-                      bin = alt.BinParams(),
+                      bin = 'binned' if aggregate else alt.BinParams(),
                       title = x_var.capitalize())
-            X_tooltip = alt.Tooltip(x_var+':Q', title=x_var.capitalize())
+            X_tooltip = alt.Tooltip(x_field+':Q', title=x_var.capitalize())
 
         reversed_y = (y_var == 'depth')
         if y_var == 'time':
-            Y = alt.Y('time:T',
+            Y = alt.Y(y_field + ':T',
                       axis = alt.Axis(format = '%Y'),
-                      bin = alt.BinParams(step = 365 * day),
+                      bin = 'binned' if aggregate else alt.BinParams(step = 365 * day),
                       title = 'Date')
-            Y_tooltip = alt.Tooltip('year(time):T', title='Time')
+            Y_tooltip = alt.Tooltip(y_field + ':T', title='Time', format = '%Y') if aggregate else alt.Tooltip('year(time):T', title='Time')
         else:
-            Y = alt.Y(y_var+':Q',
+            Y = alt.Y(y_field+':Q',
                       axis = alt.Axis(),
                       scale = alt.Scale(reverse = reversed_y),
-                      bin = alt.BinParams(),
+                      bin = 'binned' if aggregate else alt.BinParams(),
                       title = y_var.capitalize())
-            Y_tooltip = alt.Tooltip(y_var+':Q', title=y_var.capitalize())
-
-        Color = alt.Color(color_var,
+            Y_tooltip = alt.Tooltip(y_field+':Q', title=y_var.capitalize())
+
+        if aggregate:
+            grid = self.heatmap_grid(x_var, y_var, color_var, ranges=ranges)
+            chart = alt.Chart(alt.Data(values=compact_records(grid, list(grid.columns)))).mark_rect().encode(
+                x = X,
+                x2 = alt.X2('x_end'),
+                y = Y,
+                y2 = alt.Y2('y_end'),
+                color = alt.Color('value:Q', scale = alt.Scale(scheme = 'magma'), title = color_var),
+                tooltip = [X_tooltip,
+                           Y_tooltip,
+                           alt.Tooltip('value:Q', title = color_var.capitalize())]
+            ).properties(
+                width=width,
+                height=height,
+            )
+            return chart
+
+        #named data carries no dtypes for altair to infer the type from
+        color_type = '' if ':' in color_var else ':Q'
+        Color = alt.Color(color_var + color_type,
                           scale = alt.Scale(scheme = 'magma'))
 
 
-        chart = alt.Chart(self.df).mark_rect().encode(
+        chart = alt.Chart(self.df if data is None else data).mark_rect().encode(
             x = X,
             y = Y,
             color = Color,
             tooltip = [X_tooltip,
                        Y_tooltip,
-                       alt.Tooltip(color_var, title = color_var.capitalize())]
+                       alt.Tooltip(color_var + color_type, title = color_var.capitalize())]
         ).transform_filter(
             *filters
         ).properties(
@@ -79,45 +390,46 @@ class DataVisualizer:
         )
         return chart
 
-    def create_hists_selectors(self, filter_vars, filter_width, filter_height, color_scheme='magma'):
+    def create_hists_selectors(self, filter_vars, filter_width, filter_height, color_scheme='magma', max_bins=MAX_BINS):
+        #the bins are counted here and each histogram draws its own small table
+        #the bin start column is named after the event column, so a brush filters the events on it
         hists = {}
         selectors = {}
         for var in filter_vars:
 
-            selectors[var] = alt.selection_interval(name = var + '_brush')
+            selectors[var] = alt.selection_interval(name = var + '_brush', encodings = ['x'])
             if var == 'time':
                 day = 24*60*60*1000
                 time_range = self.df['time'].max() - self.df['time'].min()
                 format = '%Y'
-                tool_tip = 'year(time):T'
                 if time_range < timedelta(days = 1000):
                     format = '%Y-%m'
-                    tool_tip = 'yearmonth(time)'
                 elif time_range < timedelta(days = 100):
                     format = '%Y-%m-%d'
-                    tool_tip = 'yearmonthday(time)'
 
                 n_days = int(time_range / timedelta(days=1))
-                step = int(n_days/12) * day
+                step = max(int(n_days/12), 1) * day
+                values = (self.df['time'] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
                 x = alt.X('time:T',
                         axis = alt.Axis(format = format),
-                        bin = alt.BinParams(step = step),
+                        bin = 'binned',
                         title = 'Date')
-                    
-                type = ':T'
 
             else:
-                type = ':Q'
-                x = alt.X(var + type, bin=alt.Bin(maxbins=30), title = None)
+                values = self.df[var]
+                step = None
+                x = alt.X(var + ':Q', bin='binned', title = None)
 
-            hists[var] = alt.Chart(self.df).mark_bar().encode(
+            table = histogram(var, values.to_numpy(dtype=float), self.df['mag'].to_numpy(), step, max_bins)
+            hists[var] = alt.Chart(alt.Data(values=compact_records(table, list(table.columns)))).mark_bar().encode(
                 x = x,
-                y = alt.Y('count()', title = var[:4]),
+                x2 = alt.X2(var + '_end'),
+                y = alt.Y('count:Q', title = var[:4]),
                 color = alt.condition(selectors[var],
-                                    alt.Color('mag:Q',
-                                            scale = alt.Scale(scheme = color_scheme)),
+                                    alt.Color('max_mag:Q',
+                                            scale = alt.Scale(scheme = color_scheme),
+                                            title = 'mag'),
                                     alt.value('lightgrey')),
-                order = alt.Order(var+type, sort='ascending')
                 ).properties(
                     width = filter_width,
                     height = filter_height,
@@ -131,8 +443,16 @@ class DataVisualizer:
                    map_stroke: str = 'blue', 
                    map_width: int = 800, 
                    map_height: int = 600, 
-                   Projection = alt.Projection(type = 'equalEarth')):
-        topo = alt.topo_feature(data.world_110m.url, 'countries')
+                   Projection = alt.Projection(type = 'equalEarth'),
+                   scale: float = 100):
+        #the countries come from the basemap bundled in assets/ with the detail suited to scale
+        #the layers are built once per style, size and projection, callers must not change them in place
+        name = basemap_file(scale)
+        key = (map_fill, map_stroke, map_width, map_height, Projection.to_json(), name)
+        earth = BASEMAPS.get(key)
+        if earth is not None:
+            return earth
+        topo = alt.topo_feature(basemap_url(name), BASEMAP_OBJECT)
         earth = alt.Chart(topo).mark_geoshape(
             fill = map_fill,
             stroke = map_stroke
@@ -146,16 +466,143 @@ class DataVisualizer:
         graticule = alt.Chart(alt.graticule()).mark_geoshape().properties(projection = Projection)
 
         earth += graticule
+        BASEMAPS.put(key, earth)
         return earth
 
-    def create_chart(self, width=1200, height=800,
+    def renderer(self, mode: str = 'auto', max_points: int = MAX_POINTS) -> str:
+        #the vega renderer for mode, or 'webgl', auto picks canvas when the map draws many circles
+        assert mode in RENDERERS, f"Renderer must be one of {RENDERERS}"
+        if mode != 'auto':
+            return mode
+        return 'canvas' if min(len(self.df), max_points) > SVG_MAX_MARKS else 'svg'
+
+    def binned(self, max_points: int = MAX_POINTS) -> bool:
+        #True if create_chart draws hex_bins and a server heatmap_grid instead of the events
+        return len(self.df) > max_points
+
+    def create_deck_spec(self, color_var='sig', size_var='mag', size_range=[10, 200],
+                         phi=0, theta=0, scale=100, precision=PRECISION) -> dict:
+        #a deck.gl json spec drawing every event as a webgl ScatterplotLayer over the bundled countries
+        #colours and sizes follow create_chart, size_range is the circle area in square pixels
+        def unit(values):
+            values = values.to_numpy(dtype=float)
+            low, high = np.nanmin(values), np.nanmax(values)
+            return (values - low) / (high - low) if high > low else np.zeros(len(values))
+        def as_number(col):
+            return (self.df[col] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1) if col == 'time' else self.df[col]
+        stops = np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)] for c in MAGMA], dtype=float)
+        t = unit(as_number(color_var))
+        positions = np.linspace(0, 1, len(MAGMA))
+        rgb = np.stack([np.interp(t, positions, stops[:, i]) for i in range(3)], axis=1)
+        rgb[np.isnan(t)] = 211
+        points = pd.DataFrame({
+            'lon': self.df['lon'].to_numpy(),
+            'lat': self.df['lat'].to_numpy(),
+            'place': self.df['place'].to_numpy(),
+            'mag': self.df['mag'].to_numpy(),
+            'depth': self.df['depth'].to_numpy(),
+            'time': self.df['time'].dt.strftime('%Y-%m-%d %H:%M:%S UTC').to_numpy(),
+            'radius': np.sqrt(np.interp(np.nan_to_num(unit(as_number(size_var))), [0, 1], size_range) / np.pi),
+        })
+        records = compact_records(points, list(points.columns), precision)
+        for record, color in zip(records, rgb.astype(int).tolist()):
+            record['color'] = color
+        return {
+            #a web mercator world is 512 pixels wide at zoom 0 and 2 pi scale pixels wide in vega
+            'initialViewState': {'longitude': -phi, 'latitude': -theta, 'zoom': float(np.log2(2 * np.pi * scale / 512))},
+            'views': [{'@@type': 'MapView', 'controller': True}],
+            'layers': [
+                {'@@type': 'GeoJsonLayer', 'id': 'countries', 'data': basemap_geojson(basemap_file(scale)),
+                 'filled': True, 'stroked': True, 'getFillColor': [169, 169, 169], 'getLineColor': [211, 211, 211],
+                 'lineWidthUnits': 'pixels'},
+                {'@@type': 'ScatterplotLayer', 'id': 'events', 'data': records,
+                 'getPosition': '@@=[lon, lat]', 'getFillColor': '@@=color', 'getRadius': '@@=radius',
+                 'radiusUnits': 'pixels', 'opacity': 0.8, 'pickable': True},
+            ],
+        }
+
+    def bin_events(self, scale: float = 100, max_points: int = MAX_POINTS, bin_size: float = BIN_SIZE,
+                   center: Optional[tuple[float, float]] = None, radius: Optional[float] = None, ranges: tuple = ()) -> pd.DataFrame:
+        #hex_bins of the events for a map at projection scale, at most max_points bins
+        #bins shrink in proportion to the zoom and are coarsened until they fit in max_points
+        #a map zoomed in on the radius degrees around its (lon, lat) center draws the events there as they are,
+        #once they fit in half of max_points, and bins only the events outside the view
+        df = self.df
+        events = event_bins(df.iloc[:0], ranges)
+        if center is not None and radius is not None and radius < 180:
+            distance = unit_vectors(df['lat'].to_numpy(dtype=float), df['lon'].to_numpy(dtype=float)) \
+                @ unit_vectors(np.array(center[1], dtype=float), np.array(center[0], dtype=float))
+            inside = distance >= np.cos(np.radians(radius))
+            if inside.sum() <= max_points // 2:
+                events = event_bins(df[inside], ranges)
+                df = df[~inside]
+        if df.empty:
+            return events
+        size = bin_size * 100 / scale
+        bins = hex_bins(df, size, ranges)
+        while len(bins) > max_points - len(events):
+            size *= 2
+            bins = hex_bins(df, size, ranges)
+        return pd.concat([events, bins], ignore_index=True) if len(events) else bins
+
+    def create_chart(self, **kwargs):
+        #the chart of build_chart with its datasets attached, altair validates every embedded record
+        chart, datasets = self.build_chart(**kwargs)
+        return chart.properties(datasets = datasets)
+
+    def create_spec(self, **kwargs) -> dict:
+        #the vega-lite spec of create_chart, the datasets are added after altair has validated the
+        #chart since checking each record against the schema costs more than building the spec
+        #specs are cached per version and arguments, a spec differing from a cached one only in its
+        #projection is patched from it, so rotating or zooming the map does not rebuild the chart
+        args = inspect.signature(type(self).build_chart).bind(self, **kwargs)
+        args.apply_defaults()
+        args = {name: value for name, value in args.arguments.items() if name != 'self'}
+        #a binned map is binned for its scale and draws the events in view as they are, so zooming and rotating it
+        #needs new bins
+        binned = self.binned(args['max_points']) and args['draw_map']
+        moves = [name for name in PROJECTION_ARGS if not binned or name == 'projection']
+        key = spec_key(self.version, args)
+        #zooming far enough also switches the basemap detail
+        base = spec_key(self.version, {**{name: value for name, value in args.items() if name not in moves},
+                                       'basemap': basemap_file(args['scale'])})
+        cached = SPECS.get(key)
+        if cached is not None:
+            return cached[1]
+        similar = next((spec for spec_base, spec in reversed(SPECS.values()) if spec_base == base), None)
+        if similar is not None:
+            spec = patch_projection(similar, args['projection'], args['phi'], args['theta'], args['scale'])
+        else:
+            chart, datasets = self.build_chart(**args)
+            spec = chart.to_dict()
+            spec.setdefault('datasets', {}).update(datasets)
+        SPECS.put(key, (base, spec))
+        return spec
+
+    def create_heatmap_spec(self, width=1200, height=800, heatmap_x='time', heatmap_y='depth', heatmap_color='max(mag)',
+                            background='darkgrey', ranges=None) -> dict:
+        #the heatmap_grid of a binned chart as a spec of its own, sized like the heatmap create_chart leaves out
+        #with heatmap=False, a page redraws it with the brush_ranges of the chart without redrawing the chart
+        width *= .75
+        height *= .8
+        heatmap = self.create_heatmap([], width - int(.6 * width), height, heatmap_x, heatmap_y, heatmap_color,
+                                      aggregate=True, ranges=ranges)
+        return heatmap.properties(background = background).to_dict()
+
+    def build_chart(self, width=1200, height=800,
                      projection ='equalEarth', phi = 0, theta = 0, scale = 100,
                      map_fill = 'darkgrey', map_stroke = 'lightgrey', background = 'darkgrey',
                      color_var = 'sig', color_scheme = 'magma',
                      opacity_var = 'mag',
                      size_var = 'mag', size_range = [10, 200],
                      filter_vars = ['time', 'mag', 'sig', 'depth', 'lon', 'lat'],
-                     heatmap_x = 'time', heatmap_y = 'depth', heatmap_color = 'max(mag)'):
+                     heatmap_x = 'time', heatmap_y = 'depth', heatmap_color = 'max(mag)',
+                     max_points = MAX_POINTS, bin_size = BIN_SIZE, precision = PRECISION,
+                     draw_map = True, heatmap = True):
+        #returns the chart and the datasets it refers to by name
+        #the events are held once as EVENTS, with only the columns the encodings use
+        #without draw_map the map is left out, for pages drawing it with create_deck_spec
+        #without heatmap the heatmap is left out, for pages drawing it with create_heatmap_spec
         width *= .75
         height *= .8
         map_width = int(.6 * width)
@@ -167,10 +614,15 @@ class DataVisualizer:
         heatmap_width = width - map_width
         heatmap_height = height
 
-        rotation = [phi, theta, 0]
-        Projection = alt.Projection(type = projection,
-                                    rotate=rotation,
-                                    scale = scale,
+        #the projection reads its params, so the page can rotate and zoom the map without a new spec
+        #values set through the bound inputs arrive as strings
+        type_param, phi_param, theta_param, scale_param = PROJECTION_PARAMS.values()
+        projection_params = [alt.param(name = PROJECTION_PARAMS[arg], value = value,
+                                       bind = alt.BindDirect(element = '#' + PROJECTION_INPUTS[arg]))
+                             for arg, value in [('projection', projection), ('phi', phi), ('theta', theta), ('scale', scale)]]
+        Projection = alt.Projection(type = alt.ExprRef(expr = type_param),
+                                    rotate = alt.ExprRef(expr = f'[toNumber({phi_param}), toNumber({theta_param}), 0]'),
+                                    scale = alt.ExprRef(expr = f'toNumber({scale_param})'),
                                     translate = [map_width/2, map_height/2])
 
         if color_var == 'time':
@@ -202,10 +654,40 @@ class DataVisualizer:
 
         hists, selectors = self.create_hists_selectors(filter_vars, filter_width, filter_height, color_scheme=color_scheme)
 
-        earth = self.create_map(map_fill, map_stroke, map_width, map_height, Projection)
-
-        brush = alt.selection_interval(name = "brush")
-        quakes = alt.Chart(self.df).mark_circle().encode(
+        earth = self.create_map(map_fill, map_stroke, map_width, map_height, Projection, scale)
+
+        brush = alt.selection_interval(name = BRUSH)
+        #columns read by the points layer, the hists and the heatmap
+        used = {'lon', 'lat', 'time', 'place', 'mag', 'depth', *filter_vars, heatmap_x, heatmap_y,
+                encoded_field(heatmap_color), encoded_field(color_var), encoded_field(size_var), encoded_field(opacity_var)}
+        columns = [col for col in COL_TYPES if col in used]
+        binned = self.binned(max_points)
+        #binned maps aggregate the heatmap too, so nothing reads the events themselves
+        datasets = {} if binned else {EVENTS: compact_records(self.df, columns, precision)}
+        points = alt.NamedData(name=EVENTS)
+        Tooltip = [
+            alt.Tooltip('place:N', title='Location'),
+            alt.Tooltip('mag:Q', title='Magnitude'),
+            alt.Tooltip('depth:Q', title='Depth (km)'),
+            alt.Tooltip('time:T', title='Time')
+        ]
+        if binned and draw_map:
+            #large catalogs are drawn as bins sized by their number of events, a projection scale is about
+            #the pixels per radian at the centre of the map, which is at (-phi, -theta)
+            view = np.degrees(max(map_width, map_height) / 2 / scale)
+            bins = self.bin_events(scale, max_points, bin_size, center=(-phi, -theta), radius=view, ranges=tuple(filter_vars))
+            ranges = [col + suffix for col in filter_vars for suffix in ('_min', '_max')]
+            datasets[BINS] = compact_records(bins, [col for col in ['count', *columns, *ranges] if col in bins.columns], precision)
+            points = alt.NamedData(name=BINS)
+            Size = alt.Size('count:Q', scale=alt.Scale(type='sqrt', range=size_range), legend=alt.Legend(title='events'))
+            Tooltip = [
+                alt.Tooltip('count:Q', title='Events'),
+                alt.Tooltip('place:N', title='Largest event'),
+                alt.Tooltip('mag:Q', title='Max magnitude'),
+                alt.Tooltip('depth:Q', title='Mean depth (km)', format='.1f'),
+                alt.Tooltip('time:T', title='Latest')
+            ]
+        quakes = alt.Chart(points).mark_circle().encode(
             longitude = 'lon:Q',
             latitude = 'lat:Q',
             size = Size,
@@ -214,37 +696,47 @@ class DataVisualizer:
                                 Color,
                                 alt.value('lightgrey')),
             order = alt.Order('time:T', sort='ascending'),
-            tooltip = [
-                alt.Tooltip('place:N', title='Location'),
-                alt.Tooltip('mag:Q', title='Magnitude'),
-                alt.Tooltip('depth:Q', title='Depth (km)'),
-                alt.Tooltip('time:T', title='Time')
-            ]
+            tooltip = Tooltip
         ).properties(
             projection = Projection
         ).add_params(
             brush
-        ).transform_filter(
-            *selectors.values()
         )
+        if binned and draw_map:
+            #a bin is kept while the range of its events overlaps every histogram brush
+            for var in filter_vars:
+                selected = f'{var}_brush.{var}'
+                quakes = quakes.transform_filter(
+                    f'!isValid({selected}) || (datum.{var}_max >= extent({selected})[0] && datum.{var}_min <= extent({selected})[1])')
+        else:
+            quakes = quakes.transform_filter(*selectors.values())
 
         filters = [selector for selector in selectors.values()]
-        filters.append(brush)
-        heatmap = self.create_heatmap(filters = filters,
-                                 x_var = heatmap_x,
-                                 y_var = heatmap_y,
-                                 width = heatmap_width,
-                                 height = heatmap_height,
-                                 color_var = heatmap_color)
-
-        earth+=quakes
-
-        for hist in hists.values():
-            earth &= hist
-
-        earth |= heatmap
+        if draw_map:
+            filters.append(brush)
+        if draw_map:
+            #the basemap is shared through create_map, so the points are layered onto a copy
+            earth = earth + quakes
+
+            for hist in hists.values():
+                earth &= hist
+        else:
+            earth = alt.vconcat(*hists.values())
+            projection_params = []
+
+        if heatmap:
+            earth |= self.create_heatmap(filters = filters,
+                                         x_var = heatmap_x,
+                                         y_var = heatmap_y,
+                                         width = heatmap_width,
+                                         height = heatmap_height,
+                                         color_var = heatmap_color,
+                                         data = alt.NamedData(name=EVENTS),
+                                         aggregate = binned)
         earth = earth.resolve_scale(color='independent')
         earth = earth.properties(background = background)
-        return earth
+        if projection_params:
+            earth = earth.add_params(*projection_params)
+        return earth, datasets
 
 
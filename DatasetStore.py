@@ -0,0 +1,360 @@
+import os
+import re
+import time
+import uuid
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from DataLoader import COL_TYPES
+from MappedCatalog import MappedCatalog
+from SpatialIndex import SpatialIndex
+
+#default location of spilled datasets, relative to the working directory
+DATASET_DIR = os.path.join('.cache', 'datasets')
+#memory held by the frames kept in memory before least recently used ones are dropped
+DATASET_MAX_BYTES = 512 * 1024**2
+#seconds a spilled dataset is kept on disk after it was last written or read
+DATASET_MAX_AGE = 24 * 60 * 60
+#the part put writes, its modification time is moved on whenever the dataset is read
+FIRST_PART = 'part-00000.arrow'
+#filter masks kept per store, paging through one filtered table reuses its mask
+MAX_MASKS = 16
+
+#one clause of a dash_table filter_query, e.g. '{mag} s>= 5' or '{place} icontains "Alaska"'
+#the optional s/i prefix of the operator selects case sensitive or insensitive matching
+FILTER_CLAUSE = re.compile(r'^\{(?P<col>[^}]+)\}\s*(?P<case>[si]?)(?P<op>>=|<=|!=|>|<|=|eq|ne|ge|le|gt|lt|contains|datestartswith)\s*(?P<value>.*)$')
+FILTER_OPS = {'eq': '=', 'ne': '!=', 'ge': '>=', 'le': '<=', 'gt': '>', 'lt': '<'}
+
+
+def filter_columns(filter_query: Optional[str]) -> list[str]:
+    #the columns the clauses of a dash_table filter_query refer to
+    if not filter_query:
+        return []
+    matches = [FILTER_CLAUSE.match(clause.strip()) for clause in filter_query.split(' && ')]
+    return list(dict.fromkeys(match['col'] for match in matches if match is not None))
+
+
+def table_frame(table: pa.Table) -> pd.DataFrame:
+    #rows taken from a mapped dataset as the frame put registered, without the id column MappedCatalog.write keeps
+    df = table.select([col for col in table.column_names if col != 'id']).to_pandas()
+    return df.astype({col: dtype for col, dtype in COL_TYPES.items() if col in df.columns}, copy=False)
+
+
+def filter_mask(df: pd.DataFrame, filter_query: Optional[str]) -> Optional[np.ndarray]:
+    #evaluates a dash_table filter_query against df, returns None when nothing is filtered
+    #clauses joined by && must all hold, clauses that cannot be parsed are ignored
+    if not filter_query:
+        return None
+    mask = np.ones(len(df), dtype=bool)
+    for clause in filter_query.split(' && '):
+        match = FILTER_CLAUSE.match(clause.strip())
+        if match is None or match['col'] not in df.columns:
+            continue
+        col = df[match['col']]
+        op = FILTER_OPS.get(match['op'], match['op'])
+        value = match['value'].strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1]
+        try:
+            if op == 'contains':
+                mask &= col.astype(str).str.contains(value, case=match['case'] != 'i', regex=False).to_numpy()
+                continue
+            if op == 'datestartswith':
+                #times are compared in iso format, which separates the date from the time with a T
+                text = col.astype(str)
+                if isinstance(col.dtype, pd.DatetimeTZDtype):
+                    text, value = text.str.replace(' ', 'T', n=1), value.replace(' ', 'T', 1)
+                mask &= text.str.startswith(value).to_numpy()
+                continue
+            if isinstance(col.dtype, pd.DatetimeTZDtype):
+                value = pd.Timestamp(value)
+                value = value.tz_localize('UTC') if value.tz is None else value
+            elif pd.api.types.is_numeric_dtype(col):
+                value = float(value)
+            elif match['case'] == 'i':
+                col, value = col.str.lower(), value.lower()
+        except ValueError:
+            #a value of the wrong type for the column matches nothing
+            mask[:] = False
+            continue
+        if op == '=':
+            mask &= (col == value).to_numpy()
+        elif op == '!=':
+            mask &= (col != value).to_numpy()
+        elif op == '>=':
+            mask &= (col >= value).to_numpy()
+        elif op == '<=':
+            mask &= (col <= value).to_numpy()
+        elif op == '>':
+            mask &= (col > value).to_numpy()
+        elif op == '<':
+            mask &= (col < value).to_numpy()
+    return mask
+
+
+class DatasetStore:
+    #a server-side registry of loaded frames, the browser only holds the id returned by put
+    #frames are kept in memory up to max_bytes and dropped least recently used first
+    #every frame is also written to directory as a MappedCatalog, so other worker processes
+    #and ids dropped from memory are served from the mapped file
+    #frames are always served most recent event first
+    #sorting, filtering and paging only convert the columns and rows they need from the mapped tables
+    #a dataset can grow by append while it is served, a table whose directory changed since it was mapped is mapped again
+    def __init__(self, directory: str = DATASET_DIR, max_bytes: int = DATASET_MAX_BYTES, max_age: float = DATASET_MAX_AGE) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.frames = OrderedDict()
+        self.sizes = {}
+        #mapped table of each dataset and its row positions, most recent event first
+        self.tables = {}
+        #directory modification time of each table when it was mapped
+        self.stamps = {}
+        #ascending row order of each (dataset, column) sorted so far
+        self.sort_indexes = {}
+        self.spatial_indexes = {}
+        self.masks = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'loads': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, dataset_id: str) -> str:
+        return os.path.join(self.directory, dataset_id)
+
+    def put(self, df: pd.DataFrame) -> str:
+        #registers df and returns its id
+        dataset_id = uuid.uuid4().hex
+        os.makedirs(self.path(dataset_id))
+        table = MappedCatalog.write(df, os.path.join(self.path(dataset_id), FIRST_PART)).table
+        #served in the reverse of the order the file is written in, ties included
+        df = df.sort_values('time', kind='stable', ignore_index=True).iloc[::-1].reset_index(drop=True)
+        with self.lock:
+            self.tables[dataset_id] = table, np.arange(len(df))[::-1].copy()
+            self.stamps[dataset_id] = self.stamp(dataset_id)
+            self.keep(dataset_id, df)
+        self.prune()
+        return dataset_id
+
+    def append(self, dataset_id: str, df: pd.DataFrame) -> None:
+        #adds the events of df to dataset_id as a new part, e.g. the next batch of a streamed load
+        #every process serving dataset_id reads it again on its next get
+        parts = [part for part in os.listdir(self.path(dataset_id)) if part.endswith('.arrow')]
+        MappedCatalog.write(df, os.path.join(self.path(dataset_id), f'part-{len(parts):05d}.arrow'))
+        with self.lock:
+            self.forget(dataset_id)
+
+    def stamp(self, dataset_id: str) -> Optional[int]:
+        try:
+            return os.stat(self.path(dataset_id)).st_mtime_ns
+        except (FileNotFoundError, TypeError):
+            return None
+
+    def table(self, dataset_id: str) -> tuple[pa.Table, np.ndarray]:
+        #the mapped table of dataset_id and the positions of its rows most recent event first,
+        #raises KeyError for an unknown id
+        stamp = self.stamp(dataset_id)
+        with self.lock:
+            if dataset_id in self.tables and self.stamps.get(dataset_id) == stamp:
+                return self.tables[dataset_id]
+        table, rows = self.load(dataset_id)
+        with self.lock:
+            #the frame and indexes of a dataset that grew since it was mapped are dropped with it
+            self.forget(dataset_id)
+            self.tables[dataset_id] = table, rows
+            self.stamps[dataset_id] = stamp
+            self.stats['loads'] += 1
+        return table, rows
+
+    def get(self, dataset_id: str) -> pd.DataFrame:
+        #returns the frame registered as dataset_id, raises KeyError for an unknown id
+        table, rows = self.table(dataset_id)
+        self.touch(dataset_id)
+        with self.lock:
+            if dataset_id in self.frames:
+                self.frames.move_to_end(dataset_id)
+                self.stats['hits'] += 1
+                return self.frames[dataset_id]
+        df = table_frame(table.take(rows))
+        with self.lock:
+            if dataset_id in self.tables:
+                self.keep(dataset_id, df)
+        return df
+
+    def columns(self, dataset_id: str, columns: list[str]) -> pd.DataFrame:
+        #the given columns of dataset_id, from the frame when it is held and otherwise converted alone
+        table, rows = self.table(dataset_id)
+        with self.lock:
+            df = self.frames.get(dataset_id)
+        if df is not None:
+            return df[columns]
+        return table_frame(table.select(columns).take(rows))
+
+    def rows(self, dataset_id: str, positions: np.ndarray) -> pd.DataFrame:
+        #the rows of dataset_id at positions, only those rows are converted
+        table, rows = self.table(dataset_id)
+        return table_frame(table.take(rows[positions]))
+
+    def __contains__(self, dataset_id: str) -> bool:
+        return dataset_id in self.tables or os.path.isdir(self.path(dataset_id))
+
+    def load(self, dataset_id: str) -> tuple[pa.Table, np.ndarray]:
+        #maps the files of a dataset, which are stored oldest event first, without reading them
+        #appended parts may hold older or newer events than the ones before them, so the row order sorts them together
+        if not dataset_id or not os.path.isdir(self.path(dataset_id)):
+            raise KeyError(dataset_id)
+        parts = [MappedCatalog(os.path.join(self.path(dataset_id), part))
+                 for part in sorted(os.listdir(self.path(dataset_id))) if part.endswith('.arrow')]
+        if not parts:
+            raise KeyError(dataset_id)
+        #a part whose column held only missing values has a null type, which is promoted to the type of the others
+        table = pa.concat_tables([part.table for part in parts], promote_options='default') if len(parts) > 1 else parts[0].table
+        times = np.concatenate([part.times for part in parts])
+        return table, np.argsort(times, kind='stable')[::-1].copy()
+
+    def keep(self, dataset_id: str, df: pd.DataFrame) -> None:
+        #holds df in memory, dropping least recently used frames beyond max_bytes
+        self.frames[dataset_id] = df
+        self.sizes[dataset_id] = int(df.memory_usage(deep=True).sum())
+        while len(self.frames) > 1 and sum(self.sizes.values()) > self.max_bytes:
+            oldest, _ = self.frames.popitem(last=False)
+            self.forget(oldest)
+            self.stats['evictions'] += 1
+
+    def forget(self, dataset_id: str) -> None:
+        #drops everything held in memory for dataset_id
+        self.frames.pop(dataset_id, None)
+        self.sizes.pop(dataset_id, None)
+        self.tables.pop(dataset_id, None)
+        self.stamps.pop(dataset_id, None)
+        for key in [key for key in self.sort_indexes if key[0] == dataset_id]:
+            del self.sort_indexes[key]
+        self.spatial_indexes.pop(dataset_id, None)
+        for key in [key for key in self.masks if key[0] == dataset_id]:
+            del self.masks[key]
+
+    def discard(self, dataset_id: str) -> None:
+        with self.lock:
+            self.forget(dataset_id)
+        shutil.rmtree(self.path(dataset_id), ignore_errors=True)
+
+    def touch(self, dataset_id: str) -> None:
+        #marks dataset_id as read now, so prune keeps it while a session still pages through it
+        #the time is kept on its first part, changing the directory would change its stamp and map the table again
+        try:
+            os.utime(os.path.join(self.path(dataset_id), FIRST_PART))
+        except FileNotFoundError:
+            pass
+
+    def last_used(self, dataset_id: str) -> float:
+        #the last time dataset_id was written or read
+        try:
+            read = os.path.getmtime(os.path.join(self.path(dataset_id), FIRST_PART))
+        except FileNotFoundError:
+            read = 0.0
+        return max(os.path.getmtime(self.path(dataset_id)), read)
+
+    def prune(self) -> None:
+        #removes spilled datasets not written or read for max_age
+        cutoff = time.time() - self.max_age
+        for dataset_id in os.listdir(self.directory):
+            try:
+                if self.last_used(dataset_id) < cutoff:
+                    self.discard(dataset_id)
+            except FileNotFoundError:
+                pass
+
+    def sort_index(self, dataset_id: str, column: str) -> tuple[np.ndarray, int]:
+        #row positions of dataset_id in ascending order of column with missing values last,
+        #and the number of rows holding a value, computed once per column
+        key = (dataset_id, column)
+        self.table(dataset_id)
+        if key not in self.sort_indexes:
+            values = self.columns(dataset_id, [column])[column].reset_index(drop=True)
+            order = (values.sort_values(kind='stable', na_position='last').index.to_numpy(), int(values.notna().sum()))
+            with self.lock:
+                if dataset_id in self.tables:
+                    self.sort_indexes[key] = order
+            return order
+        return self.sort_indexes[key]
+
+    def spatial_index(self, dataset_id: str) -> SpatialIndex:
+        #SpatialIndex over the events of dataset_id, built once per dataset
+        self.table(dataset_id)
+        if dataset_id not in self.spatial_indexes:
+            index = SpatialIndex.from_frame(self.columns(dataset_id, ['lat', 'lon']))
+            with self.lock:
+                if dataset_id in self.tables:
+                    self.spatial_indexes[dataset_id] = index
+            return index
+        return self.spatial_indexes[dataset_id]
+
+    def within(self, dataset_id: str, params) -> pd.DataFrame:
+        #the events of dataset_id inside the rectangle and circle of a RequestParams, answered locally
+        rows = self.spatial_index(dataset_id).filter(params)
+        return self.get(dataset_id) if rows is None else self.rows(dataset_id, rows)
+
+    def mask(self, dataset_id: str, filter_query: Optional[str]) -> Optional[np.ndarray]:
+        #filter_mask of dataset_id, the most recent masks are kept
+        key = (dataset_id, filter_query)
+        table, _ = self.table(dataset_id)
+        with self.lock:
+            if key in self.masks:
+                self.masks.move_to_end(key)
+                return self.masks[key]
+        mask = None
+        if filter_query:
+            columns = [col for col in filter_columns(filter_query) if col in table.column_names]
+            mask = filter_mask(self.columns(dataset_id, columns), filter_query)
+        with self.lock:
+            self.masks[key] = mask
+            while len(self.masks) > MAX_MASKS:
+                self.masks.popitem(last=False)
+        return mask
+
+    def order(self, dataset_id: str, sort_by: Optional[list[dict]] = None, filter_query: Optional[str] = None) -> Optional[np.ndarray]:
+        #row positions of dataset_id that pass filter_query, in the order given by a dash_table sort_by
+        #returns None when the frame is neither sorted nor filtered
+        mask = self.mask(dataset_id, filter_query)
+        if not sort_by:
+            return None if mask is None else np.flatnonzero(mask)
+        if len(sort_by) == 1:
+            order, valid = self.sort_index(dataset_id, sort_by[0]['column_id'])
+            if sort_by[0]['direction'] == 'desc':
+                #missing values stay last, like pandas sorts them
+                order = np.concatenate([order[:valid][::-1], order[valid:]])
+            return order if mask is None else order[mask[order]]
+        #several sort columns are sorted directly on the filtered rows
+        df = self.columns(dataset_id, [s['column_id'] for s in sort_by]).reset_index(drop=True)
+        rows = df if mask is None else df[mask]
+        return rows.sort_values([s['column_id'] for s in sort_by],
+                                ascending=[s['direction'] == 'asc' for s in sort_by],
+                                kind='stable').index.to_numpy()
+
+    def select(self, dataset_id: str, sort_by: Optional[list[dict]] = None, filter_query: Optional[str] = None) -> pd.DataFrame:
+        #the rows of dataset_id that pass filter_query, sorted by sort_by
+        order = self.order(dataset_id, sort_by, filter_query)
+        self.touch(dataset_id)
+        return self.get(dataset_id) if order is None else self.rows(dataset_id, order)
+
+    def page(self, dataset_id: str, page_current: int, page_size: int,
+             sort_by: Optional[list[dict]] = None, filter_query: Optional[str] = None) -> tuple[pd.DataFrame, int]:
+        #one page of the sorted and filtered rows and the number of pages
+        #a page past the end, e.g. after a filter shrank the table, shows the last page
+        order = self.order(dataset_id, sort_by, filter_query)
+        self.touch(dataset_id)
+        n = len(self.table(dataset_id)[1]) if order is None else len(order)
+        page_count = max(1, -(-n // page_size))
+        start = min(page_current or 0, page_count - 1) * page_size
+        positions = np.arange(start, min(start + page_size, n)) if order is None else order[start:start + page_size]
+        return self.rows(dataset_id, positions), page_count
+
+    def info(self) -> dict:
+        with self.lock:
+            return {**self.stats,
+                    'datasets': len(self.frames),
+                    'bytes': sum(self.sizes.values()),
+                    'max_bytes': self.max_bytes}
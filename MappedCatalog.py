@@ -0,0 +1,69 @@
+import os
+from typing import Optional, Union
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from DataLoader import COL_TYPES
+
+#anything pd.Timestamp accepts, naive times are taken as UTC
+TimeLike = Union[str, pd.Timestamp, np.datetime64, None]
+
+
+class MappedCatalog:
+    #a catalog stored as an uncompressed arrow ipc file sorted by time and memory-mapped instead of read
+    #the os page cache holds the file once for every process that maps it, so several dash workers
+    #share one copy, and only the pages of the columns and time range actually sliced are touched
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.source = pa.memory_map(path, 'r')
+        self.table = pa.ipc.open_file(self.source).read_all()
+        #the buffers of a mapped table point into the file, to_numpy on them does not copy
+        self.times = self.table.column('time').combine_chunks().view(pa.int64()).to_numpy()
+
+    @staticmethod
+    def write(df: pd.DataFrame, path: str) -> 'MappedCatalog':
+        #writes df sorted by time as a single record batch, a named index (the event id) is kept as a column
+        #the file is written next to path and moved into place, so processes mapping the old file keep a valid copy
+        df = df.sort_values('time', kind='stable').reset_index(drop=df.index.name is None)
+        table = pa.Table.from_pandas(df, preserve_index=False).combine_chunks()
+        tmp = path + f'.{os.getpid()}.tmp'
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression=None)) as writer:
+                writer.write_table(table, max_chunksize=max(len(table), 1))
+        os.replace(tmp, path)
+        return MappedCatalog(path)
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    @property
+    def columns(self) -> list[str]:
+        return self.table.column_names
+
+    def time_range(self) -> tuple[Optional[pd.Timestamp], Optional[pd.Timestamp]]:
+        if not len(self):
+            return None, None
+        return pd.Timestamp(self.times[0], tz='UTC'), pd.Timestamp(self.times[-1], tz='UTC')
+
+    def bounds(self, start: TimeLike = None, end: TimeLike = None) -> tuple[int, int]:
+        #row range [i, j) of the events with start <= time <= end, found by binary search
+        def ns(value):
+            value = pd.Timestamp(value)
+            return (value.tz_localize('UTC') if value.tz is None else value).value
+        i = 0 if start is None else int(np.searchsorted(self.times, ns(start), side='left'))
+        j = len(self) if end is None else int(np.searchsorted(self.times, ns(end), side='right'))
+        return i, max(i, j)
+
+    def slice(self, start: TimeLike = None, end: TimeLike = None, columns: Optional[list[str]] = None) -> pd.DataFrame:
+        #the events between start and end as a DataFrame, only those rows and columns are converted
+        i, j = self.bounds(start, end)
+        table = self.table.slice(i, j - i)
+        if columns is not None:
+            table = table.select(columns)
+        df = table.to_pandas()
+        if 'id' in df.columns:
+            df = df.set_index('id')
+        return df.astype({col: dtype for col, dtype in COL_TYPES.items() if col in df.columns}, copy=False)
+
+    def to_frame(self, columns: Optional[list[str]] = None) -> pd.DataFrame:
+        return self.slice(columns=columns)
@@ -0,0 +1,234 @@
+import os
+import json
+import threading
+from typing import Optional
+import numpy as np
+import pandas as pd
+from DataLoader import RequestParams, COL_TYPES
+from SpatialIndex import SpatialIndex, KM_PER_DEGREE
+
+#metadata of every partition, the only file read to plan a query
+CATALOG_META = 'partitions.json'
+#the month of every stored event id, only read by writes
+CATALOG_IDS = 'ids.parquet'
+#columns whose range is recorded per partition, a query skips partitions outside its ranges
+STATS_COLUMNS = ('mag', 'depth', 'lat', 'lon')
+
+
+def month_keys(times: pd.Series) -> np.ndarray:
+    #'YYYY-MM' of every utc time
+    times = times.dt.tz_convert('UTC')
+    return np.char.add(np.char.add(times.dt.year.to_numpy().astype(str), '-'),
+                       np.char.zfill(times.dt.month.to_numpy().astype(str), 2))
+
+
+def time_ms(value: str) -> int:
+    return int(pd.Timestamp(value, tz='UTC').value // 10**6)
+
+
+def utc_time(value) -> pd.Timestamp:
+    #a time string or timestamp as a utc timestamp, naive values are taken to be utc
+    value = pd.Timestamp(value)
+    return value.tz_localize('UTC') if value.tzinfo is None else value.tz_convert('UTC')
+
+
+def empty_catalog(columns: Optional[list[str]] = None) -> pd.DataFrame:
+    #a catalog with the COL_TYPES schema and no events
+    df = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in COL_TYPES.items()},
+                      index=pd.Index([], dtype=object, name='id'))
+    return df if columns is None else df[columns]
+
+
+def overlaps(low: Optional[float], high: Optional[float], bounds: Optional[list]) -> bool:
+    #True if [low, high] meets the recorded [min, max] of a column, None bounds are open
+    #a column that only holds NaN has no range and no event in it can pass a bound on it
+    if low is None and high is None:
+        return True
+    if bounds is None:
+        return False
+    return (low is None or bounds[1] >= low) and (high is None or bounds[0] <= high)
+
+
+def lon_intervals(minlon: float, maxlon: float) -> list[tuple[float, float]]:
+    #the longitudes of an api box in -180..180, two intervals when it crosses the antimeridian
+    if maxlon - minlon >= 360:
+        return [(-180.0, 180.0)]
+    low = (minlon + 180) % 360 - 180
+    high = low + (maxlon - minlon)
+    if high <= 180:
+        return [(low, high)]
+    return [(low, 180.0), (-180.0, high - 360)]
+
+
+class PartitionedCatalog:
+    #a catalog with the COL_TYPES schema, indexed by event id, stored as one parquet file per month under directory
+    #CATALOG_META records the rows, time range and STATS_COLUMNS ranges of every month, so a query reads
+    #a few kilobytes of metadata and then only the months whose ranges overlap its RequestParams
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.meta_path = os.path.join(directory, CATALOG_META)
+        self.ids_path = os.path.join(directory, CATALOG_IDS)
+        self.lock = threading.Lock()
+        self.stats = {'queries': 0, 'partitions_read': 0, 'partitions_pruned': 0}
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.meta = {}
+
+    def path(self, month: str) -> str:
+        return os.path.join(self.directory, f'{month}.parquet')
+
+    def save_meta(self) -> None:
+        #written to a temporary file first so a reader never sees partial metadata
+        tmp = self.meta_path + f'.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f, sort_keys=True)
+        os.replace(tmp, self.meta_path)
+
+    def ids(self) -> pd.Series:
+        #the month of every stored event, indexed by id
+        #catalogs written before CATALOG_IDS was kept are indexed from their partitions
+        if os.path.exists(self.ids_path):
+            return pd.read_parquet(self.ids_path)['month']
+        if not self.meta:
+            return pd.Series([], dtype=object, index=pd.Index([], dtype=object, name='id'), name='month')
+        return pd.concat([pd.Series(month, index=pd.read_parquet(self.path(month), columns=[]).index, name='month')
+                          for month in sorted(self.meta)])
+
+    def write(self, df: pd.DataFrame, start=None, end=None) -> None:
+        #adds the events of df, indexed by event id or holding an id column, events already stored with the same id
+        #are replaced wherever they are stored, so an event whose time moved to another month is not kept twice
+        #given a window from start to end, the events stored in it are replaced by those of df, so events deleted
+        #upstream since the window was last written are dropped, without one df is merged in like a sync
+        #only the months df has events in, takes events from or whose window it covers are rewritten
+        if df.index.name != 'id':
+            if 'id' not in df.columns:
+                raise ValueError('Events written to a PartitionedCatalog need an id index or column')
+            df = df.set_index('id')
+        df = df[~df.index.duplicated(keep='last')]
+        df = df.astype({col: dtype for col, dtype in COL_TYPES.items() if col in df.columns}, copy=False)
+        months = pd.Series(month_keys(df['time']), index=df.index, name='month')
+        window = None if start is None or end is None else (utc_time(start), utc_time(end))
+        with self.lock:
+            ids = self.ids()
+            replaced = ids[ids.index.isin(df.index)]
+            covered = [] if window is None else \
+                [month for month, entry in self.meta.items()
+                 if overlaps(window[0].value // 10**6, window[1].value // 10**6, entry['time'])]
+            rewritten = sorted(set(months) | set(replaced) | set(covered))
+            written = []
+            for month in rewritten:
+                events = df[months.to_numpy() == month]
+                if month in self.meta:
+                    stored = pd.read_parquet(self.path(month))
+                    keep = ~stored.index.isin(df.index)
+                    if window is not None:
+                        keep &= ~stored['time'].between(*window).to_numpy()
+                    events = pd.concat([stored[keep], events])
+                if events.empty:
+                    os.remove(self.path(month))
+                    del self.meta[month]
+                    continue
+                events = events.sort_values('time', kind='stable')
+                tmp = self.path(month) + f'.{os.getpid()}.tmp'
+                events.to_parquet(tmp)
+                os.replace(tmp, self.path(month))
+                self.meta[month] = self.describe(events)
+                written.append(pd.Series(month, index=events.index, name='month'))
+            ids = pd.concat([ids[~ids.isin(rewritten)], *written])
+            tmp = self.ids_path + f'.{os.getpid()}.tmp'
+            ids.to_frame().to_parquet(tmp)
+            os.replace(tmp, self.ids_path)
+            self.save_meta()
+
+    @staticmethod
+    def describe(events: pd.DataFrame) -> dict:
+        #the metadata recorded for a partition
+        entry = {'rows': len(events),
+                 'time': [int(events['time'].iloc[0].value // 10**6), int(events['time'].iloc[-1].value // 10**6)]}
+        for col in STATS_COLUMNS:
+            values = events[col].to_numpy(dtype=float)
+            entry[col] = None if np.isnan(values).all() else [float(np.nanmin(values)), float(np.nanmax(values))]
+        return entry
+
+    def partitions(self, params: RequestParams) -> list[str]:
+        #the months whose recorded ranges overlap the window, magnitudes, depths and area of params
+        start = None if params.starttime is None else time_ms(params.starttime)
+        end = None if params.endtime is None else time_ms(params.endtime)
+        lat_low, lat_high = params.minlatitude, params.maxlatitude
+        lons = None
+        if params.minlongitude is not None or params.maxlongitude is not None:
+            lons = lon_intervals(-180 if params.minlongitude is None else params.minlongitude,
+                                 180 if params.maxlongitude is None else params.maxlongitude)
+        maxradius = params.maxradius
+        if maxradius is None and params.maxradiuskm is not None:
+            maxradius = params.maxradiuskm / KM_PER_DEGREE
+        if params.latitude is not None and params.longitude is not None and maxradius is not None:
+            #a circle is pruned by the band of latitudes it spans
+            lat_low = max(lat_low if lat_low is not None else -90, params.latitude - maxradius)
+            lat_high = min(lat_high if lat_high is not None else 90, params.latitude + maxradius)
+        months = []
+        for month, entry in sorted(self.meta.items()):
+            keep = overlaps(start, end, entry['time']) \
+                and overlaps(params.minmagnitude, params.maxmagnitude, entry['mag']) \
+                and overlaps(params.mindepth, params.maxdepth, entry['depth']) \
+                and overlaps(lat_low, lat_high, entry['lat']) \
+                and (lons is None or any(overlaps(low, high, entry['lon']) for low, high in lons))
+            if keep:
+                months.append(month)
+        return months
+
+    def query(self, params: RequestParams, columns: Optional[list[str]] = None) -> pd.DataFrame:
+        #the events matching params, read from the overlapping months only, in the order params asks for
+        #columns optionally limits the columns returned, the ones params filters on are read regardless
+        months = self.partitions(params)
+        with self.lock:
+            self.stats['queries'] += 1
+            self.stats['partitions_read'] += len(months)
+            self.stats['partitions_pruned'] += len(self.meta) - len(months)
+        if not months:
+            return empty_catalog(columns)
+        read = None if columns is None else list(dict.fromkeys([*columns, 'time', 'sig', *STATS_COLUMNS]))
+        df = pd.concat([pd.read_parquet(self.path(month), columns=read) for month in months])
+        keep = np.ones(len(df), dtype=bool)
+        if params.starttime is not None:
+            keep &= (df['time'] >= pd.Timestamp(params.starttime, tz='UTC')).to_numpy()
+        if params.endtime is not None:
+            keep &= (df['time'] <= pd.Timestamp(params.endtime, tz='UTC')).to_numpy()
+        for col, low, high in (('mag', params.minmagnitude, params.maxmagnitude),
+                               ('depth', params.mindepth, params.maxdepth),
+                               ('sig', params.minsig, params.maxsig)):
+            if low is not None:
+                keep &= (df[col] >= low).to_numpy()
+            if high is not None:
+                keep &= (df[col] <= high).to_numpy()
+        rows = SpatialIndex.from_frame(df).filter(params)
+        if rows is not None:
+            spatial = np.zeros(len(df), dtype=bool)
+            spatial[rows] = True
+            keep &= spatial
+        df = df[keep]
+        if params.orderby in ('time', 'time-asc'):
+            df = df.sort_values('time', ascending=(params.orderby == 'time-asc'), kind='stable')
+        return df if columns is None else df[columns]
+
+    def to_frame(self, columns: Optional[list[str]] = None) -> pd.DataFrame:
+        #every stored event, oldest first
+        if not self.meta:
+            return empty_catalog(columns)
+        return pd.concat([pd.read_parquet(self.path(month), columns=columns) for month in sorted(self.meta)])
+
+    def time_range(self) -> tuple[Optional[pd.Timestamp], Optional[pd.Timestamp]]:
+        if not self.meta:
+            return None, None
+        return (pd.Timestamp(min(entry['time'][0] for entry in self.meta.values()), unit='ms', tz='UTC'),
+                pd.Timestamp(max(entry['time'][1] for entry in self.meta.values()), unit='ms', tz='UTC'))
+
+    def __len__(self) -> int:
+        return sum(entry['rows'] for entry in self.meta.values())
+
+    def info(self) -> dict:
+        with self.lock:
+            return {**self.stats, 'partitions': len(self.meta), 'rows': len(self)}
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+import pandas as pd
+from DataLoader import RequestParams, DT_FORMAT, params_key
+#processes sharing a cache directory take turns updating its index through an flock,
+#without fcntl only the threads of one process are serialised
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#default location of the cache, relative to the working directory
+CACHE_DIR = os.path.join('.cache', 'queries')
+#seconds before an entry whose window reaches the present expires
+CACHE_TTL = 15 * 60
+#seconds after its end before a window is treated as final, the usgs revises recent events for days
+IMMUTABLE_AFTER = 7 * 24 * 60 * 60
+#total size of cached query results before least recently used entries are evicted
+CACHE_MAX_BYTES = 1024**3
+
+
+def is_immutable(params: RequestParams) -> bool:
+    #a request whose window ended more than IMMUTABLE_AFTER ago always has the same answer
+    #unless it asks for updates, which keep arriving after the window closes
+    if params.endtime is None or params.updatedafter is not None:
+        return False
+    end = datetime.strptime(params.endtime, DT_FORMAT).replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc).timestamp() - end.timestamp() > IMMUTABLE_AFTER
+
+
+class QueryCache:
+    #an on-disk cache of api responses shared by every DataLoader given it
+    #counts are kept in the index, query results are stored as parquet files next to it
+    #every change to the index is made on a fresh copy read under the index lock and saved before it is released,
+    #so entries added, evicted or used by other processes sharing the directory are never overwritten
+    def __init__(self, directory: str = CACHE_DIR, ttl: float = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock_path = os.path.join(directory, 'index.lock')
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'expired': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+        self.index = {}
+        self.reload()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.parquet')
+
+    def save_index(self) -> None:
+        #written to a temporary file first so a reader never sees a partial index
+        tmp = self.index_path + f'.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+    def reload(self) -> None:
+        #reads the index as the processes sharing the directory last saved it
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = {}
+
+    @contextmanager
+    def locked_index(self):
+        #holds the index of every process sharing the directory, read fresh from disk
+        #and saved with the changes made to it when the block exits
+        with self.lock, open(self.lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self.reload()
+                yield self.index
+                self.save_index()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def lookup(self, key: str) -> Optional[dict]:
+        #returns the live index entry for key, dropping it if it has expired
+        #a hit records its access time for the least recently used eviction
+        entry = self.index.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        if not entry['immutable'] and time.time() - entry['created'] > self.ttl:
+            self.remove(key)
+            self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return None
+        entry['accessed'] = time.time()
+        self.stats['hits'] += 1
+        return entry
+
+    def store(self, key: str, entry: dict, params: RequestParams) -> None:
+        now = time.time()
+        entry.update(created=now, accessed=now, immutable=is_immutable(params))
+        self.index[key] = entry
+        self.stats['writes'] += 1
+        self.evict()
+
+    def remove(self, key: str) -> None:
+        entry = self.index.pop(key, None)
+        if entry and entry.get('bytes'):
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def evict(self) -> None:
+        #removes least recently used entries until the cache fits in max_bytes
+        total = self.size()
+        for key in sorted(self.index, key=lambda key: self.index[key]['accessed']):
+            if total <= self.max_bytes:
+                break
+            total -= self.index[key].get('bytes', 0)
+            self.remove(key)
+            self.stats['evictions'] += 1
+
+    def size(self) -> int:
+        return sum(entry.get('bytes', 0) for entry in self.index.values())
+
+    def get_count(self, url: str, params: RequestParams) -> Optional[int]:
+        with self.locked_index():
+            entry = self.lookup(params_key(url, params))
+            return None if entry is None else entry['count']
+
+    def put_count(self, url: str, params: RequestParams, count: int) -> None:
+        with self.locked_index():
+            self.store(params_key(url, params), {'count': count}, params)
+
+    def get_frame(self, url: str, params: RequestParams) -> Optional[pd.DataFrame]:
+        key = params_key(url, params)
+        with self.locked_index():
+            if self.lookup(key) is None:
+                return None
+        try:
+            return pd.read_parquet(self.path(key))
+        except (FileNotFoundError, OSError):
+            #the file was evicted by another process after the lookup
+            with self.locked_index():
+                self.index.pop(key, None)
+            return None
+
+    def put_frame(self, url: str, params: RequestParams, df: pd.DataFrame) -> None:
+        #the file is written next to its path and moved into place, so readers never see part of it
+        key = params_key(url, params)
+        path = self.path(key)
+        tmp = path + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        df.to_parquet(tmp)
+        os.replace(tmp, path)
+        with self.locked_index():
+            self.store(key, {'count': len(df), 'bytes': os.path.getsize(path)}, params)
+
+    def info(self) -> dict:
+        #cache statistics for monitoring
+        with self.locked_index():
+            return {**self.stats,
+                    'entries': len(self.index),
+                    'immutable': sum(entry['immutable'] for entry in self.index.values()),
+                    'bytes': self.size(),
+                    'max_bytes': self.max_bytes}
+
+    def clear(self) -> None:
+        with self.locked_index():
+            for key in list(self.index):
+                self.remove(key)
@@ -0,0 +1,90 @@
+import os
+import threading
+from typing import Any, Callable, Optional
+#the lock files that coalesce calls across processes need flock, without it only threads are coalesced
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def same_file(f, path: str) -> bool:
+    #whether the open file f is still the file at path
+    try:
+        return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+class Flight:
+    #one call in progress, the callers that joined it wait on done
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    #coalesces concurrent calls with the same key, so the work of a key is only done once at a time
+    #callers arriving while a call is in flight wait for it and share its result or its error
+    #given a directory, the leading call also holds an flock on <directory>/<key>.lock, so leaders in other
+    #processes sharing the directory wait for it, their call should first look for the result in a shared cache
+    def __init__(self) -> None:
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key: str, fn: Callable[[], Any], directory: Optional[str] = None) -> Any:
+        with self.lock:
+            self.stats['calls'] += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                self.stats['shared'] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self.locked(key, fn, directory)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def locked(self, key: str, fn: Callable[[], Any], directory: Optional[str]) -> Any:
+        #runs fn holding the lock file of key
+        #the file is removed before it is unlocked, processes still waiting on it then run fn once more,
+        #which is served by the cache the leader filled
+        if directory is None or fcntl is None:
+            return fn()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, key + '.lock')
+        while True:
+            with open(path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                #a lock taken on a file the previous leader already removed does not exclude a process
+                #that opened the new file at path, so it is given up and taken again on the file at path
+                if not same_file(f, path):
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    continue
+                try:
+                    return fn()
+                finally:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def info(self) -> dict:
+        with self.lock:
+            return {**self.stats, 'in_flight': len(self.flights)}
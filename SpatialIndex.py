@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+from typing import Optional
+from DataLoader import RequestParams
+
+#side of the grid cells events are bucketed by, in degrees
+CELL_DEGREES = 2.0
+#great circle km per degree on the 6371 km sphere the usgs api measures maxradiuskm on
+KM_PER_DEGREE = 111.19
+
+
+def unit_vectors(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    #positions on the unit sphere, the dot product of two is the cosine of their angular distance
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class SpatialIndex:
+    #a grid over lon/lat built once per frame, with the rows of each cell stored together
+    #a query collects the rows of the cells its region overlaps and tests only those exactly
+    #rows are positions in the frame, events without a position are never returned
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, cell: float = CELL_DEGREES) -> None:
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = (np.asarray(lon, dtype=float) + 180) % 360 - 180
+        self.xyz = unit_vectors(self.lat, self.lon)
+        self.cell = cell
+        self.n_lon = int(np.ceil(360 / cell))
+        self.n_lat = int(np.ceil(180 / cell))
+        valid = ~np.isnan(self.lat) & ~np.isnan(self.lon)
+        cells = np.full(len(self.lat), self.n_lat * self.n_lon)
+        cells[valid] = self.lat_cell(self.lat[valid]) * self.n_lon + self.lon_cell(self.lon[valid])
+        self.order = np.argsort(cells, kind='stable')
+        #rows of cell c are order[starts[c]:starts[c + 1]]
+        self.starts = np.searchsorted(cells[self.order], np.arange(self.n_lat * self.n_lon + 1))
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, cell: float = CELL_DEGREES) -> 'SpatialIndex':
+        return cls(df['lat'].to_numpy(dtype=float), df['lon'].to_numpy(dtype=float), cell)
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    def lat_cell(self, lat):
+        return np.clip(((np.asarray(lat) + 90) // self.cell).astype(np.int64), 0, self.n_lat - 1)
+
+    def lon_cell(self, lon):
+        return np.clip(((np.asarray(lon) + 180) // self.cell).astype(np.int64), 0, self.n_lon - 1)
+
+    def lon_ranges(self, minlon: float, maxlon: float) -> list[tuple[int, int]]:
+        #inclusive ranges of lon cells covering minlon..maxlon, two when it crosses the antimeridian
+        if maxlon - minlon >= 360:
+            return [(0, self.n_lon - 1)]
+        low = (minlon + 180) % 360 - 180
+        high = low + (maxlon - minlon)
+        if high < 180:
+            return [(int(self.lon_cell(low)), int(self.lon_cell(high)))]
+        return [(int(self.lon_cell(low)), self.n_lon - 1), (0, int(self.lon_cell(high - 360)))]
+
+    def candidates(self, minlat: float, maxlat: float, lon_ranges: list[tuple[int, int]]) -> np.ndarray:
+        #rows in the cells between minlat and maxlat and in lon_ranges, each lat row is one slice per range
+        slices = []
+        for i in range(int(self.lat_cell(minlat)), int(self.lat_cell(maxlat)) + 1):
+            for j0, j1 in lon_ranges:
+                slices.append(self.order[self.starts[i * self.n_lon + j0]:self.starts[i * self.n_lon + j1 + 1]])
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def box(self, minlat: float = -90, maxlat: float = 90, minlon: float = -180, maxlon: float = 180) -> np.ndarray:
+        #rows inside the rectangle, longitudes follow the api and may run past 180 to cross the antimeridian
+        rows = self.candidates(minlat, maxlat, self.lon_ranges(minlon, maxlon))
+        lat, lon = self.lat[rows], self.lon[rows]
+        keep = (lat >= minlat) & (lat <= maxlat)
+        if maxlon - minlon < 360:
+            keep &= (lon - minlon) % 360 <= maxlon - minlon
+        return np.sort(rows[keep])
+
+    def radius(self, latitude: float, longitude: float, maxradius: float) -> np.ndarray:
+        #rows within maxradius degrees of great circle distance from the centre
+        minlat, maxlat = latitude - maxradius, latitude + maxradius
+        if minlat <= -90 or maxlat >= 90:
+            #the circle reaches a pole and spans every longitude
+            lon_ranges = [(0, self.n_lon - 1)]
+        else:
+            #half width in longitude of the circle's bounding box
+            ratio = np.sin(np.radians(maxradius)) / np.cos(np.radians(latitude))
+            width = 180.0 if ratio >= 1 else np.degrees(np.arcsin(ratio))
+            lon_ranges = self.lon_ranges(longitude - width, longitude + width)
+        rows = self.candidates(max(minlat, -90), min(maxlat, 90), lon_ranges)
+        centre = unit_vectors(np.array(latitude), np.array(longitude))
+        #a small tolerance keeps events exactly on the circle
+        keep = self.xyz[rows] @ centre >= np.cos(np.radians(maxradius)) - 1e-12
+        return np.sort(rows[keep])
+
+    def nearest(self, latitude: float, longitude: float, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        #the k rows closest to the centre, nearest first, and their distances in degrees
+        #the search circle doubles until it holds k events, which are then the k nearest overall
+        maxradius = self.cell
+        while True:
+            rows = self.radius(latitude, longitude, maxradius)
+            if len(rows) >= k or maxradius >= 180:
+                break
+            maxradius = min(2 * maxradius, 180)
+        centre = unit_vectors(np.array(latitude), np.array(longitude))
+        distances = np.degrees(np.arccos(np.clip(self.xyz[rows] @ centre, -1, 1)))
+        order = np.argsort(distances, kind='stable')[:k]
+        return rows[order], distances[order]
+
+    def filter(self, params: RequestParams) -> Optional[np.ndarray]:
+        #rows inside the rectangle and circle of params, as the api would select them
+        #returns None when params hold no geometry narrower than the whole world
+        rows = None
+        rectangle = [params.minlatitude, params.maxlatitude, params.minlongitude, params.maxlongitude]
+        defaults = [-90, 90, -180, 180]
+        if any(value is not None and value != default for value, default in zip(rectangle, defaults)):
+            rows = self.box(*[default if value is None else value for value, default in zip(rectangle, defaults)])
+        maxradius = params.maxradius
+        if maxradius is None and params.maxradiuskm is not None:
+            maxradius = params.maxradiuskm / KM_PER_DEGREE
+        if params.latitude is not None and params.longitude is not None and maxradius is not None:
+            circle = self.radius(params.latitude, params.longitude, maxradius)
+            rows = circle if rows is None else np.intersect1d(rows, circle, assume_unique=True)
+        return rows
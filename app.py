@@ -1,24 +1,36 @@
+import os
 import pandas as pd
 import altair as alt
 import dash_vega_components as dvc
-from dash import Dash, Input, Output, callback, dcc, html
-from DataVisualizer import DataVisualizer
+from dash import Dash, Input, Output, State, ClientsideFunction, callback, clientside_callback, dcc, html
+from DataVisualizer import DataVisualizer, PROJECTION_INPUTS
+from DataLoader import save_catalog, load_catalog
+from Basemap import ASSET_MAX_AGE
 
 alt.data_transformers.disable_max_rows()
 
+CSV_PATH = 'data/test.csv'
+#the parsed csv is saved next to it so later starts skip csv and date parsing
+CATALOG_PATH = 'data/test.parquet'
 
-df = pd.read_csv('data/test.csv')
-
-def preprocess(df):
+def read_csv(path):
+    df = pd.read_csv(path)
     df.set_index('id', inplace=True)
     df['time'] = pd.to_datetime(df['time'], format = 'ISO8601')
-    df = df.sample(5000, random_state=42)
     return df
 
-df = preprocess(df)
+if os.path.exists(CATALOG_PATH) and os.path.getmtime(CATALOG_PATH) >= os.path.getmtime(CSV_PATH):
+    df = load_catalog(CATALOG_PATH)
+else:
+    df = read_csv(CSV_PATH)
+    save_catalog(df, CATALOG_PATH)
+
+#large catalogs are drawn as hexagonal bins by the visualizer, so every event is kept
 visualizer = DataVisualizer(df)
 
 app = Dash()
+#the basemap is served from assets/, see Basemap.basemap_url
+app.server.config['SEND_FILE_MAX_AGE_DEFAULT'] = ASSET_MAX_AGE
 app.layout = html.Div([
     html.H1('Title'),
     html.Div(
@@ -115,15 +127,24 @@ app.layout = html.Div([
         ]
     ),
     html.Div(id='output_div'),
+    #the chart's projection params are bound to these, see assets/projection.js
+    html.Div([html.Input(id=element, type='hidden') for element in PROJECTION_INPUTS.values()],
+             id='projection_signals'),
 
 ])
 
-@callback(
-    Output('output_div', 'children'),
+#rotating, zooming and changing the projection only updates the chart in the browser
+clientside_callback(
+    ClientsideFunction(namespace='map', function_name='set_projection'),
+    Output('projection_signals', 'title'),
     Input('proj_dd', 'value'),
     Input('phi', 'value'),
     Input('theta', 'value'),
     Input('scale', 'value'),
+)
+
+@callback(
+    Output('output_div', 'children'),
     Input('map_fill', 'value'),
     Input('map_stroke', 'value'),
     Input('background', 'value'),
@@ -133,12 +154,18 @@ app.layout = html.Div([
     Input('filter_vars', 'value'),
     Input('heatmap_x', 'value'),
     Input('heatmap_y', 'value'),
+    #a rebuilt chart starts from the current projection
+    State('proj_dd', 'value'),
+    State('phi', 'value'),
+    State('theta', 'value'),
+    State('scale', 'value'),
 )
-def update_output(proj_dd, phi, theta, scale, map_fill, map_stroke, background,
+def update_output(map_fill, map_stroke, background,
                   size_var, color_var, opacity_var,
                   filter_vars,
-                  heatmap_x, heatmap_y):
-    chart_spec = visualizer.create_chart(
+                  heatmap_x, heatmap_y,
+                  proj_dd, phi, theta, scale):
+    chart_spec = visualizer.create_spec(
         projection=proj_dd,
         phi=phi, theta=theta,
         scale = scale,
@@ -152,12 +179,12 @@ def update_output(proj_dd, phi, theta, scale, map_fill, map_stroke, background,
         heatmap_y=heatmap_y,
         width = 1200,
         height = 500,
-    ).properties(
-        background = background).to_dict()
+        background = background,
+    )
     return dvc.Vega(
         id='map',
         signalsToObserve=['brush'],
-        opt={"renderer": 'svg', 'actions': False},
+        opt={"renderer": visualizer.renderer(), 'actions': False},
         spec=chart_spec
     )
 
@@ -1,7 +1,10 @@
 import dash
 from dash import Dash, html, dcc, Input, Output
+from Basemap import ASSET_MAX_AGE
 
 app = Dash(__name__, use_pages=True, suppress_callback_exceptions=True)
+#the basemap is served from assets/, see Basemap.basemap_url
+app.server.config['SEND_FILE_MAX_AGE_DEFAULT'] = ASSET_MAX_AGE
 
 app.layout = html.Div([
     html.H1('Eearthquake Visualization Dashboard'),
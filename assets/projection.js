@@ -0,0 +1,24 @@
+// Moves the map in the browser: the chart's projection params are bound to hidden inputs
+// (DataVisualizer.PROJECTION_INPUTS), writing a control's value into its input and firing an
+// input event updates the vega signal without a server callback or a new spec
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map: {
+        set_projection: function(projection, phi, theta, scale) {
+            const values = {
+                projection_input: projection,
+                phi_input: phi,
+                theta_input: theta,
+                scale_input: scale
+            };
+            for (const [id, value] of Object.entries(values)) {
+                const input = document.getElementById(id);
+                if (!input || value === null || value === undefined || input.value === String(value)) {
+                    continue;
+                }
+                input.value = value;
+                input.dispatchEvent(new Event('input'));
+            }
+            return window.dash_clientside.no_update;
+        }
+    }
+});
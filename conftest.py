@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+from DataLoader import DT_FORMAT
+
+#a stub of the usgs fdsnws event service serving a fixed synthetic catalog
+#one event every STEP seconds from START, magnitudes cycle through MAGS
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+STEP = 600
+N_EVENTS = 5000
+MAGS = [2.5, 3.0, 4.5, 5.5, 6.5]
+
+
+def make_event(i: int) -> dict:
+    ms = int((START.timestamp() + i * STEP) * 1000)
+    mag = MAGS[i % len(MAGS)]
+    return {
+        'type': 'Feature',
+        'id': f'stub{i:06d}',
+        'properties': {
+            'mag': mag,
+            'place': f'{i % 100} km N of Stubville',
+            'time': ms,
+            'updated': ms + 60000,
+            'tsunami': int(mag >= 6.5),
+            'sig': int(mag * 100),
+            'cdi': None,
+            'alert': 'green' if mag >= 5.5 else None,
+        },
+        'geometry': {'type': 'Point', 'coordinates': [(i * 7) % 360 - 180, (i * 3) % 180 - 90, (i * 11) % 700]},
+    }
+
+
+class StubUSGS:
+    def __init__(self):
+        self.events = [make_event(i) for i in range(N_EVENTS)]
+        self.lock = threading.Lock()
+        self.hits = {'count': 0, 'query': 0}
+        self.fail = 0 #number of upcoming requests answered with fail_status
+        self.fail_status = 503
+        self.delay = 0.0 #seconds each request takes
+        self.active = 0
+        self.max_active = 0
+
+    def select(self, args: dict) -> list[dict]:
+        def ms(value):
+            return datetime.strptime(value, DT_FORMAT).replace(tzinfo=timezone.utc).timestamp() * 1000
+        events = self.events
+        if 'starttime' in args:
+            start = ms(args['starttime'])
+            events = [e for e in events if e['properties']['time'] >= start]
+        if 'endtime' in args:
+            end = ms(args['endtime'])
+            events = [e for e in events if e['properties']['time'] <= end]
+        if 'updatedafter' in args:
+            after = ms(args['updatedafter'])
+            events = [e for e in events if e['properties']['updated'] > after]
+        if 'minmagnitude' in args:
+            events = [e for e in events if e['properties']['mag'] >= float(args['minmagnitude'])]
+        if 'maxmagnitude' in args:
+            events = [e for e in events if e['properties']['mag'] <= float(args['maxmagnitude'])]
+        return sorted(events, key=lambda e: e['properties']['time'], reverse=True)
+
+    def handler(stub):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                args = {k: v[0] for k, v in parse_qs(url.query).items()}
+                endpoint = url.path.rsplit('/', 1)[-1]
+                with stub.lock:
+                    stub.hits[endpoint] = stub.hits.get(endpoint, 0) + 1
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                    failing = stub.fail > 0
+                    stub.fail -= failing
+                try:
+                    time.sleep(stub.delay)
+                    if failing:
+                        self.send_response(stub.fail_status)
+                        self.send_header('Retry-After', '0')
+                        self.end_headers()
+                        return
+                    events = stub.select(args)
+                    if endpoint == 'count':
+                        body = {'count': len(events), 'maxAllowed': 20000}
+                    else:
+                        offset = int(args.get('offset', 1)) - 1
+                        limit = int(args.get('limit', 20000))
+                        page = events[offset:offset + limit]
+                        body = {'type': 'FeatureCollection', 'metadata': {'count': len(page)}, 'features': page}
+                    data = json.dumps(body).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                finally:
+                    with stub.lock:
+                        stub.active -= 1
+        return Handler
+
+
+@pytest.fixture
+def usgs_stub():
+    stub = StubUSGS()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), stub.handler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    stub.url = f'http://127.0.0.1:{server.server_port}/fdsnws/event/1/'
+    yield stub
+    server.shutdown()
+    server.server_close()
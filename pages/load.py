@@ -1,13 +1,49 @@
+import os
+import time
 import dash
 import dash_vega_components as dvc
-from dash import html, dcc, callback, Input, Output, State, dash_table
+from dash import html, dcc, callback, clientside_callback, ClientsideFunction, Input, Output, State, dash_table
 from dash.exceptions import PreventUpdate
 from datetime import datetime, date, timedelta
-from DataLoader import DataLoader, RequestParams, DT_FORMAT
-from DataVisualizer import DataVisualizer
+from DataLoader import DataLoader, RequestParams, DT_FORMAT, COL_TYPES
+from DataVisualizer import DataVisualizer, PROJECTION_INPUTS, DECK_TOOLTIP, brush_names, brush_ranges
+from QueryCache import QueryCache
+from CatalogStore import CatalogStore
+from DatasetStore import DatasetStore
 import pandas as pd
+#dash_deck draws the webgl map, without it the webgl renderer falls back to canvas
+try:
+    import dash_deck
+except ImportError:
+    dash_deck = None
+#with diskcache loads run as background jobs, so a slow api response does not hold a dash worker
+#and the load reports its progress, without it they run in the request thread
+try:
+    import diskcache
+    JOBS = dash.DiskcacheManager(diskcache.Cache(os.path.join('.cache', 'jobs')))
+except ImportError:
+    JOBS = None
 dash.register_page(__name__)
 
+#repeated counts and loads with the same parameters are answered from disk
+CACHE = QueryCache()
+#loaded frames stay on the server, the browser holds their id in the dataset_id store
+DATASETS = DatasetStore()
+#a background load shows its events as they arrive, the table and map are refreshed
+#once STREAM_ROWS more events have arrived or STREAM_SECONDS have passed since the last refresh
+STREAM_ROWS = 10000
+STREAM_SECONDS = 1.0
+#starting values of the map tools, the hidden projection inputs start at them too
+#since the chart initialises its projection params from those inputs
+PROJECTION_DEFAULTS = {'projection': 'naturalEarth1', 'phi': 0, 'theta': 0, 'scale': 100}
+
+def dataset_columns(dataset_id):
+    #numeric and datetime columns of a loaded dataset, for the aesthetics and filter dropdowns
+    if not dataset_id:
+        return []
+    df = DATASETS.get(dataset_id)
+    return df.select_dtypes(include=['number', 'datetime64[ns, UTC]']).columns.tolist()
+
 layout = html.Div([
     html.Div(
     [
@@ -160,11 +196,23 @@ def build_loader(input):
 )
 def build_loader_output(input):
     loader_output = []
+    loader_output.append(dcc.Store(id='dataset_id'))
+    #the dataset a background load is filling, reset to None when the load finishes and sets dataset_id
+    #and when the output is cleared
+    loader_output.append(dcc.Store(id='dataset_stream'))
+    #rows are sorted, filtered and served one page at a time from DATASETS by update_table_page
     loader_output.append(dash_table.DataTable(
             id = 'data_table',
+            #known up front so streamed rows show before the load returns
+            columns=[{"name": col, "id": col} for col in COL_TYPES],
             page_size=50,
-            filter_action = 'native',
-            sort_action = 'native',
+            page_current=0,
+            page_action = 'custom',
+            filter_action = 'custom',
+            filter_query = '',
+            sort_action = 'custom',
+            sort_mode = 'multi',
+            sort_by = [],
             style_table={
                 'height': '38vh',
                 'width': '44vw',
@@ -357,6 +405,12 @@ def build_visualizer(input):
     visualizer.append(html.Div(['Control Pannel'], id = 'visualizer_control_pannel', className='control-pannel'))
     visualizer.append(html.Div(['Visualization'], id = 'visualizer_output', className='dashboard-output visualization'))
     visualizer.append(dcc.Store(id='visualizer_dimensions', data={'width': None, 'height': None}))
+    #the dataset and settings of a heatmap drawn beside a binned chart, see update_heatmap
+    visualizer.append(dcc.Store(id='heatmap_args'))
+    #the chart's projection params are bound to these, see assets/projection.js
+    visualizer.append(html.Div([html.Input(id=element, type='hidden', value=PROJECTION_DEFAULTS[arg])
+                                for arg, element in PROJECTION_INPUTS.items()],
+                               id='projection_signals'))
     return visualizer
 
 @callback(
@@ -371,8 +425,7 @@ def build_visualizer_control_pannel(input):
     control_pannel.append(html.Div(['Map Aesthetics'], id='map_aesthetics_widget', className='widget dropdown-widget'))
     control_pannel.append(html.Div(['Heatmap Aesthetics'], id='heatmap_aesthetics_widget', className='widget dropdown-widget'))
     control_pannel.append(html.Div(['Filters'], id='filter_widget', className='widget dropdown-widget'))
-    for i in range(7,8):
-        control_pannel.append(html.Div([f'Widget{i}'], id=f'visualizer_widget{i}', className='widget'))
+    control_pannel.append(html.Div(['Renderer'], id='renderer_widget', className='widget dropdown-widget'))
 
     control_pannel.append(html.Div(['Viz Buttons'], id='viz_button_widget', className='widget button-widget'))
     return control_pannel
@@ -387,7 +440,7 @@ def build_projection_widget(input):
     widget.append(
         dcc.Dropdown(
             options = ['naturalEarth1', 'azimuthalEqualArea', 'mercator'],
-            value = 'naturalEarth1',
+            value = PROJECTION_DEFAULTS['projection'],
             id = 'projection_dropdown',
             className = 'widget dropdown-widget'
         )
@@ -406,7 +459,7 @@ def build_map_tools_widget(input):
         min=-179.9,
         max=179.9,
         step = 1,
-        value = 0,
+        value = PROJECTION_DEFAULTS['phi'],
         marks = None,
         tooltip={'placement': 'bottom', 'always_visible': True},
         id='phi_slider',
@@ -417,7 +470,7 @@ def build_map_tools_widget(input):
         min=-89.9,
         max=89.9,
         step = 1,
-        value = 0,
+        value = PROJECTION_DEFAULTS['theta'],
         marks = None,
         tooltip={'placement': 'bottom', 'always_visible': True},
         id='theta_slider',
@@ -428,7 +481,7 @@ def build_map_tools_widget(input):
         min=10,
         max=1000,
         step = 10,
-        value = 100,
+        value = PROJECTION_DEFAULTS['scale'],
         marks = None,
         tooltip={'placement': 'bottom', 'always_visible': True},
         id='scale_slider',
@@ -437,6 +490,16 @@ def build_map_tools_widget(input):
 
     return widget
 
+#the map tools move the drawn chart in the browser, the visualize button is only needed for other changes
+clientside_callback(
+    ClientsideFunction(namespace='map', function_name='set_projection'),
+    Output('projection_signals', 'title'),
+    Input('projection_dropdown', 'value'),
+    Input('phi_slider', 'value'),
+    Input('theta_slider', 'value'),
+    Input('scale_slider', 'value'),
+)
+
 @callback(
         Output('map_colors_widget', 'children'),
         Input('visualizer_control_pannel', 'children')
@@ -465,12 +528,11 @@ def build_map_colors_widget(input):
 
 @callback(
         Output('map_aesthetics_widget', 'children'),
-        Input('data_table', 'data'),
+        Input('dataset_id', 'data'),
         prevent_initial_callback = True
 )
-def build_map_aesthetics_widget(data):
-    df = pd.DataFrame(data)
-    cols = df.select_dtypes(include=['number', 'datetime64[ns, UTC]']).columns.tolist()
+def build_map_aesthetics_widget(dataset_id):
+    cols = dataset_columns(dataset_id)
     widget = []
     widget.append(html.H5('Size:'))
     widget.append(dcc.Dropdown(
@@ -498,14 +560,11 @@ def build_map_aesthetics_widget(data):
 
 @callback(
         Output('heatmap_aesthetics_widget', 'children'),
-        Input('data_table', 'data'),
+        Input('dataset_id', 'data'),
         prevent_initial_callback = True
 )
-def build_heatmap_aesthetics_widget(data):
-    df = pd.DataFrame(data)
-    if len(df):
-        df['time'] = pd.to_datetime(df['time'], utc=True, format='ISO8601')
-    cols = df.select_dtypes(include=['number', 'datetime64[ns, UTC]']).columns.tolist()
+def build_heatmap_aesthetics_widget(dataset_id):
+    cols = dataset_columns(dataset_id)
     widget = []
     widget.append(html.H5('X:'))
     widget.append(dcc.Dropdown(
@@ -533,14 +592,11 @@ def build_heatmap_aesthetics_widget(data):
 
 @callback(
         Output('filter_widget', 'children'),
-        Input('data_table', 'data'),
+        Input('dataset_id', 'data'),
         prevent_initial_callback=True
 )
-def build_filter_widget(data):
-    df = pd.DataFrame(data)
-    if len(df):
-        df['time'] = pd.to_datetime(df['time'], utc=True, format='ISO8601')
-    cols = df.select_dtypes(include=['number', 'datetime64[ns, UTC]']).columns.tolist()
+def build_filter_widget(dataset_id):
+    cols = dataset_columns(dataset_id)
     widget = []
     widget.append(html.H5('Filters:'))
     widget.append(dcc.Dropdown(
@@ -552,6 +608,22 @@ def build_filter_widget(data):
     ))
 
     return widget
+@callback(
+        Output('renderer_widget', 'children'),
+        Input('visualizer_control_pannel', 'children')
+)
+def build_renderer_widget(input):
+    widget = []
+    widget.append(html.H5('Renderer:'))
+    widget.append(dcc.Dropdown(
+        options=['auto', 'svg', 'canvas'] + (['webgl'] if dash_deck is not None else []),
+        value='auto',
+        id='renderer_dropdown',
+        className='dropdown'
+    ))
+
+    return widget
+
 @callback(
     Output('viz_button_widget', 'children'),
     Input('visualizer_control_pannel', 'children')
@@ -561,9 +633,11 @@ def build_viz_button_widget(input):
     widget.append(html.Button('Visualize', id='viz_button', className='button'))
     return widget
 
-@callback(
-    Output('data_table', 'data', allow_duplicate=True),
+LOAD_DEPENDENCIES = [
+    Output('dataset_id', 'data', allow_duplicate=True),
     Output('data_table', 'columns'),
+    Output('data_table', 'page_current'),
+    Output('dataset_stream', 'data', allow_duplicate=True),
     State('date_range_picker', 'start_date'),
     State('date_range_picker', 'end_date'),
     State('mag_range_slider', 'value'),
@@ -572,9 +646,10 @@ def build_viz_button_widget(input):
     State('latitude_range_slider', 'value'),
     State('longitude_range_slider', 'value'),
     Input('load_button', 'n_clicks'),
-    prevent_initial_call=True,
-)
-def update_data_table(start_date, 
+]
+
+def update_data_table(set_progress,
+                        start_date, 
                         end_date,
                         magrange,
                         sigrange,
@@ -603,15 +678,67 @@ def update_data_table(start_date,
                                maxlatitude=latrange[1],
                                minlongitude=lonrange[0],
                                maxlongitude=lonrange[1])
-        dl = DataLoader(params)
-        dl.query()
-        df = dl.preprocess()
-        columns = [{"name": col, "id": col} for col in df.columns]
-        return df.to_dict('records'), columns
+        shards = {'done': 0, 'total': 0}
+        dl = DataLoader(params, cache=CACHE, progress=lambda done, total: shards.update(done=done, total=total))
+        #reloading the same filters only downloads events added or updated since the last load
+        #otherwise the most recent shard is registered as soon as it arrives and older ones are appended
+        dataset_id, rows, shown, shown_at = None, 0, 0, time.monotonic()
+        for batch in dl.stream(CatalogStore.for_params(dl.url, params)):
+            if batch.empty:
+                continue
+            df = dl.preprocess(batch)
+            if dataset_id is None:
+                dataset_id = DATASETS.put(df)
+            else:
+                DATASETS.append(dataset_id, df)
+            rows += len(df)
+            if not shown or rows - shown >= STREAM_ROWS or time.monotonic() - shown_at >= STREAM_SECONDS:
+                set_progress((f"Loaded {shards['done']} of {shards['total']} shards, {rows} earthquakes",
+                              {'id': dataset_id, 'rows': rows}))
+                shown, shown_at = rows, time.monotonic()
+        if dataset_id is None:
+            dataset_id = DATASETS.put(dl.preprocess())
+        columns = [{"name": col, "id": col} for col in COL_TYPES]
+        return dataset_id, columns, 0, None
+
+if JOBS is not None:
+    #the job runs in its own process and registers the dataset through the shared DATASETS directory
+    #clearing while a load runs cancels it, the load button is disabled until it finishes
+    callback(*LOAD_DEPENDENCIES,
+             background=True,
+             manager=JOBS,
+             progress=[Output('count_output', 'children', allow_duplicate=True), Output('dataset_stream', 'data')],
+             cancel=[Input('clear_button', 'n_clicks')],
+             running=[(Output('load_button', 'disabled'), True, False)],
+             prevent_initial_call=True)(update_data_table)
+else:
+    @callback(*LOAD_DEPENDENCIES, prevent_initial_call=True)
+    def update_data_table_inline(*args):
+        return update_data_table(lambda progress: None, *args)
+
+@callback(
+    Output('data_table', 'data'),
+    Output('data_table', 'page_count'),
+    Input('dataset_id', 'data'),
+    Input('dataset_stream', 'data'),
+    Input('data_table', 'page_current'),
+    Input('data_table', 'page_size'),
+    Input('data_table', 'sort_by'),
+    Input('data_table', 'filter_query'),
+)
+def update_table_page(dataset_id, stream, page_current, page_size, sort_by, filter_query):
+    #while a load runs the table pages through the events it has registered so far
+    if stream:
+        dataset_id = stream['id']
+    if not dataset_id:
+        return [], 1
+    rows, page_count = DATASETS.page(dataset_id, page_current, page_size, sort_by, filter_query)
+    return rows.to_dict('records'), page_count
 
 @callback(
-    Output('data_table', 'data', allow_duplicate=True),
+    Output('dataset_id', 'data', allow_duplicate=True),
     Output('count_output', 'children', allow_duplicate=True),
+    Output('dataset_stream', 'data', allow_duplicate=True),
     Input('clear_button', 'n_clicks'),
     prevent_initial_call=True,
     allow_duplicate = True
@@ -620,7 +747,7 @@ def clear_output(n_clicks):
     if not n_clicks or n_clicks ==0:
         raise PreventUpdate
     else:
-        return pd.DataFrame().to_dict('records'), 'Click Count'
+        return None, 'Click Count', None
 
 @callback(
     Output('count_output', 'children', allow_duplicate=True),
@@ -663,13 +790,17 @@ def count_earthquakes(start_date,
                                maxlatitude=latrange[1],
                                minlongitude=lonrange[0],
                                maxlongitude=lonrange[1])
-        dl = DataLoader(params)
+        dl = DataLoader(params, cache=CACHE)
         return f'Found {dl.count()} earthquakes' 
 
 
+#the hidden projection inputs are set with the spec, the chart reads its starting projection from them
 @callback(
     Output('visualizer_output', 'children'),
-    State('data_table', 'derived_virtual_data'),
+    *[Output(element, 'value') for element in PROJECTION_INPUTS.values()],
+    Output('heatmap_args', 'data'),
+    State('dataset_id', 'data'),
+    State('data_table', 'filter_query'),
     State('projection_dropdown', 'value'),
     State('phi_slider','value'),
     State('theta_slider', 'value'),
@@ -684,11 +815,14 @@ def count_earthquakes(start_date,
     State('y_dropdown', 'value'),
     State('heatmap_color_dropdown', 'value'),
     State('filter_dropdown', 'value'),
+    State('renderer_dropdown', 'value'),
     Input('visualizer_dimensions', 'data'),
     Input('viz_button', 'n_clicks'),
+    Input('dataset_stream', 'data'),
     prevent_initial_call = True
 )
-def update_visualizer(data,
+def update_visualizer(dataset_id,
+                      filter_query,
                       projection,
                       phi,
                       theta,
@@ -703,8 +837,10 @@ def update_visualizer(data,
                       y_var,
                       heatmap_color,
                       filter_vars,
+                      renderer,
                       dimensions,
-                      n_clicks):
+                      n_clicks,
+                      stream):
     # Extract dimensions with fallbacks
     if dimensions and isinstance(dimensions, dict):
         width = dimensions.get('width')
@@ -719,10 +855,30 @@ def update_visualizer(data,
     if height is None or height <= 0:
         height = 200  # Fallback height
 
-    df = pd.DataFrame(data)
-    df['time'] = pd.to_datetime(df['time'], utc=True,format='ISO8601')
-    dv = DataVisualizer(df)
-    spec = dv.create_chart(
+    #a cleared dropdown would leave the projection type empty
+    projection = projection or PROJECTION_DEFAULTS['projection']
+
+    #a chart already shown is redrawn as a load streams in more events
+    if dash.ctx.triggered_id == 'dataset_stream' and not n_clicks:
+        raise PreventUpdate
+    if stream:
+        dataset_id = stream['id']
+    if not dataset_id:
+        raise PreventUpdate
+    #the visualizer shows the rows that pass the table filters
+    df = DATASETS.select(dataset_id, filter_query=filter_query)
+    if df.empty:
+        raise PreventUpdate
+    #a streamed dataset only grows, so its filtered length tells its versions apart
+    dv = DataVisualizer(df, version=(dataset_id, filter_query, len(df)))
+    renderer = dv.renderer(renderer or 'auto')
+    if renderer == 'webgl' and dash_deck is None:
+        renderer = 'canvas'
+    #a binned chart's heatmap is aggregated on the server, it is drawn on its own so it can follow the brushes
+    binned = dv.binned()
+    heatmap = {'width': width, 'height': height, 'heatmap_x': x_var, 'heatmap_y': y_var,
+               'heatmap_color': heatmap_color, 'background': map_background}
+    spec = dv.create_spec(
         width=width,
         height=height,
         projection=projection,
@@ -739,9 +895,45 @@ def update_visualizer(data,
         heatmap_color=heatmap_color,
         filter_vars=filter_vars,
         background = map_background,
-    ).to_dict()
-    return dvc.Vega(
+        draw_map = renderer != 'webgl',
+        heatmap = not binned,
+    )
+    chart = dvc.Vega(
         id='map',
-        opt={"renderer": 'svg', 'actions': False},
-        spec=spec
+        opt={"renderer": 'canvas' if renderer == 'webgl' else renderer, 'actions': False},
+        spec=spec,
+        signalsToObserve=brush_names(filter_vars or []) if binned else [],
+        debounceWait=200,
+    )
+    args = None
+    if binned:
+        args = {'id': dataset_id, 'filter_query': filter_query, 'heatmap': heatmap}
+        chart = html.Div([chart, dvc.Vega(id='heatmap_chart', opt={'renderer': 'canvas', 'actions': False},
+                                          spec=dv.create_heatmap_spec(**heatmap))],
+                         style={'display': 'flex'})
+    if renderer != 'webgl':
+        return chart, projection, phi, theta, scale, args
+    #every event is drawn on the webgl map, the histograms and heatmap follow below it
+    deck = dash_deck.DeckGL(
+        data=dv.create_deck_spec(color_var=color_var, size_var=size_var, phi=phi, theta=theta, scale=scale),
+        id='deck_map',
+        tooltip=DECK_TOOLTIP,
+        style={'position': 'relative', 'width': '100%', 'height': f'{int(.6 * height)}px'},
     )
+    return [deck, chart], projection, phi, theta, scale, args
+
+#the brushes of a binned chart are observed, its heatmap is aggregated again over the events inside them
+@callback(
+    Output('heatmap_chart', 'spec'),
+    Input('map', 'signalData'),
+    State('heatmap_args', 'data'),
+    prevent_initial_call = True
+)
+def update_heatmap(signals, args):
+    if not args:
+        raise PreventUpdate
+    df = DATASETS.select(args['id'], filter_query=args['filter_query'])
+    if df.empty:
+        raise PreventUpdate
+    dv = DataVisualizer(df, version=(args['id'], args['filter_query'], len(df)))
+    return dv.create_heatmap_spec(ranges=brush_ranges(signals), **args['heatmap'])
@@ -0,0 +1,52 @@
+import os
+import json
+import sys
+import subprocess
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Polygon, MultiPolygon
+from shapely.geometry import shape
+from Basemap import ASSETS_DIR, BASEMAP_OBJECT, basemap_file, basemap_url, encode_topology, decode_topology
+
+
+def decode_ring(topology, index):
+    #absolute lon/lat positions of an arc
+    q = np.cumsum(np.array(topology['arcs'][index]), axis=0)
+    return q * topology['transform']['scale'] + topology['transform']['translate']
+
+
+def test_encode_topology_round_trip():
+    square = Polygon([(0, 0), (0, 10), (10, 10), (10, 0)], holes=[[(2, 2), (2, 4), (4, 4), (4, 2)]])
+    islands = MultiPolygon([Polygon([(20, 20), (21, 20), (21, 21)]), Polygon([(30, -5), (31, -5), (31, -4)])])
+    gdf = gpd.GeoDataFrame({'name': ['square', 'islands'], 'iso_a3': ['SQR', 'ISL']},
+                           geometry=[square, islands], crs=4326)
+    topology = encode_topology(gdf)
+    square_obj, islands_obj = topology['objects'][BASEMAP_OBJECT]['geometries']
+    assert square_obj['type'] == 'Polygon' and square_obj['id'] == 'SQR'
+    assert islands_obj['type'] == 'MultiPolygon' and islands_obj['properties'] == {'name': 'islands'}
+    exterior = Polygon(decode_ring(topology, square_obj['arcs'][0][0]))
+    hole = Polygon(decode_ring(topology, square_obj['arcs'][1][0]))
+    assert abs(exterior.area - 100) < 0.1 and abs(hole.area - 4) < 0.1
+    #exterior rings are clockwise
+    assert not exterior.exterior.is_ccw
+    json.dumps(topology)
+    #decoded back to geojson for renderers without topojson support
+    square_feature, islands_feature = decode_topology(topology)['features']
+    assert abs(shape(square_feature['geometry']).area - 96) < 0.1
+    assert len(shape(islands_feature['geometry']).geoms) == 2
+
+
+def test_bundled_basemaps():
+    #the zoomed out map uses the coarse basemap, zooming in switches to the full 110m one
+    assert basemap_file(100) == 'world-110m-coarse.json'
+    assert basemap_file(400) == 'world-110m.json'
+    with open(os.path.join(ASSETS_DIR, 'world-110m.json')) as f:
+        topology = json.load(f)
+    assert len(topology['objects'][BASEMAP_OBJECT]['geometries']) > 170
+    assert basemap_url('world-110m.json').startswith('/assets/world-110m.json?m=')
+
+
+def test_reading_needs_no_geopandas():
+    #the apps only read the bundled basemaps, geopandas and shapely are loaded to generate them
+    code = "import sys, Basemap; assert not {'geopandas', 'shapely'} & set(sys.modules)"
+    subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
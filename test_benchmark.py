@@ -0,0 +1,60 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from DataLoader import DataLoader, RequestParams, COL_TYPES, RAW_TYPES, parse_geojson
+
+#benchmarks for the load path, run with the rest of the suite when pytest-benchmark is installed
+#compare runs with: pytest test_benchmark.py --benchmark-autosave --benchmark-compare
+pytest.importorskip('pytest_benchmark')
+
+
+def synthetic_frame(n: int) -> pd.DataFrame:
+    #n random events with the RAW_TYPES columns parse_geojson produces
+    rng = np.random.default_rng(0)
+    time = rng.integers(0, 50 * 365 * 24 * 3600 * 1000, n)
+    mag = rng.uniform(0, 9, n)
+    return pd.DataFrame({
+        'id': np.array([f'ev{i:07d}' for i in range(n)], dtype=object),
+        'place': np.array(['somewhere'] * n, dtype=object),
+        'time': time,
+        'lat': rng.uniform(-90, 90, n),
+        'lon': rng.uniform(-180, 180, n),
+        'mag': mag,
+        'sig': (mag * 100).astype('int64'),
+        'depth': rng.uniform(-5, 700, n),
+        'tsunami': rng.random(n) < 0.01,
+        'cdi': np.where(rng.random(n) < 0.5, np.nan, rng.uniform(1, 9, n)),
+        'alert': np.array([None] * n, dtype=object),
+        'updated': time + 60000,
+    })[list(RAW_TYPES)]
+
+
+def synthetic_geojson(df: pd.DataFrame) -> bytes:
+    #the usgs geojson body that parses back into df
+    features = [{
+        'type': 'Feature',
+        'id': row.id,
+        'properties': {'mag': row.mag, 'place': row.place, 'time': row.time, 'updated': row.updated,
+                       'tsunami': int(row.tsunami), 'sig': row.sig,
+                       'cdi': None if np.isnan(row.cdi) else row.cdi, 'alert': row.alert},
+        'geometry': {'type': 'Point', 'coordinates': [row.lon, row.lat, row.depth]},
+    } for row in df.itertuples()]
+    return json.dumps({'type': 'FeatureCollection', 'metadata': {'count': len(features)}, 'features': features}).encode()
+
+
+@pytest.mark.parametrize('n', [1_000, 20_000, 1_000_000])
+def test_preprocess(benchmark, n):
+    dl = DataLoader(RequestParams())
+    dl.df = synthetic_frame(n)
+    df = benchmark(dl.preprocess)
+    assert len(df) == n
+    assert list(df.columns) == list(COL_TYPES)
+
+
+#a 1M feature response is several hundred MB of json, too large to build for every run
+@pytest.mark.parametrize('n', [1_000, 20_000])
+def test_parse_geojson(benchmark, n):
+    body = synthetic_geojson(synthetic_frame(n))
+    df = benchmark(parse_geojson, body)
+    assert len(df) == n
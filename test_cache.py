@@ -0,0 +1,98 @@
+import time
+from datetime import datetime, timedelta, timezone
+from DataLoader import RequestParams as RP
+from DataLoader import DataLoader, make_session, DT_FORMAT
+from QueryCache import QueryCache, params_key, is_immutable
+import pandas as pd
+
+PAST = RP(starttime='2020-01-01 00:00:00', endtime='2020-01-02 00:00:00', minmagnitude=None)
+LIVE = RP(starttime='2020-01-01 00:00:00', endtime='2999-01-01 00:00:00', minmagnitude=None)
+URL = 'http://localhost/query'
+
+
+def make_frame(n):
+    return pd.DataFrame({'id': [f'ev{i}' for i in range(n)], 'mag': [1.0] * n})
+
+
+def test_params_key_is_canonical():
+    assert params_key(URL, RP(minmagnitude=6)) == params_key(URL, RP(minmagnitude=6.0))
+    assert params_key(URL, RP(minmagnitude=6)) != params_key(URL, RP(minmagnitude=5))
+    assert params_key(URL, PAST) != params_key(URL + 'x', PAST)
+
+
+def test_is_immutable():
+    assert is_immutable(PAST)
+    assert not is_immutable(LIVE)
+    assert not is_immutable(RP(endtime=None))
+    #a window that just ended may still be revised
+    recent = datetime.strftime(datetime.now(timezone.utc) - timedelta(hours=1), DT_FORMAT)
+    assert not is_immutable(RP(starttime=PAST.starttime, endtime=recent))
+
+
+def test_frame_round_trip(tmp_path):
+    cache = QueryCache(str(tmp_path))
+    assert cache.get_frame(URL, PAST) is None
+    cache.put_frame(URL, PAST, make_frame(10))
+    df = cache.get_frame(URL, PAST)
+    assert len(df) == 10
+    #a new instance reads the same entries from disk
+    assert len(QueryCache(str(tmp_path)).get_frame(URL, PAST)) == 10
+    info = cache.info()
+    assert info['hits'] == 1 and info['misses'] == 1 and info['entries'] == 1
+
+
+def test_ttl(tmp_path):
+    cache = QueryCache(str(tmp_path), ttl=0)
+    cache.put_count(URL, LIVE, 5)
+    cache.put_count(URL, PAST, 7)
+    time.sleep(0.01)
+    assert cache.get_count(URL, LIVE) is None
+    #past windows never expire
+    assert cache.get_count(URL, PAST) == 7
+    assert cache.info()['expired'] == 1
+
+
+def test_lru_eviction(tmp_path):
+    cache = QueryCache(str(tmp_path))
+    params = [RP(starttime=PAST.starttime, endtime=PAST.endtime, minmagnitude=m) for m in range(3)]
+    cache.put_frame(URL, params[0], make_frame(100))
+    cache.max_bytes = int(cache.size() * 2.5)
+    cache.put_frame(URL, params[1], make_frame(100))
+    cache.get_frame(URL, params[0])
+    cache.put_frame(URL, params[2], make_frame(100))
+    assert cache.get_frame(URL, params[1]) is None
+    assert cache.get_frame(URL, params[0]) is not None
+    assert cache.info()['evictions'] == 1
+    assert cache.size() <= cache.max_bytes
+
+
+def test_loader_uses_cache(tmp_path, usgs_stub):
+    cache = QueryCache(str(tmp_path))
+    def loader():
+        return DataLoader(PAST, url=usgs_stub.url, session=make_session(), cache=cache)
+    assert loader().count() == 145
+    assert len(loader().query()) == 145
+    assert loader().count() == 145
+    assert len(loader().query()) == 145
+    assert usgs_stub.hits == {'count': 1, 'query': 1}
+
+
+def test_shared_between_processes(tmp_path):
+    #two caches on one directory, as two dash workers would have
+    first, second = QueryCache(str(tmp_path)), QueryCache(str(tmp_path))
+    params = [RP(starttime=PAST.starttime, endtime=PAST.endtime, minmagnitude=m) for m in range(3)]
+    first.put_frame(URL, params[0], make_frame(100))
+    second.put_frame(URL, params[1], make_frame(100))
+    #neither write overwrote the other
+    assert first.get_frame(URL, params[1]) is not None
+    assert QueryCache(str(tmp_path)).info()['entries'] == 2
+    #the hit above is saved, so the entry first wrote is now the least recently used one,
+    #and the budget counts the frames of both
+    first.max_bytes = int(first.size() * 1.25)
+    first.put_frame(URL, params[2], make_frame(100))
+    assert second.get_frame(URL, params[0]) is None
+    assert second.get_frame(URL, params[1]) is not None
+    assert len(list(tmp_path.glob('*.parquet'))) == 2
+    #an entry removed by one cache stays removed for the other
+    second.clear()
+    assert first.info()['entries'] == 0
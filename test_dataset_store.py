@@ -0,0 +1,167 @@
+import os
+import time
+import pandas as pd
+from pytest import raises
+from DatasetStore import DatasetStore, filter_mask
+from DataLoader import RequestParams
+from test_visualizer import make_large_catalog
+from test_visualizer import make_catalog
+
+
+def test_put_get(tmp_path):
+    store = DatasetStore(str(tmp_path))
+    df = make_catalog(10)
+    dataset_id = store.put(df)
+    assert dataset_id in store
+    got = store.get(dataset_id)
+    #served most recent first
+    pd.testing.assert_frame_equal(got, df.iloc[::-1].reset_index(drop=True))
+    with raises(KeyError):
+        store.get('unknown')
+
+
+def test_shared_through_disk(tmp_path):
+    df = make_catalog(10)
+    dataset_id = DatasetStore(str(tmp_path)).put(df)
+    #another worker process only sees the spilled files
+    other = DatasetStore(str(tmp_path))
+    pd.testing.assert_frame_equal(other.get(dataset_id), df.iloc[::-1].reset_index(drop=True))
+    assert other.info()['loads'] == 1
+
+
+def test_memory_budget(tmp_path):
+    store = DatasetStore(str(tmp_path))
+    first = store.put(make_catalog(100))
+    store.max_bytes = int(store.info()['bytes'] * 2.5)
+    second = store.put(make_catalog(100))
+    store.get(first)
+    store.put(make_catalog(100))
+    info = store.info()
+    assert info['evictions'] == 1 and info['datasets'] == 2
+    assert info['bytes'] <= store.max_bytes
+    #the dropped frame is still served from disk
+    assert len(store.get(second)) == 100
+
+
+def test_discard(tmp_path):
+    store = DatasetStore(str(tmp_path))
+    dataset_id = store.put(make_catalog(3))
+    store.discard(dataset_id)
+    assert dataset_id not in store
+
+
+def test_prune_keeps_datasets_in_use(tmp_path):
+    store = DatasetStore(str(tmp_path), max_age=60)
+    paged, idle = store.put(make_catalog(3)), store.put(make_catalog(3))
+    day_ago = time.time() - 24 * 60 * 60
+    for dataset_id in (paged, idle):
+        for path in (tmp_path / dataset_id / 'part-00000.arrow', tmp_path / dataset_id):
+            os.utime(path, (day_ago, day_ago))
+    #a session still paging through a dataset keeps it, and marking it read does not map the table again
+    store.page(paged, 0, 2)
+    loads = store.info()['loads']
+    store.prune()
+    assert paged in store and idle not in store
+    store.page(paged, 1, 2)
+    assert store.info()['loads'] == loads
+
+
+def test_filter_mask():
+    df = make_catalog(10)
+    assert filter_mask(df, None) is None
+    assert filter_mask(df, '{mag} s>= 4.5').tolist() == [False] * 5 + [True] * 5
+    assert filter_mask(df, '{mag} ge 4.5 && {sig} < 8').sum() == 3
+    assert filter_mask(df, '{place} icontains "PLACE 1"').sum() == 1
+    assert filter_mask(df, '{place} scontains "PLACE 1"').sum() == 0
+    assert filter_mask(df, '{time} datestartswith 2023-01-0').sum() == 9
+    assert filter_mask(df, '{time} datestartswith 2023-01-02T00').sum() == 1
+    assert filter_mask(df, '{time} datestartswith "2023-01-02 00"').sum() == 1
+    assert filter_mask(df, '{time} > 2023-01-08').sum() == 2
+    assert filter_mask(df, '{mag} > abc').sum() == 0
+    #clauses on unknown columns are ignored
+    assert filter_mask(df, '{nope} > 1').all()
+
+
+def test_page_sort_filter(tmp_path):
+    store = DatasetStore(str(tmp_path))
+    dataset_id = store.put(make_catalog(10))
+    rows, page_count = store.page(dataset_id, 0, 4)
+    assert page_count == 3
+    assert rows['sig'].tolist() == [9, 8, 7, 6]
+
+    sort_by = [{'column_id': 'mag', 'direction': 'asc'}]
+    rows, page_count = store.page(dataset_id, 1, 4, sort_by, '{sig} >= 2')
+    assert page_count == 2
+    assert rows['sig'].tolist() == [6, 7, 8, 9]
+    #the sort index is computed once and reused in both directions
+    assert list(store.sort_indexes) == [(dataset_id, 'mag')]
+    rows, _ = store.page(dataset_id, 0, 3, [{'column_id': 'mag', 'direction': 'desc'}])
+    assert rows['sig'].tolist() == [9, 8, 7]
+
+    #a page past the end of a filtered table falls back to the last page
+    rows, page_count = store.page(dataset_id, 5, 4, None, '{sig} < 3')
+    assert page_count == 1 and rows['sig'].tolist() == [2, 1, 0]
+
+    multi = [{'column_id': 'tsunami', 'direction': 'asc'}, {'column_id': 'sig', 'direction': 'desc'}]
+    assert store.select(dataset_id, multi)['sig'].tolist() == [9, 7, 5, 3, 1, 8, 6, 4, 2, 0]
+
+    #another process pages through the mapped table without converting the whole frame
+    other = DatasetStore(str(tmp_path))
+    rows, page_count = other.page(dataset_id, 1, 4, sort_by, '{sig} >= 2')
+    assert page_count == 2 and rows['sig'].tolist() == [6, 7, 8, 9]
+    assert other.select(dataset_id, multi)['sig'].tolist() == [9, 7, 5, 3, 1, 8, 6, 4, 2, 0]
+    assert other.info()['datasets'] == 0
+
+
+def test_sort_missing_values_last(tmp_path):
+    store = DatasetStore(str(tmp_path))
+    df = make_catalog(10)
+    df.loc[[3, 7], 'mag'] = float('nan')
+    dataset_id = store.put(df)
+    for direction in ('asc', 'desc'):
+        rows = store.select(dataset_id, [{'column_id': 'mag', 'direction': direction}])
+        assert rows['mag'].isna().tolist() == [False] * 8 + [True] * 2
+        assert rows['mag'].iloc[:8].is_monotonic_increasing == (direction == 'asc')
+    rows, _ = store.page(dataset_id, 0, 3, [{'column_id': 'mag', 'direction': 'desc'}])
+    assert rows['mag'].tolist() == df['mag'].dropna().sort_values(ascending=False).iloc[:3].tolist()
+
+
+def test_within(tmp_path):
+    store = DatasetStore(str(tmp_path))
+    dataset_id = store.put(make_large_catalog(2000))
+    params = RequestParams(minlatitude=10, maxlatitude=40, minlongitude=100, maxlongitude=200)
+    df = store.within(dataset_id, params)
+    assert len(df) and df['lat'].between(10, 40).all()
+    assert ((df['lon'] >= 100) | (df['lon'] <= -160)).all()
+    assert store.spatial_index(dataset_id) is store.spatial_index(dataset_id)
+    #the default world rectangle keeps every event
+    assert len(store.within(dataset_id, RequestParams())) == 2000
+
+
+def test_append(tmp_path):
+    store = DatasetStore(str(tmp_path))
+    df = make_catalog(30)
+    #a streamed load registers the most recent events first and appends older ones
+    dataset_id = store.put(df.iloc[20:])
+    other = DatasetStore(str(tmp_path))
+    assert other.page(dataset_id, 0, 5)[1] == 2
+    store.append(dataset_id, df.iloc[10:20])
+    store.append(dataset_id, df.iloc[:10])
+    expected = df.iloc[::-1].reset_index(drop=True)
+    pd.testing.assert_frame_equal(store.get(dataset_id), expected)
+    #the other process notices the dataset grew and drops what it built for the smaller one
+    pd.testing.assert_frame_equal(other.get(dataset_id), expected)
+    assert other.page(dataset_id, 0, 5)[1] == 6
+
+
+def test_append_mixed_types(tmp_path):
+    store = DatasetStore(str(tmp_path))
+    df = make_catalog(20)
+    #a batch without alerts has a null alert column, the next one strings
+    first, second = df.iloc[10:].assign(alert=None), df.iloc[:10].assign(alert='green')
+    dataset_id = store.put(first)
+    store.append(dataset_id, second)
+    got = DatasetStore(str(tmp_path)).get(dataset_id)
+    assert got['alert'].tolist() == [None] * 10 + ['green'] * 10
+    rows, _ = DatasetStore(str(tmp_path)).page(dataset_id, 1, 10)
+    assert rows['alert'].tolist() == ['green'] * 10
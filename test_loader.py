@@ -1,7 +1,17 @@
 from DataLoader import RequestParams as RP
-from DataLoader import InvalidParamError, DT_FORMAT, DataLoader, COL_TYPES
-from datetime import datetime, timedelta
+from DataLoader import InvalidParamError, DT_FORMAT, DataLoader, COL_TYPES, RAW_TYPES, make_session, parse_geojson, load_catalog, save_catalog
+from datetime import datetime, timedelta, timezone
+from dataclasses import replace
 from pytest import raises
+import pytest
+import json
+from concurrent.futures import ThreadPoolExecutor
+import DataLoader as DataLoaderModule
+import pandas as pd
+from CatalogStore import CatalogStore
+from QueryCache import QueryCache
+from CatalogServer import LocalCatalog, SERVER_PATH, serve
+from conftest import START, make_event
 
 starttime = datetime(year=2025,month=11,day=20)
 endtime = datetime(year=2025,month=11,day=21)
@@ -12,6 +22,21 @@ end = datetime.strftime(endtime, DT_FORMAT)
 TEST_PARAMS = RP(starttime=start, endtime=end, minmagnitude=5)
 
 
+@pytest.fixture(scope='class')
+def local_api():
+    #a local server holding 15 events on the day of TEST_PARAMS, 6 of them of magnitude 5 or more
+    shift = int((starttime.replace(tzinfo=timezone.utc) - START).total_seconds() * 1000)
+    events = [make_event(i) for i in range(15)]
+    for event in events:
+        event['properties']['time'] += shift
+        event['properties']['updated'] += shift
+    server = serve(LocalCatalog(parse_geojson(json.dumps({'features': events}).encode())), port=0, background=True)
+    server.url = f'http://127.0.0.1:{server.server_port}{SERVER_PATH}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 
 class TestRequestParams:
     invalid_format_params: RP = RP(format='goojson')
@@ -30,18 +55,18 @@ class TestRequestParams:
 
 class TestDataLoader:
     #test DataLoader.count 
-    def test_count(self): 
-        dl = DataLoader(TEST_PARAMS) 
+    def test_count(self, local_api): 
+        dl = DataLoader(TEST_PARAMS, url=local_api.url) 
         assert dl.count() == 6
 
     #test DataLoader.query
-    def test_query(self):
-        dl = DataLoader(TEST_PARAMS) 
+    def test_query(self, local_api):
+        dl = DataLoader(TEST_PARAMS, url=local_api.url) 
         assert len(dl.query()) == 6
     
-    def test_preprocess(self):
+    def test_preprocess(self, local_api):
         #test that the dataframe has the correct columns and datatypes required by the visualizer
-        dl = DataLoader(TEST_PARAMS)
+        dl = DataLoader(TEST_PARAMS, url=local_api.url)
         dl.query()
         df = dl.preprocess()
         
@@ -52,3 +77,318 @@ class TestDataLoader:
         
         for col, expected_type in COL_TYPES.items():
             assert df[col].dtype == expected_type, f"Column '{col}' must be of type {expected_type}"
+
+
+class TestParseGeoJSON:
+    BODY = json.dumps({'type': 'FeatureCollection', 'metadata': {'count': 2}, 'features': [
+        {'type': 'Feature', 'id': 'a', 'geometry': {'type': 'Point', 'coordinates': [1.5, -2.5, 10.0]},
+         'properties': {'mag': 5.1, 'place': 'here', 'time': 1700000000000, 'updated': 1700000001000,
+                        'tsunami': 1, 'sig': 400, 'cdi': 3.4, 'alert': 'green'}},
+        {'type': 'Feature', 'id': 'b', 'geometry': {'type': 'Point', 'coordinates': [3.0, 4.0]},
+         'properties': {'mag': None, 'place': None, 'time': 1600000000000, 'updated': 1600000000000,
+                        'tsunami': 0, 'sig': None, 'cdi': None, 'alert': None}},
+    ]}).encode()
+
+    def test_columns_and_types(self):
+        df = parse_geojson(self.BODY)
+        assert list(df.columns) == list(RAW_TYPES)
+        for col, dtype in RAW_TYPES.items():
+            assert df[col].dtype == dtype, col
+        assert df['id'].tolist() == ['a', 'b']
+        assert df['lon'].tolist() == [1.5, 3.0]
+        assert df['tsunami'].tolist() == [True, False]
+        assert df['mag'].isna().tolist() == [False, True]
+        assert df['depth'].isna().tolist() == [False, True]
+        assert df['sig'].tolist() == [400, 0]
+
+    def test_without_ijson(self, monkeypatch):
+        monkeypatch.setattr(DataLoaderModule, 'ijson', None)
+        df = parse_geojson(self.BODY)
+        assert df['id'].tolist() == ['a', 'b']
+        assert df['cdi'].isna().tolist() == [False, True]
+
+    def test_empty(self):
+        df = parse_geojson(b'{"type": "FeatureCollection", "features": []}')
+        assert df.empty
+        assert list(df.columns) == list(RAW_TYPES)
+
+
+class TestShardedQuery:
+    #a fake catalog of one event every 10 minutes, served by replacing count and fetch
+    EVENTS = pd.date_range('2020-01-01', '2021-01-01', freq='10min')
+
+    def events_in(self, params):
+        start = datetime.strptime(params.starttime, DT_FORMAT)
+        end = datetime.strptime(params.endtime, DT_FORMAT)
+        return self.EVENTS[(self.EVENTS >= start) & (self.EVENTS <= end)]
+
+    def fake_loader(self):
+        params = RP(starttime='2020-01-01 00:00:00', endtime='2021-01-01 00:00:00')
+        dl = DataLoader(params)
+        dl.count = lambda params=None: len(self.events_in(params or dl.params))
+        def fetch(params):
+            times = self.events_in(params)
+            return pd.DataFrame({'id': [f'ev{int(t.timestamp())}' for t in times],
+                                 'time': times.astype('int64') // 10**6})
+        dl.fetch = fetch
+        return dl
+
+    def test_shards_fit_limit(self):
+        dl = self.fake_loader()
+        shards = dl.shard(max_records=5000)
+        assert len(shards) > 1
+        for params in shards:
+            assert dl.count(params) <= 5000
+
+    def test_query_sharded(self):
+        dl = self.fake_loader()
+        df = dl.query_sharded(max_records=5000)
+        assert len(df) == len(self.EVENTS)
+        assert df['id'].is_unique
+        assert df['time'].is_monotonic_decreasing
+
+
+class TestConcurrentFetch:
+    #the stub catalog holds 5000 events, one every 10 minutes from 2020-01-01
+    PARAMS = RP(starttime='2020-01-01 00:00:00', endtime='2020-02-05 00:00:00', minmagnitude=None)
+
+    def loader(self, usgs_stub, max_workers=4):
+        return DataLoader(self.PARAMS, url=usgs_stub.url,
+                          session=make_session(max_workers, backoff=0.01),
+                          max_workers=max_workers)
+
+    def test_count(self, usgs_stub):
+        assert self.loader(usgs_stub).count() == 5000
+
+    def test_retry(self, usgs_stub):
+        usgs_stub.fail = 2
+        assert self.loader(usgs_stub).count() == 5000
+        assert usgs_stub.hits['count'] == 3
+
+    def test_retry_exhausted(self, usgs_stub):
+        usgs_stub.fail = 100
+        usgs_stub.fail_status = 429
+        with raises(Exception, match='HTTP Request Error: 429'):
+            self.loader(usgs_stub).count()
+
+    def test_query_sharded(self, usgs_stub):
+        df = self.loader(usgs_stub).query_sharded(max_records=500)
+        assert len(df) == 5000
+        assert df['id'].is_unique
+
+    def test_query_sharded_limit(self, usgs_stub):
+        #the limit caps the combined events instead of every shard
+        dl = self.loader(usgs_stub)
+        everything = dl.query_sharded(max_records=500)
+        dl.params = replace(self.PARAMS, limit=700)
+        df = dl.query_sharded(max_records=500)
+        assert len(df) == 700
+        assert list(df['id']) == list(everything['id'][:700])
+
+    def test_progress(self, usgs_stub):
+        reports = []
+        dl = self.loader(usgs_stub)
+        dl.progress = lambda done, total: reports.append((done, total))
+        dl.query_sharded(max_records=500)
+        total = reports[-1][1]
+        assert total >= 10
+        assert reports == [(i, total) for i in range(1, total + 1)]
+
+    def test_shared_session_per_pool_size(self, usgs_stub):
+        #a loader with more workers gets a larger pool instead of the one made for the first loader
+        small = DataLoader(self.PARAMS, url=usgs_stub.url, max_workers=2)
+        large = DataLoader(self.PARAMS, url=usgs_stub.url, max_workers=8)
+        assert small.session is DataLoader(self.PARAMS, max_workers=2).session
+        assert small.session is not large.session
+        assert large.session.get_adapter(usgs_stub.url)._pool_maxsize == 8
+
+    def test_identical_requests_coalesced(self, usgs_stub):
+        #several users counting and loading the same filters at once cause one request each
+        usgs_stub.delay = 0.2
+        params = RP(starttime='2020-01-01 00:00:00', endtime='2020-01-02 00:00:00', minmagnitude=None)
+        with ThreadPoolExecutor(6) as pool:
+            counts = list(pool.map(lambda i: self.loader(usgs_stub).count(params), range(6)))
+            frames = list(pool.map(lambda i: self.loader(usgs_stub).fetch(params), range(6)))
+        assert counts == [145] * 6 and all(len(df) == 145 for df in frames)
+        assert usgs_stub.hits == {'count': 1, 'query': 1}
+
+    def test_shards_fetched_concurrently(self, usgs_stub):
+        usgs_stub.delay = 0.05
+        self.loader(usgs_stub, max_workers=8).query_sharded(max_records=500)
+        assert usgs_stub.max_active > 1
+        assert usgs_stub.max_active <= 8
+
+
+class TestSync:
+    PARAMS = RP(starttime='2020-01-01 00:00:00', endtime='2020-01-03 00:00:00', minmagnitude=None)
+
+    def loader(self, usgs_stub, params=None):
+        return DataLoader(params or self.PARAMS, url=usgs_stub.url, session=make_session())
+
+    def test_sync_fetches_only_updates(self, usgs_stub, tmp_path):
+        store = CatalogStore(str(tmp_path))
+        assert len(self.loader(usgs_stub).sync(store)) == 289
+
+        #nothing changed, only the delta count is requested
+        hits = dict(usgs_stub.hits)
+        assert len(self.loader(usgs_stub).sync(store)) == 289
+        assert usgs_stub.hits['query'] == hits['query']
+
+        #an event is revised upstream
+        event = usgs_stub.events[10]
+        event['properties']['mag'] = 9.9
+        event['properties']['updated'] = int(datetime.now().timestamp() * 1000)
+        df = self.loader(usgs_stub).sync(store)
+        assert len(df) == 289
+        assert df['id'].is_unique
+        assert df.loc[df['id'] == event['id'], 'mag'].item() == 9.9
+        assert store.high_water_mark == event['properties']['updated']
+
+    def test_sync_rolling_window(self, usgs_stub, tmp_path):
+        store = CatalogStore(str(tmp_path))
+        self.loader(usgs_stub).sync(store)
+        later = RP(starttime='2020-01-02 00:00:00', endtime='2020-01-04 00:00:00', minmagnitude=None)
+        df = self.loader(usgs_stub, later).sync(store)
+        assert len(df) == 289
+        assert len(store.load()) == 289
+
+    def test_sync_later_endtime(self, usgs_stub, tmp_path):
+        #extending the window fetches the events in the new part even though they are older than the high-water mark
+        store = CatalogStore(str(tmp_path))
+        self.loader(usgs_stub).sync(store)
+        later = RP(starttime=self.PARAMS.starttime, endtime='2020-01-10 00:00:00', minmagnitude=None)
+        df = self.loader(usgs_stub, later).sync(store)
+        fresh = self.loader(usgs_stub, later).query()
+        assert len(df) == len(fresh) == 1297
+        assert df['id'].is_unique
+        assert store.endtime == later.endtime
+
+    def test_sync_resets_on_new_filters(self, usgs_stub, tmp_path):
+        store = CatalogStore(str(tmp_path))
+        self.loader(usgs_stub).sync(store)
+        filtered = RP(starttime=self.PARAMS.starttime, endtime=self.PARAMS.endtime, minmagnitude=5)
+        df = self.loader(usgs_stub, filtered).sync(store)
+        assert (df['mag'] >= 5).all()
+
+    def test_stream(self, usgs_stub, tmp_path):
+        store = CatalogStore(str(tmp_path))
+        dl = self.loader(usgs_stub)
+        batches = list(dl.stream(store, max_records=50))
+        assert len(batches) > 1
+        #most recent shard first and no event twice
+        assert all(older['time'].max() <= newer['time'].min() for newer, older in zip(batches, batches[1:]))
+        df = pd.concat(batches, ignore_index=True)
+        assert len(df) == 289 and df['id'].is_unique
+        #the store is filled once every batch has arrived, a repeated load is one synced batch
+        assert len(store.load()) == 289
+        hits = dict(usgs_stub.hits)
+        batches = list(self.loader(usgs_stub).stream(store, max_records=50))
+        assert len(batches) == 1 and len(batches[0]) == 289
+        assert usgs_stub.hits['query'] == hits['query']
+
+
+class TestPaginatedQuery:
+    PARAMS = RP(starttime='2020-01-01 00:00:00', endtime='2020-01-02 00:00:00', minmagnitude=None)
+
+    def test_query_skips_count(self, usgs_stub):
+        dl = DataLoader(self.PARAMS, url=usgs_stub.url, session=make_session())
+        assert len(dl.query()) == 145
+        assert usgs_stub.hits == {'count': 0, 'query': 1}
+
+    def test_preprocess(self, usgs_stub):
+        dl = DataLoader(self.PARAMS, url=usgs_stub.url, session=make_session())
+        dl.query()
+        df = dl.preprocess()
+        for col, expected_type in COL_TYPES.items():
+            assert df[col].dtype == expected_type, f"Column '{col}' must be of type {expected_type}"
+
+    def test_query_pages(self, usgs_stub):
+        params = RP(starttime=self.PARAMS.starttime, endtime=self.PARAMS.endtime, minmagnitude=None)
+        df = DataLoader(params, url=usgs_stub.url, session=make_session()).query(page_size=50)
+        assert len(df) == 145
+        assert df['id'].is_unique
+        assert usgs_stub.hits['query'] == 3
+
+    def test_query_honours_limit(self, usgs_stub):
+        params = RP(starttime=self.PARAMS.starttime, endtime=self.PARAMS.endtime, minmagnitude=None, limit=60)
+        df = DataLoader(params, url=usgs_stub.url, session=make_session()).query(page_size=50)
+        assert len(df) == 60
+        assert df['id'].tolist() == [event['id'] for event in usgs_stub.select({'starttime': params.starttime,
+                                                                                 'endtime': params.endtime})[:60]]
+        #the second page only asks for the 10 records left under the limit
+        assert usgs_stub.hits['query'] == 2
+
+    def test_query_pages_from_cached_count(self, usgs_stub, tmp_path):
+        params = RP(starttime=self.PARAMS.starttime, endtime=self.PARAMS.endtime, minmagnitude=None)
+        dl = DataLoader(params, url=usgs_stub.url, session=make_session(), cache=QueryCache(str(tmp_path)))
+        dl.count()
+        df = dl.query(page_size=29)
+        assert len(df) == 145
+        #145 records fill exactly 5 pages, one more page comes back short to confirm the count is still right
+        assert usgs_stub.hits == {'count': 1, 'query': 6}
+
+    def test_query_pages_past_stale_count(self, usgs_stub, tmp_path):
+        params = RP(starttime=self.PARAMS.starttime, endtime=self.PARAMS.endtime, minmagnitude=None)
+        cache = QueryCache(str(tmp_path))
+        dl = DataLoader(params, url=usgs_stub.url, session=make_session(), cache=cache)
+        #the cached count is from before 45 more events arrived
+        cache.put_count(dl.count_url, params, 100)
+        df = dl.query(page_size=50)
+        assert len(df) == 145 and df['id'].is_unique
+
+
+class TestCatalogFiles:
+    PARAMS = RP(starttime='2020-01-01 00:00:00', endtime='2020-02-01 00:00:00', minmagnitude=5)
+
+    def saved(self, usgs_stub, path, **kwargs):
+        dl = DataLoader(self.PARAMS, url=usgs_stub.url, session=make_session())
+        dl.query()
+        return dl.save(str(path), **kwargs)
+
+    def check(self, df, loaded):
+        assert len(loaded) == len(df)
+        for col, expected_type in COL_TYPES.items():
+            assert loaded[col].dtype == expected_type, f"Column '{col}' must be of type {expected_type}"
+        pd.testing.assert_frame_equal(loaded.sort_index()[list(COL_TYPES)], df.sort_index())
+
+    def test_parquet(self, usgs_stub, tmp_path):
+        path = tmp_path / 'catalog.parquet'
+        df = self.saved(usgs_stub, path)
+        self.check(df, load_catalog(str(path)))
+
+    def test_arrow(self, usgs_stub, tmp_path):
+        path = tmp_path / 'catalog.arrow'
+        df = self.saved(usgs_stub, path, format='arrow')
+        self.check(df, load_catalog(str(path)))
+
+    def test_partitioned(self, usgs_stub, tmp_path):
+        df = self.saved(usgs_stub, tmp_path / 'catalog.parquet')
+        #move every other event a year later so the catalog spans two years
+        df['time'] = df['time'].where(pd.RangeIndex(len(df)) % 2 == 0, df['time'] + pd.Timedelta(days=366))
+        path = tmp_path / 'catalog'
+        save_catalog(df, str(path), partition_by_year=True)
+        assert sorted(p.name for p in path.iterdir()) == ['year=2020', 'year=2021']
+        self.check(df, load_catalog(str(path)))
+        #saving again replaces the catalog instead of adding to it
+        save_catalog(df, str(path), partition_by_year=True)
+        self.check(df, load_catalog(str(path)))
+
+    def test_monthly(self, usgs_stub, tmp_path):
+        df = self.saved(usgs_stub, tmp_path / 'catalog.parquet')
+        df['time'] = df['time'].where(pd.RangeIndex(len(df)) % 2 == 0, df['time'] + pd.Timedelta(days=40))
+        path = tmp_path / 'monthly'
+        save_catalog(df, str(path), format='monthly')
+        assert sorted(p.name for p in path.iterdir()) == ['2020-01.parquet', '2020-02.parquet', '2020-03.parquet',
+                                                          'ids.parquet', 'partitions.json']
+        self.check(df, load_catalog(str(path)))
+        #saving again replaces the events instead of adding them twice
+        save_catalog(df, str(path), format='monthly')
+        self.check(df, load_catalog(str(path)))
+        #and drops the events no longer in the window, e.g. deleted upstream
+        save_catalog(df.iloc[1:], str(path), format='monthly', window=(df['time'].min(), df['time'].max()))
+        self.check(df.iloc[1:], load_catalog(str(path)))
+
+    def test_columns(self, usgs_stub, tmp_path):
+        path = tmp_path / 'catalog.parquet'
+        self.saved(usgs_stub, path)
+        assert list(load_catalog(str(path), columns=['time', 'mag']).columns) == ['time', 'mag']
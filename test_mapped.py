@@ -0,0 +1,42 @@
+import pandas as pd
+from MappedCatalog import MappedCatalog
+from DataLoader import COL_TYPES
+from test_visualizer import make_catalog
+
+
+def test_round_trip(tmp_path):
+    df = make_catalog(20).sample(frac=1, random_state=0)
+    catalog = MappedCatalog.write(df, str(tmp_path / 'catalog.arrow'))
+    assert len(catalog) == 20
+    loaded = catalog.to_frame()
+    for col, expected_type in COL_TYPES.items():
+        assert loaded[col].dtype == expected_type, f"Column '{col}' must be of type {expected_type}"
+    assert loaded['time'].is_monotonic_increasing
+    pd.testing.assert_frame_equal(loaded.reset_index(drop=True), df.sort_values('time').reset_index(drop=True))
+
+
+def test_slice(tmp_path):
+    df = make_catalog(20)
+    catalog = MappedCatalog.write(df, str(tmp_path / 'catalog.arrow'))
+    sliced = catalog.slice('2023-01-05', '2023-01-09', columns=['time', 'mag'])
+    assert list(sliced.columns) == ['time', 'mag']
+    assert sliced['time'].tolist() == pd.date_range('2023-01-05', '2023-01-09', freq='D', tz='UTC').tolist()
+    assert catalog.slice(end='2022-01-01').empty
+    assert len(catalog.slice(start=pd.Timestamp('2023-01-15', tz='UTC'))) == 6
+    assert catalog.time_range() == (df['time'].min(), df['time'].max())
+
+
+def test_index_kept(tmp_path):
+    df = make_catalog(5).set_axis(pd.Index([f'ev{i}' for i in range(5)], name='id'))
+    catalog = MappedCatalog.write(df, str(tmp_path / 'catalog.arrow'))
+    assert catalog.slice().index.tolist() == ['ev0', 'ev1', 'ev2', 'ev3', 'ev4']
+
+
+def test_shared_between_readers(tmp_path):
+    path = str(tmp_path / 'catalog.arrow')
+    MappedCatalog.write(make_catalog(5), path)
+    first, second = MappedCatalog(path), MappedCatalog(path)
+    #replacing the file leaves existing readers on the old, still mapped, copy
+    MappedCatalog.write(make_catalog(8), path)
+    assert len(first) == len(second) == 5
+    assert len(MappedCatalog(path)) == 8
@@ -0,0 +1,131 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from DataLoader import RequestParams as RP, COL_TYPES
+from PartitionedCatalog import PartitionedCatalog, CATALOG_META, lon_intervals
+from SpatialIndex import KM_PER_DEGREE, unit_vectors
+from test_visualizer import make_large_catalog
+
+
+@pytest.fixture(scope='module')
+def events():
+    df = make_large_catalog(20000)
+    df.index = pd.Index([f'ev{i}' for i in range(len(df))], name='id')
+    #2010 only has small events, so a magnitude bound prunes all of it
+    in_2010 = (df['time'].dt.year == 2010).to_numpy()
+    df.loc[in_2010, 'mag'] = df.loc[in_2010, 'mag'] * 0.3
+    return df
+
+
+@pytest.fixture(scope='module')
+def catalog(events, tmp_path_factory):
+    catalog = PartitionedCatalog(str(tmp_path_factory.mktemp('monthly')))
+    catalog.write(events)
+    return catalog
+
+
+def expected(events, params):
+    #brute force selection of the events matching params
+    lat, lon = events['lat'].to_numpy(), events['lon'].to_numpy()
+    keep = (events['time'] >= pd.Timestamp(params.starttime, tz='UTC')) & (events['time'] <= pd.Timestamp(params.endtime, tz='UTC'))
+    if params.minmagnitude is not None:
+        keep &= events['mag'] >= params.minmagnitude
+    keep &= (events['depth'] >= params.mindepth) & (events['depth'] <= params.maxdepth)
+    keep &= (lat >= params.minlatitude) & (lat <= params.maxlatitude)
+    keep &= ((lon - params.minlongitude) % 360 <= params.maxlongitude - params.minlongitude) \
+        | (params.maxlongitude - params.minlongitude >= 360)
+    if params.maxradiuskm is not None:
+        centre = unit_vectors(np.array(params.latitude), np.array(params.longitude))
+        distances = np.degrees(np.arccos(np.clip(unit_vectors(lat, lon) @ centre, -1, 1)))
+        keep &= distances <= params.maxradiuskm / KM_PER_DEGREE
+    return events[keep].sort_values('time', ascending=False, kind='stable')
+
+
+def test_metadata(catalog, events):
+    with open(catalog.meta_path) as f:
+        meta = json.load(f)
+    assert len(meta) == 300 and sum(entry['rows'] for entry in meta.values()) == len(events)
+    january = events[(events['time'].dt.year == 2000) & (events['time'].dt.month == 1)]
+    assert meta['2000-01']['mag'] == [january['mag'].min(), january['mag'].max()]
+    assert meta['2010-06']['mag'][1] < 2.4
+
+
+@pytest.mark.parametrize('params, max_read', [
+    #a year of every event reads that year's months
+    (RP(starttime='2005-01-01 00:00:00', endtime='2005-12-31 23:59:59', minmagnitude=None), 12),
+    #large events over a decade skip the months that only hold small ones
+    (RP(starttime='2005-01-01 00:00:00', endtime='2014-12-31 23:59:59', minmagnitude=5), 108),
+    #a box across the antimeridian and a depth range
+    (RP(starttime='2001-03-01 00:00:00', endtime='2003-03-01 00:00:00', minmagnitude=None, mindepth=100, maxdepth=300,
+        minlatitude=-20, maxlatitude=40, minlongitude=170, maxlongitude=200), 25),
+    #a circle
+    (RP(starttime='2015-01-01 00:00:00', endtime='2016-01-01 00:00:00', minmagnitude=2,
+        latitude=35.0, longitude=139.0, maxradiuskm=2000), 13),
+])
+def test_query_reads_only_overlapping_partitions(catalog, events, params, max_read):
+    before = catalog.info()['partitions_read']
+    df = catalog.query(params)
+    assert catalog.info()['partitions_read'] - before <= max_read
+    pd.testing.assert_frame_equal(df, expected(events, params))
+    for col, dtype in COL_TYPES.items():
+        assert df[col].dtype == dtype
+
+
+def test_columns(catalog):
+    params = RP(starttime='2005-01-01 00:00:00', endtime='2005-02-01 00:00:00', minmagnitude=7)
+    df = catalog.query(params, columns=['time', 'mag'])
+    assert list(df.columns) == ['time', 'mag'] and (df['mag'] >= 7).all()
+    #nothing overlaps a window before the catalog
+    assert catalog.query(RP(starttime='1990-01-01 00:00:00', endtime='1990-02-01 00:00:00')).empty
+
+
+def test_write_replaces_by_id(events, tmp_path):
+    catalog = PartitionedCatalog(str(tmp_path))
+    catalog.write(events.iloc[:1000])
+    revised = events.iloc[:10].assign(mag=9.5)
+    catalog.write(pd.concat([revised, events.iloc[1000:1100]]))
+    reopened = PartitionedCatalog(str(tmp_path))
+    assert len(reopened) == 1100
+    df = reopened.to_frame()
+    assert len(df) == 1100 and df.index.is_unique
+    assert (df.loc[revised.index, 'mag'] == 9.5).all()
+    month = revised['time'].iloc[0].strftime('%Y-%m')
+    assert reopened.meta[month]['mag'][1] == 9.5
+
+
+def test_write_window_replaces_stored_events(events, tmp_path):
+    stored = events.iloc[:1000].sort_values('time')
+    catalog = PartitionedCatalog(str(tmp_path))
+    catalog.write(stored)
+    #events deleted upstream are missing from a rewrite of their window and dropped, the rest are kept
+    window = stored.iloc[100:900]
+    start, end = window['time'].iloc[0], window['time'].iloc[-1]
+    catalog.write(window.drop(window.index[::2]), start, end)
+    df = PartitionedCatalog(str(tmp_path)).to_frame()
+    assert len(df) == 600 and df.index.is_unique
+    assert not df.index.isin(window.index[::2]).any()
+    assert catalog.ids().sort_index().index.equals(df.index.sort_values())
+
+
+def test_write_moves_events_between_months(events, tmp_path):
+    catalog = PartitionedCatalog(str(tmp_path))
+    catalog.write(events.iloc[:1000])
+    #a revised event whose time moved to another month, given with an id column instead of an index
+    moved = events.iloc[:1].assign(time=events['time'].iloc[0] + pd.Timedelta(days=45))
+    catalog.write(moved.reset_index())
+    df = PartitionedCatalog(str(tmp_path)).to_frame()
+    assert len(df) == 1000 and df.index.is_unique
+    assert df.loc[moved.index[0], 'time'] == moved['time'].iloc[0]
+    #the month it left is rewritten, or removed with the last of its events
+    old = events['time'].iloc[0].strftime('%Y-%m')
+    assert catalog.meta.get(old, {'rows': 0})['rows'] == (events.iloc[:1000]['time'].dt.strftime('%Y-%m') == old).sum() - 1
+    #events without ids cannot be told apart from the stored ones
+    with pytest.raises(ValueError, match='id'):
+        catalog.write(events.iloc[:10].reset_index(drop=True))
+
+
+def test_lon_intervals():
+    assert lon_intervals(-180, 180) == [(-180.0, 180.0)]
+    assert lon_intervals(170, 200) == [(170, 180.0), (-180.0, -160)]
+    assert lon_intervals(-200, -170) == [(160, 180.0), (-180.0, -170)]
@@ -0,0 +1,112 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import threading
+import requests
+from DataLoader import RequestParams as RP, DataLoader, make_session, parse_geojson, save_catalog, MAX_RECORDS
+from CatalogServer import LocalCatalog, SERVER_PATH, serve, read_catalog
+from SpatialIndex import KM_PER_DEGREE, unit_vectors
+from conftest import StubUSGS
+
+#the conftest stub catalog, one event every 10 minutes from 2020-01-01
+PARAMS = RP(starttime='2020-01-01 00:00:00', endtime='2020-02-05 00:00:00', minmagnitude=None)
+
+
+@pytest.fixture(scope='module')
+def stub():
+    return StubUSGS()
+
+
+@pytest.fixture(scope='module')
+def events(stub):
+    return parse_geojson(json.dumps({'features': stub.events}).encode())
+
+
+@pytest.fixture(scope='module')
+def server(events):
+    server = serve(LocalCatalog(events), port=0, background=True)
+    server.url = f'http://127.0.0.1:{server.server_port}{SERVER_PATH}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def loader(server, params=PARAMS):
+    return DataLoader(params, url=server.url, session=make_session())
+
+
+@pytest.mark.parametrize('params', [
+    PARAMS,
+    RP(starttime='2020-01-03 00:00:00', endtime='2020-01-04 00:00:00', minmagnitude=4.5, maxmagnitude=6.0),
+    RP(starttime='2020-01-01 00:00:00', endtime='2020-01-10 00:00:00', minmagnitude=None,
+       updatedafter='2020-01-05 00:00:00'),
+])
+def test_answers_like_the_api(server, stub, params):
+    #the local server selects the same events in the same order as the stub of the usgs service
+    args = {k: v for k, v in params.__dict__.items() if v is not None}
+    expected = [event['id'] for event in stub.select(args)]
+    dl = loader(server, params)
+    assert dl.count() == len(expected)
+    assert dl.query()['id'].tolist() == expected[:MAX_RECORDS]
+
+
+def test_sharded_and_paginated(server):
+    df = loader(server).query_sharded(max_records=500)
+    assert len(df) == 5000 and df['id'].is_unique
+    pages = loader(server).query(page_size=1000)
+    assert pages['id'].tolist() == df['id'].tolist()
+
+
+def test_error_releases_connection(server):
+    #a session with a single connection keeps working after a request the server rejects
+    dl = DataLoader(PARAMS, url=server.url, session=make_session(1))
+    with pytest.raises(Exception, match='400'):
+        dl.fetch(RP(**{**PARAMS.__dict__, 'limit': MAX_RECORDS + 10000}))
+    #fetched in a daemon thread so a leaked connection fails the test instead of blocking it
+    frames = []
+    thread = threading.Thread(target=lambda: frames.append(dl.fetch(RP(**{**PARAMS.__dict__, 'limit': 10}))), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert frames and len(frames[0]) == 10
+
+
+def test_spatial_filters(server, events):
+    lat, lon = events['lat'].to_numpy(), events['lon'].to_numpy()
+    #a rectangle across the antimeridian
+    box = RP(**{**PARAMS.__dict__, 'minlatitude': -30, 'maxlatitude': 30, 'minlongitude': 150, 'maxlongitude': 200})
+    expected = (lat >= -30) & (lat <= 30) & ((lon - 150) % 360 <= 50)
+    assert set(loader(server, box).query()['id']) == set(events['id'][expected])
+    #a circle given in km
+    circle = RP(**{**PARAMS.__dict__, 'latitude': 35.0, 'longitude': 139.0, 'maxradiuskm': 3000})
+    distances = np.degrees(np.arccos(np.clip(unit_vectors(lat, lon) @ unit_vectors(np.array(35.0), np.array(139.0)), -1, 1)))
+    expected = distances <= 3000 / KM_PER_DEGREE
+    assert expected.any()
+    assert set(loader(server, circle).query()['id']) == set(events['id'][expected])
+
+
+def test_orderby_and_errors(server):
+    args = {'starttime': '2020-01-01', 'endtime': '2020-01-02', 'format': 'geojson'}
+    body = requests.get(server.url + 'query', params={**args, 'orderby': 'magnitude'}).json()
+    mags = [feature['properties']['mag'] for feature in body['features']]
+    assert mags == sorted(mags, reverse=True) and body['metadata']['count'] == len(mags)
+    #a limit above the api's, a bad format and an unknown endpoint
+    assert requests.get(server.url + 'query', params={**args, 'limit': MAX_RECORDS + 1}).status_code == 400
+    assert requests.get(server.url + 'query', params={**args, 'format': 'csv'}).status_code == 400
+    assert requests.get(server.url + 'catalogs').status_code == 404
+
+
+def test_read_saved_catalog(events, tmp_path):
+    #a preprocessed catalog saved with save_catalog is served with the times the api returned
+    dl = DataLoader.__new__(DataLoader)
+    dl.df = events
+    save_catalog(dl.preprocess().set_axis(pd.Index(events['id'], name='id')), str(tmp_path / 'catalog.parquet'))
+    df = read_catalog(str(tmp_path / 'catalog.parquet'))
+    assert df['id'].tolist() == events['id'].tolist()
+    assert df['time'].tolist() == events['time'].tolist()
+    assert len(LocalCatalog(df)) == len(events)
+    #and so is a monthly catalog, read by load_catalog like any other
+    save_catalog(dl.preprocess().set_axis(pd.Index(events['id'], name='id')), str(tmp_path / 'monthly'), format='monthly')
+    df = read_catalog(str(tmp_path / 'monthly'))
+    assert df['id'].tolist() == events['id'].tolist()
+    assert df['time'].tolist() == events['time'].tolist()
@@ -0,0 +1,80 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from pytest import raises, mark
+from SingleFlight import SingleFlight, fcntl
+
+
+def test_concurrent_calls_share_one():
+    flights = SingleFlight()
+    calls = []
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return len(calls)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: flights.do('key', work), range(8)))
+    assert results == [1] * 8 and len(calls) == 1
+    assert flights.info() == {'calls': 8, 'shared': 7, 'in_flight': 0}
+    #a later call does the work again
+    assert flights.do('key', work) == 2
+
+
+def test_error_is_shared():
+    flights = SingleFlight()
+    started = threading.Event()
+    def fail():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError('api down')
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(flights.do, 'key', fail)
+        started.wait()
+        follower = pool.submit(flights.do, 'key', lambda: 'not run')
+        for future in (leader, follower):
+            with raises(ValueError, match='api down'):
+                future.result()
+
+
+def cached_work(directory, cache):
+    #what a DataLoader request does, look in the shared cache first and fill it after the slow request
+    def work():
+        if os.path.exists(cache):
+            return 'cached'
+        with open(os.path.join(directory, 'requests'), 'a') as f:
+            f.write('.')
+        time.sleep(0.5)
+        with open(cache, 'w') as f:
+            f.write('done')
+        return 'fetched'
+    SingleFlight().do('key', work, directory)
+
+
+@mark.skipif(fcntl is None, reason='lock files need fcntl')
+def test_processes_share_one(tmp_path):
+    directory, cache = str(tmp_path), str(tmp_path / 'cache')
+    processes = [multiprocessing.Process(target=cached_work, args=(directory, cache)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    with open(tmp_path / 'requests') as f:
+        assert f.read() == '.'
+    assert not os.path.exists(tmp_path / 'key.lock')
+
+
+@mark.skipif(fcntl is None, reason='lock files need fcntl')
+def test_lock_file_excludes_after_removal(tmp_path):
+    #leaders waiting on a lock file the previous leader removed never run alongside one locking the new file
+    active, overlaps = [], []
+    def work():
+        active.append(1)
+        overlaps.append(len(active))
+        time.sleep(0.02)
+        active.pop()
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: SingleFlight().do('key', work, str(tmp_path)), range(32)))
+    assert len(overlaps) == 32 and max(overlaps) == 1
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from DataLoader import RequestParams
+from SpatialIndex import SpatialIndex, unit_vectors, KM_PER_DEGREE
+
+
+@pytest.fixture(scope='module')
+def points():
+    rng = np.random.default_rng(0)
+    n = 20000
+    #uniform on the sphere, so the poles are covered too
+    lat = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    lon = rng.uniform(-180, 180, n)
+    lat[:5] = np.nan
+    return lat, lon
+
+
+def brute_distances(lat, lon, latitude, longitude):
+    dots = unit_vectors(lat, lon) @ unit_vectors(np.array(latitude), np.array(longitude))
+    return np.degrees(np.arccos(np.clip(dots, -1, 1)))
+
+
+@pytest.mark.parametrize('box', [(-10, 20, 30, 60), (40, 90, 170, 200), (-90, -60, -200, -150), (-5, 5, -180, 180)])
+def test_box_matches_brute_force(points, box):
+    lat, lon = points
+    minlat, maxlat, minlon, maxlon = box
+    expected = (lat >= minlat) & (lat <= maxlat) & (((lon - minlon) % 360 <= maxlon - minlon) | (maxlon - minlon >= 360))
+    np.testing.assert_array_equal(SpatialIndex(lat, lon).box(*box), np.flatnonzero(expected))
+
+
+@pytest.mark.parametrize('centre', [(0, 0, 10), (60, 179, 15), (-85, 20, 12), (30, -120, 100)])
+def test_radius_matches_brute_force(points, centre):
+    lat, lon = points
+    latitude, longitude, radius = centre
+    expected = np.flatnonzero(brute_distances(lat, lon, latitude, longitude) <= radius)
+    np.testing.assert_array_equal(SpatialIndex(lat, lon).radius(latitude, longitude, radius), expected)
+
+
+def test_nearest(points):
+    lat, lon = points
+    index = SpatialIndex(lat, lon)
+    rows, distances = index.nearest(35.0, 139.0, k=25)
+    brute = brute_distances(lat, lon, 35.0, 139.0)
+    np.testing.assert_array_equal(rows, np.argsort(np.nan_to_num(brute, nan=np.inf), kind='stable')[:25])
+    assert np.all(np.diff(distances) >= 0)
+
+
+def test_filter_params(points):
+    lat, lon = points
+    index = SpatialIndex(lat, lon)
+    #the default world rectangle does not filter
+    assert index.filter(RequestParams()) is None
+    params = RequestParams(minlatitude=0, maxlatitude=60, latitude=35.0, longitude=139.0, maxradiuskm=2000)
+    rows = index.filter(params)
+    distances = brute_distances(lat, lon, 35.0, 139.0)
+    expected = np.flatnonzero((distances <= 2000 / KM_PER_DEGREE) & (lat >= 0) & (lat <= 60))
+    np.testing.assert_array_equal(rows, expected)
@@ -1,6 +1,9 @@
 import pytest
 import pandas as pd
-from DataVisualizer import DataVisualizer
+import json
+import numpy as np
+from DataVisualizer import DataVisualizer, hex_bins, histogram, aggregate_grid, brush_names, brush_ranges
+from DataLoader import COL_TYPES, save_catalog
 
 def test_invalid_input_not_dataframe():
     with pytest.raises(AssertionError, match="Input must be a pandas DataFrame"):
@@ -33,4 +36,231 @@ def test_incorrect_column_types():
         'time': [pd.Timestamp('2023-01-01T00:00:00Z')]
     })
     with pytest.raises(AssertionError, match="Column 'sig' must be of type int64"):
-        DataVisualizer(df)
\ No newline at end of file
+        DataVisualizer(df)
+
+def make_catalog(n=10):
+    #a small frame matching COL_TYPES
+    return pd.DataFrame({
+        'place': [f'place {i}' for i in range(n)],
+        'time': pd.date_range('2023-01-01', periods=n, freq='D', tz='UTC'),
+        'lat': [float(i) for i in range(n)],
+        'lon': [float(-i) for i in range(n)],
+        'mag': [4.0 + i / 10 for i in range(n)],
+        'sig': list(range(n)),
+        'depth': [10.0 * i for i in range(n)],
+        'tsunami': [i % 2 == 0 for i in range(n)],
+        'cdi': [None] * n,
+        'alert': [None] * n,
+    }).astype(COL_TYPES)
+
+def test_from_file(tmp_path):
+    df = make_catalog()
+    for name, format in [('catalog.parquet', 'parquet'), ('catalog.arrow', 'arrow')]:
+        path = str(tmp_path / name)
+        save_catalog(df, path, format=format)
+        pd.testing.assert_frame_equal(DataVisualizer.from_file(path).df, df)
+
+
+def make_large_catalog(n=20000, seed=0):
+    #n random events matching COL_TYPES
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'place': [f'place {i}' for i in range(n)],
+        'time': pd.Timestamp('2000-01-01', tz='UTC') + pd.to_timedelta(rng.integers(0, 25 * 365 * 86400, n), unit='s'),
+        'lat': rng.uniform(-80, 80, n),
+        'lon': rng.uniform(-180, 180, n),
+        'mag': rng.uniform(0, 8, n),
+        'sig': rng.integers(0, 1000, n),
+        'depth': rng.uniform(0, 700, n),
+        'tsunami': rng.random(n) < 0.01,
+        'cdi': rng.uniform(1, 9, n),
+        'alert': [None] * n,
+    }).astype(COL_TYPES)
+
+def test_hex_bins_keep_largest_events():
+    df = make_large_catalog()
+    df.loc[123, ['mag', 'place']] = [9.5, 'the big one']
+    bins = hex_bins(df, 5.0)
+    assert bins['count'].sum() == len(df)
+    assert bins['mag'].max() == 9.5
+    assert bins.loc[bins['mag'].idxmax(), 'place'] == 'the big one'
+    #a bin holding a single event sits exactly on it
+    single = hex_bins(df.iloc[:3], 0.001)
+    np.testing.assert_allclose(single[['lon', 'lat']].to_numpy(), df.iloc[:3][['lon', 'lat']].to_numpy())
+
+def test_bin_events_bounded():
+    dv = DataVisualizer(make_large_catalog())
+    assert len(dv.bin_events(scale=100, max_points=500)) <= 500
+    #zooming in gives finer bins
+    assert len(dv.bin_events(scale=400, max_points=50000)) > len(dv.bin_events(scale=100, max_points=50000))
+
+def test_bin_events_zoomed_in():
+    df = make_large_catalog()
+    dv = DataVisualizer(df)
+    center = (df['lon'].iloc[0], df['lat'].iloc[0])
+    #the events in view fit in half of max_points and are drawn as they are, the rest stays binned
+    bins = dv.bin_events(scale=2000, max_points=500, center=center, radius=3.0, ranges=('mag',))
+    assert bins['count'].sum() == len(df) and len(bins) <= 500
+    events = bins[bins['count'] == 1]
+    assert ((events['lon'] == center[0]) & (events['lat'] == center[1])).any()
+    assert (events['mag_min'] == events['mag']).all()
+    #bins carry the range of their events for the brushes
+    binned = bins[bins['count'] > 1]
+    assert (binned['mag_min'] <= binned['mag_max']).all() and (binned['mag_max'] == binned['mag']).all()
+    #a view holding too many events stays binned
+    assert (dv.bin_events(scale=2000, max_points=50, center=center, radius=90.0)['count'] > 1).any()
+
+def test_binned_map_brushes_overlap_ranges():
+    spec = DataVisualizer(make_large_catalog(2000)).create_spec(filter_vars=['mag'], max_points=1000)
+    layer = spec['hconcat'][0]['vconcat'][0]['layer'][-1]
+    assert layer['transform'] == [{'filter': '!isValid(mag_brush.mag) || (datum.mag_max >= extent(mag_brush.mag)[0] '
+                                             '&& datum.mag_min <= extent(mag_brush.mag)[1])'}]
+    assert {'mag_min', 'mag_max'} <= set(spec['datasets']['bins'][0])
+
+def test_chart_bins_large_catalogs():
+    dv = DataVisualizer(make_large_catalog(2000))
+    def points_layer(spec):
+        return spec['hconcat'][0]['vconcat'][0]['layer'][-1]
+    spec = dv.create_chart(filter_vars=['mag'], max_points=1000).to_dict()
+    assert points_layer(spec)['encoding']['size']['field'] == 'count'
+    spec = dv.create_chart(filter_vars=['mag'], max_points=5000).to_dict()
+    assert points_layer(spec)['encoding']['size']['field'] == 'mag'
+
+def test_spec_embeds_events_once():
+    df = make_large_catalog(1000)
+    spec = DataVisualizer(df).create_spec(filter_vars=['mag', 'time'], color_var='sig', size_var='mag', opacity_var='mag',
+                                          heatmap_x='time', heatmap_y='depth', heatmap_color='max(mag)')
+    assert list(spec['datasets']) == ['events']
+    events = spec['datasets']['events']
+    assert len(events) == len(df)
+    #only the columns the encodings read, times in epoch ms and floats rounded
+    assert set(events[0]) == {'place', 'time', 'lat', 'lon', 'mag', 'sig', 'depth'}
+    assert events[0]['time'] == df['time'].iloc[0].value // 10**6
+    assert events[0]['lat'] == round(df['lat'].iloc[0], 3)
+    assert spec['hconcat'][0]['vconcat'][0]['layer'][-1]['data'] == {'name': 'events'}
+    assert spec['hconcat'][1]['data'] == {'name': 'events'}
+    #create_chart carries the same datasets on the altair chart
+    assert DataVisualizer(df).create_chart(filter_vars=['mag']).to_dict()['datasets'].keys() == {'events'}
+
+def test_histogram_counts_every_value():
+    rng = np.random.default_rng(1)
+    values = rng.uniform(-3, 7, 10000)
+    values[:10] = np.nan
+    table = histogram('x', values, rng.uniform(0, 8, 10000))
+    assert table['count'].sum() == 9990
+    assert len(table) <= 30
+    assert (table['x'] <= np.nanmin(values)).sum() == 1 and (table['x_end'] > np.nanmax(values)).sum() == 1
+    #each bin counts the values in [start, end)
+    row = table.iloc[3]
+    assert row['count'] == ((values >= row['x']) & (values < row['x_end'])).sum()
+
+def test_chart_hists_are_precomputed():
+    df = make_large_catalog(1000)
+    spec = DataVisualizer(df).create_spec(filter_vars=['mag', 'time'])
+    hists = spec['hconcat'][0]['vconcat'][1:]
+    for hist, var in zip(hists, ['mag', 'time']):
+        assert hist['encoding']['x']['bin'] == 'binned'
+        assert hist['encoding']['x']['field'] == var
+        assert sum(row['count'] for row in hist['data']['values']) == len(df)
+    #brushes select on x only, the bin start field the points layer is filtered on
+    brushes = {param['name']: param for param in spec['params']}
+    assert brushes['mag_brush']['select']['encodings'] == ['x']
+    assert brushes['time_brush']['select']['encodings'] == ['x']
+
+def test_aggregate_grid():
+    x = np.array([0.5, 1.5, 1.7, 9.0, np.nan])
+    y = np.array([0.1, 0.1, 0.2, 5.0, 1.0])
+    values = np.array([1.0, 2.0, 4.0, 8.0, 16.0])
+    grid = aggregate_grid(x, y, values, 'max', x_step=1, y_step=1).set_index(['x', 'y'])
+    assert grid.loc[(1.0, 0.0), 'value'] == 4.0
+    assert len(grid) == 3
+    assert aggregate_grid(x, y, values, 'sum', x_step=1, y_step=1)['value'].sum() == 15.0
+    assert aggregate_grid(x, y, None, 'count', x_step=1, y_step=1)['value'].sum() == 4
+    means = aggregate_grid(x, y, values, 'mean', x_step=1, y_step=1).set_index(['x', 'y'])
+    assert means.loc[(1.0, 0.0), 'value'] == 3.0
+
+def test_heatmap_grid_cached():
+    dv = DataVisualizer(make_large_catalog(3000), version='v1')
+    grid = dv.heatmap_grid('time', 'depth', 'max(mag)')
+    assert dv.heatmap_grid('time', 'depth', 'max(mag)') is grid
+    assert dv.heatmap_grid('mag', 'depth', 'count()')['value'].sum() == 3000
+    #large catalogs draw the server grid and embed no events
+    spec = dv.create_spec(filter_vars=['mag'], max_points=1000)
+    assert 'events' not in spec['datasets']
+    assert len(spec['hconcat'][1]['data']['values']) == len(grid)
+
+def test_heatmap_grid_brushed():
+    df = make_large_catalog(3000)
+    dv = DataVisualizer(df, version='brushed')
+    signals = {'mag_brush': {'mag': [4.0, 5.0]}, 'time_brush': {},
+               'brush': {'time': ['2023-01-01T00:00:00.000Z', df['time'].max().value // 10**6]}}
+    ranges = brush_ranges(signals)
+    assert ranges == {'mag': (4.0, 5.0), 'time': (pd.Timestamp('2023-01-01', tz='UTC').value // 10**6,
+                                                  df['time'].max().value // 10**6)}
+    brushed = dv.heatmap_grid('time', 'depth', 'count()', ranges=ranges)
+    inside = df['mag'].between(4.0, 5.0) & (df['time'] >= pd.Timestamp('2023-01-01', tz='UTC'))
+    assert brushed['value'].sum() == inside.sum()
+    #the cells stay those of all events
+    cells = dv.heatmap_grid('time', 'depth', 'count()').set_index(['x', 'y'])
+    assert set(brushed.set_index(['x', 'y']).index) <= set(cells.index)
+    #a binned page draws the heatmap beside the chart and redraws it for the brushes
+    spec = dv.create_spec(filter_vars=['mag'], max_points=1000, heatmap=False)
+    assert 'hconcat' not in spec
+    heatmap = dv.create_heatmap_spec(heatmap_color='count()', ranges=ranges)
+    assert sum(row['value'] for row in heatmap['data']['values']) == inside.sum()
+    assert brush_names(['mag']) == ['brush', 'mag_brush']
+
+def test_heatmap_color_without_aggregate():
+    dv = DataVisualizer(make_large_catalog(500), version='plain-color')
+    #a bare column is averaged
+    means = dv.heatmap_grid('time', 'depth', 'mag')
+    assert means['value'].tolist() == dv.heatmap_grid('time', 'depth', 'mean(mag)')['value'].tolist()
+    with pytest.raises(ValueError, match='Heatmap aggregate'):
+        dv.heatmap_grid('time', 'depth', 'median(mag)')
+
+def test_spec_cache_patches_projection(monkeypatch):
+    dv = DataVisualizer(make_large_catalog(500), version='spec-cache')
+    spec = dv.create_spec(filter_vars=['mag'], phi=0, scale=100)
+    assert dv.create_spec(filter_vars=['mag'], phi=0.0, scale=100) is spec
+    #rotating reuses the cached spec without building a chart
+    def build_chart(**kwargs):
+        raise AssertionError('chart rebuilt')
+    monkeypatch.setattr(dv, 'build_chart', build_chart)
+    rotated = dv.create_spec(filter_vars=['mag'], phi=45, scale=250, projection='orthographic')
+    def params(spec):
+        return {param['name']: param['value'] for param in spec['params'] if 'value' in param}
+    assert params(rotated) == {'projection_type': 'orthographic', 'projection_phi': 45,
+                               'projection_theta': 0, 'projection_scale': 250}
+    assert rotated['datasets'] is spec['datasets']
+    assert params(spec)['projection_phi'] == 0
+
+def test_projection_bound_to_inputs():
+    spec = DataVisualizer(make_large_catalog(500), version='projection').create_spec(filter_vars=['mag'], theta=30)
+    bound = {param['name']: param['bind']['element'] for param in spec['params'] if 'bind' in param}
+    assert bound == {'projection_type': '#projection_input', 'projection_phi': '#phi_input',
+                     'projection_theta': '#theta_input', 'projection_scale': '#scale_input'}
+    #every map layer reads the params
+    for layer in spec['hconcat'][0]['vconcat'][0]['layer']:
+        assert layer['projection']['rotate'] == {'expr': '[toNumber(projection_phi), toNumber(projection_theta), 0]'}
+
+def test_renderer_modes():
+    assert DataVisualizer(make_catalog()).renderer() == 'svg'
+    dv = DataVisualizer(make_large_catalog(3000))
+    assert dv.renderer() == 'canvas'
+    assert dv.renderer('svg') == 'svg'
+    with pytest.raises(AssertionError):
+        dv.renderer('opengl')
+
+def test_deck_spec_tooltip_fields():
+    df = make_large_catalog(200)
+    dv = DataVisualizer(df)
+    spec = dv.create_deck_spec(color_var='time', size_var='mag')
+    countries, events = spec['layers']
+    assert countries['data']['type'] == 'FeatureCollection'
+    assert len(events['data']) == len(df)
+    record = events['data'][0]
+    assert {'place', 'mag', 'depth', 'time'} <= set(record)
+    assert record['time'].endswith('UTC') and len(record['color']) == 3
+    #without the map the chart is the histograms and the heatmap
+    spec = dv.create_spec(filter_vars=['mag'], draw_map=False)
+    assert 'layer' not in spec['hconcat'][0]['vconcat'][0]